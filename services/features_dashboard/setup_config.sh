@@ -1,7 +1,7 @@
 export PRODUCT_ID="BTC/USD"
 
 export FEATURE_GROUP_NAME="ohlc_feature_group"
-export FEATURE_GROUP_VERSION=1
+export FEATURE_GROUP_VERSION=4
 
 export FEATURE_VIEW_NAME="ohlc_feature_view"
-export FEATURE_VIEW_VERSION=1
\ No newline at end of file
+export FEATURE_VIEW_VERSION=2
\ No newline at end of file
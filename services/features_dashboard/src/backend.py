@@ -77,6 +77,10 @@ def get_features_from_the_store(
             # breakpoint()
             # retry the call with the use_hive option. This is what Hopsworks recommends
             features: pd.DataFrame = feature_view.get_batch_data(read_options={"use_hive": True})
+
+        # the feature group holds the candles of every resolution, and we plot the
+        # 1-minute ones
+        features = features[features['window_sec'] == 60]
     else:
         # we fetch from the online feature store.
         # we need to build this list of dictionaries with the primary keys because the online feature store does not support batch reads
@@ -110,14 +114,15 @@ def get_primary_keys(last_n_minutes: int) -> List[Dict]:
     timestamps = [current_utc - i * 60000 for i in range(last_n_minutes)]
     
     # I've just sent the `kafka_to_feature_store` service pushing a candle for
-    # this timestamp for BTC/USD. Let's see if we can actually read it from the online store.
+    # primary keys are the product_id, timestamp and resolution of 1-minute candles
     # timestamps = [1719068640000]
 
-    # primary keys are pairs of product_id and timestamp
+    # primary keys are the product_id, timestamp and resolution of the 1-minute candles
     primary_keys = [
         {
             'product_id': config.product_id,
             'timestamp': timestamp,
+            'window_sec': 60,
         } for timestamp in timestamps
     ]
 
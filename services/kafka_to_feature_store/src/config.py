@@ -24,6 +24,14 @@ class Config(BaseSettings):
     # whether to create a new consumer group or not
     create_new_consumer_group: bool = False
     
+    # the resolution of the candles that come without a `window_sec` field, i.e.
+    # from a topic with the candles of a single resolution
+    ohlc_window_sec: int = 60
+
+    # port of the Prometheus metrics endpoint, with the latency of the pipeline.
+    # None disables it
+    metrics_port: Optional[int] = 8000
+
     # required to authenticate with Hopsworks API
     hopsworks_project_name: str
     hopsworks_api_key: str
@@ -40,14 +40,44 @@ def push_data_to_feature_store(
     ohlc_feature_group = feature_store.get_or_create_feature_group(
         name=feature_group_name,
         version=feature_group_version,
-        description='OHLC data coming from Kraken',
-        primary_key=['product_id', 'timestamp'],
+        description=(
+            'OHLC data coming from Kraken, with the volume, notional, VWAP, trade '
+            'count and buy / sell volume of each candle. The candles of the windows '
+            'without trades are flat and marked with is_synthetic. The RSI, '
+            'momentum, standard deviation and MACD come from trade_to_ohlc when '
+            'it computes them. window_sec is the resolution of the candle'
+        ),
+        # with OHLC_TAG_WINDOW_SEC, the candles of every resolution come through the
+        # same topic, so a 1m and a 5m candle can end at the same timestamp
+        primary_key=['product_id', 'timestamp', 'window_sec'],
         event_time='timestamp',
         online_enabled=True,
     )
 
     # transform the data (dict) into a pandas dataframe
-    data = pd.DataFrame(data)    
+    data = pd.DataFrame(data)
+    # the candles of a topic with a single resolution don't tell which one it is
+    if 'window_sec' not in data.columns:
+        data['window_sec'] = config.ohlc_window_sec
+    data['window_sec'] = (
+        data['window_sec'].fillna(config.ohlc_window_sec).astype('int64')
+    )
+    # trade_to_ohlc sends a candle again when late trades correct it, so we keep
+    # the latest version of each candle. The feature group upserts on its primary
+    # key, which takes care of the corrections of candles from earlier batches.
+    data = data.drop_duplicates(
+        subset=['product_id', 'timestamp', 'window_sec'], keep='last'
+    )
+    # the VWAP is None for candles without volume, the indicators are None until
+    # enough candles came in, and the trade count must not be inferred as a float
+    # when some candles lack it
+    for column in ['vwap', 'rsi', 'momentum', 'std', 'MACD', 'MACD_Signal']:
+        if column in data.columns:
+            data[column] = data[column].astype('float64')
+    if 'trade_count' in data.columns:
+        data['trade_count'] = data['trade_count'].fillna(0).astype('int64')
+    if 'is_synthetic' in data.columns:
+        data['is_synthetic'] = data['is_synthetic'].fillna(False).astype('bool')
     # Write the data to the feature group
 
     ohlc_feature_group.insert(
@@ -5,6 +5,8 @@ import json
 from loguru import logger
 from datetime import datetime, timezone
 from hopsworks_api import push_data_to_feature_store
+from metrics import get_candle_trace, observe_inserted
+from prometheus_client import start_http_server
 
 def get_current_utc_ts() -> int:
     """
@@ -69,6 +71,9 @@ def kafka_to_feature_store(
     last_save_to_feature_store_ts = get_current_utc_ts()
     #initialize the buffer
     buffer = []
+    # the traces of the candles in the buffer, for the latency of the pipeline,
+    # which only makes sense for the live candles
+    traces = []
     #TODO: handle the case where the buffer is not full and there is nor more expected data to come in 
     # as with the current implementation we may miss the last few messages if the buffer is not full (up to buffer_size-1 messages)
     # Create a consumer and start a polling loop
@@ -95,8 +100,11 @@ def kafka_to_feature_store(
                         feature_group_version=feature_group_version,
                         online_or_offline = "online"  if live_or_historical == "live" else "offline"
                     )
+                    # the candles are queryable now
+                    observe_inserted(traces)
                     #clear the buffer
                     buffer = []
+                    traces = []
                 else:
                     #if the last message was received less than save_every_n_sec seconds ago we will skip to the next iteration
                     logger.debug("Timer limit not excedeed, continuing the polling from the input Kafka topic")
@@ -113,6 +121,10 @@ def kafka_to_feature_store(
                     continue
                 #append the data to the buffer
                 buffer.append(ohlc)
+                if live_or_historical == 'live':
+                    trace = get_candle_trace(ohlc, msg.headers())
+                    if trace is not None:
+                        traces.append(trace)
                 logger.info(f"current buffer length: {len(buffer)}")
                 
                 #check if the buffer is full
@@ -124,9 +136,12 @@ def kafka_to_feature_store(
                         feature_group_version=feature_group_version,
                         online_or_offline = "online"  if live_or_historical == "live" else "offline"
                     )
+                    # the candles are queryable now
+                    observe_inserted(traces)
                 
                     #clear the buffer
                     buffer = []
+                    traces = []
                 # update the last_save_to_feature_store_ts
                 last_save_to_feature_store_ts = get_current_utc_ts()
                 # step 2 -> store the data in the feature store
@@ -148,6 +163,10 @@ def kafka_to_feature_store(
             #consumer.store_offsets(message=msg)# telling kafka that this consumer group has red up until this message
 
 if __name__ == "__main__":
+    if config.metrics_port is not None:
+        # Prometheus scrapes the metrics from http://<host>:<metrics_port>/metrics
+        start_http_server(config.metrics_port)
+
     try: 
         kafka_to_feature_store(
             kafka_topic = config.kafka_topic,
@@ -0,0 +1,90 @@
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Histogram
+
+# Prometheus metrics of kafka_to_feature_store, served on METRICS_PORT by `main`.
+#
+# The candles of trade_to_ohlc carry trace headers, see
+# `trade_to_ohlc/src/tracing.py`: 'ingest_ms', when trade_producer got the trade
+# that closed the candle, and 'produce_ms', when trade_to_ohlc produced the
+# candle. Once a candle is in the feature store, we split the time since the end
+# of its window into the stages of the pipeline:
+#
+#   window_to_ingest: waiting for a trade of the next window, plus the latency of
+#       the exchange and of trade_producer
+#   ingest_to_produce: the trades topic and trade_to_ohlc
+#   produce_to_insert: the OHLC topic, our buffer and the insert into Hopsworks
+#   end_to_end: all of the above, until the candle is queryable
+
+PIPELINE_LATENCY_SECONDS = Histogram(
+    'ohlc_pipeline_latency_seconds',
+    'Time spent by the candles in each stage of the pipeline, until they are '
+    'inserted into the feature store',
+    ['stage'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+# (end of the window, ingest time, produce time) of a candle, in milliseconds
+CandleTrace = Tuple[int, Optional[int], Optional[int]]
+
+
+def get_candle_trace(
+    candle: Dict[str, Any], headers: Optional[List[Tuple[str, bytes]]]
+) -> Optional[CandleTrace]:
+    """
+    Returns the trace of a candle from the `headers` of its message, or None if
+    we don't record its latency.
+
+    The corrections of a candle by late trades are produced long after the end of
+    its window, so they are not traced. Neither are the synthetic candles of the
+    windows without trades: they are produced when a trade of a later window
+    comes in, so their latency says nothing about the pipeline.
+
+    Args:
+        candle (Dict[str, Any]): The candle.
+        headers (Optional[List[Tuple[str, bytes]]]): The headers of the message.
+
+    Returns:
+        Optional[CandleTrace]: The trace of the candle.
+    """
+    headers = dict(headers or ())
+    if headers.get('is_correction') == b'1' or candle.get('is_synthetic'):
+        return None
+    ingest_ms = headers.get('ingest_ms')
+    produce_ms = headers.get('produce_ms')
+    return (
+        candle['timestamp'],
+        int(ingest_ms) if ingest_ms is not None else None,
+        int(produce_ms) if produce_ms is not None else None,
+    )
+
+
+def observe_inserted(traces: List[CandleTrace]) -> None:
+    """
+    Records the latency of each stage of the candles we just inserted into the
+    feature store.
+
+    Args:
+        traces (List[CandleTrace]): The traces of the inserted candles.
+
+    Returns:
+        None
+    """
+    insert_ms = time() * 1000
+    for timestamp, ingest_ms, produce_ms in traces:
+        PIPELINE_LATENCY_SECONDS.labels(stage='end_to_end').observe(
+            (insert_ms - timestamp) / 1000
+        )
+        if ingest_ms is not None:
+            PIPELINE_LATENCY_SECONDS.labels(stage='window_to_ingest').observe(
+                (ingest_ms - timestamp) / 1000
+            )
+        if produce_ms is not None:
+            PIPELINE_LATENCY_SECONDS.labels(stage='produce_to_insert').observe(
+                (insert_ms - produce_ms) / 1000
+            )
+        if ingest_ms is not None and produce_ms is not None:
+            PIPELINE_LATENCY_SECONDS.labels(stage='ingest_to_produce').observe(
+                (produce_ms - ingest_ms) / 1000
+            )
@@ -0,0 +1,28 @@
+from metrics import get_candle_trace
+
+HEADERS = [('ingest_ms', b'1719068641000'), ('produce_ms', b'1719068641500')]
+
+
+def candle(**fields):
+    return {'product_id': 'BTC/USD', 'timestamp': 1719068640000, **fields}
+
+
+def test_trace_of_a_candle():
+    assert get_candle_trace(candle(is_synthetic=False), HEADERS) == (
+        1719068640000,
+        1719068641000,
+        1719068641500,
+    )
+
+
+def test_trace_without_headers():
+    assert get_candle_trace(candle(), None) == (1719068640000, None, None)
+
+
+def test_corrections_are_not_traced():
+    headers = HEADERS + [('is_correction', b'1')]
+    assert get_candle_trace(candle(), headers) is None
+
+
+def test_synthetic_candles_are_not_traced():
+    assert get_candle_trace(candle(is_synthetic=True), HEADERS) is None
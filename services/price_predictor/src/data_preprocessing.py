@@ -36,6 +36,19 @@ def interpolate_missing_candles(
     # do the same for high and low
     ohlc_data['high'].fillna(ohlc_data['close'], inplace=True)
     ohlc_data['low'].fillna(ohlc_data['close'], inplace=True)
+
+    # trade_to_ohlc already emits synthetic candles for the windows without trades,
+    # and the few we still fill here, e.g. across restarts, are synthetic as well
+    if 'is_synthetic' in ohlc_data.columns:
+        ohlc_data['is_synthetic'] = ohlc_data['is_synthetic'].fillna(True).astype(bool)
+
+    # nothing was traded in the missing candles, so their volume is 0 and their
+    # vwap is the close price. Older feature groups don't have these columns.
+    for column in ['volume', 'trade_count', 'buy_volume', 'sell_volume']:
+        if column in ohlc_data.columns:
+            ohlc_data[column] = ohlc_data[column].fillna(0)
+    if 'vwap' in ohlc_data.columns:
+        ohlc_data['vwap'] = ohlc_data['vwap'].fillna(ohlc_data['close'])
     
     # we have to forward fill the product_id as well
     ohlc_data['product_id'].ffill(inplace=True)
@@ -1,5 +1,6 @@
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 import talib
 
@@ -25,6 +26,9 @@ def add_features(
     - RSI indicator -> `rsi` column
     - Momentum indicator -> `momentum` column
     - Standard deviation -> `std` column
+    - MACD -> `MACD` and `MACD_Signal` columns
+    - Volume indicators, if the candles have volume -> `vwap_distance`,
+      `buy_volume_ratio`, `volume_change` and `obv` columns
 
     - Last observed target -> `last_observed_target` column
     - Temporal features -> `day_of_week`, `hour_of_day`, `minute_of_hour` columns
@@ -44,13 +48,16 @@ def add_features(
     X_ = add_volatility_indicators(X_, timeperiod=volatility_timeperiod, fillna=fillna)
     X_ = add_macd_indicator(X_, fillna=fillna)
 
+    # candles from older feature groups don't have the volume based fields
+    if 'volume' in X_.columns:
+        X_ = add_volume_indicators(X_, fillna=fillna)
+
     # Challenge -> You can add more features here, for example:
     # - Moving averages
     # - Bollinger bands
     # - MACD
     # - etc.
     # You can use the talib library to compute these indicators
-    # Some of these indicators require the `volume` which we don't have in our feature group.
 
     X_ = add_last_observed_target(
         X_,
@@ -134,6 +141,41 @@ def add_volatility_indicators(
 
     return X_
 
+def add_volume_indicators(
+    X: pd.DataFrame,
+    fillna: Optional[bool] = True,
+) -> pd.DataFrame:
+    """
+    Adds the indicators that depend on the volume of the candles
+    - Distance between the close price and the VWAP -> `vwap_distance` column
+    - Share of the volume bought by the takers -> `buy_volume_ratio` column
+    - Change in volume from the previous candle -> `volume_change` column
+    - On-Balance Volume -> `obv` column
+
+    Args:
+        - X: pd.DataFrame: the input DataFrame, with the `volume`, `vwap` and
+          `buy_volume` columns
+
+    Returns:
+        - pd.DataFrame: the input DataFrame with the new columns
+    """
+    X_ = X.copy()
+
+    X_['vwap_distance'] = X_['close'] / X_['vwap'] - 1
+    X_['buy_volume_ratio'] = X_['buy_volume'] / X_['volume']
+    X_['volume_change'] = X_['volume'].pct_change()
+    X_['obv'] = talib.OBV(X_['close'], X_['volume'])
+
+    # candles without volume give NaN (0/0) or inf (x/0) ratios
+    volume_features = ['vwap_distance', 'buy_volume_ratio', 'volume_change', 'obv']
+    X_[volume_features] = X_[volume_features].replace([np.inf, -np.inf], np.nan)
+
+    if fillna:
+        X_[volume_features] = X_[volume_features].fillna(0)
+
+    return X_
+
+
 def add_macd_indicator(
     X: pd.DataFrame,
     fastperiod: Optional[int] = 12,
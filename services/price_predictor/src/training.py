@@ -196,6 +196,10 @@ def train(
         'hour_of_day',
         'minute_of_hour',
     ]
+    # candles from older feature groups don't have the volume based features
+    volume_features = ['vwap_distance', 'buy_volume_ratio', 'volume_change', 'obv']
+    if all(feature in X_train.columns for feature in volume_features):
+        features_to_use += volume_features
     X_train = X_train[features_to_use]
     X_test = X_test[features_to_use]
 
@@ -57,6 +57,7 @@ class OhlcDataReader:
             {
                 'product_id': product_id,
                 'timestamp': timestamp,
+                'window_sec': self.ohlc_window_sec,
             } for timestamp in timestamp_keys
         ]
         
@@ -190,6 +191,8 @@ class OhlcDataReader:
 
         # filter the features for the given product_id and time range
         features = features[features['product_id'] == product_id]
+        # the feature group holds the candles of every resolution
+        features = features[features['window_sec'] == self.ohlc_window_sec]
         features = features[features['timestamp'] >= from_timestamp_ms]
         features = features[features['timestamp'] <= to_timestamp_ms]
         # sort the features by timestamp (ascending)
@@ -216,9 +219,9 @@ if __name__ == '__main__':
 
     ohlc_data_reader = OhlcDataReader(
         feature_view_name='ohlc_feature_view',
-        feature_view_version=10,
+        feature_view_version=11,
         feature_group_name='ohlc_feature_group',
-        feature_group_version=3,
+        feature_group_version=4,
         ohlc_window_sec=60
     )
 
@@ -0,0 +1,121 @@
+"""
+Micro-benchmarks for the hot loop of `main.produce_trades`.
+
+Run them with `make benchmark`. They don't need a Kafka broker, because they
+only measure the per-trade work we do before handing the message to the producer.
+"""
+
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable, List
+
+from loguru import logger
+from quixstreams import Application
+from quixstreams.models.topics import Topic
+
+from kraken_api.timestamps import kraken_timestamp_to_ms
+from kraken_api.trade import Trade, TradeRecord
+from serialization import serialize_trade
+
+N_TRADES = 200_000
+
+# one day of BTC/USD trades looks roughly like this
+RAW_TRADES = [
+    ('BTC/USD', 65000.0 + i % 100, 0.001 * (i % 7 + 1), 1718616999467 + i)
+    for i in range(N_TRADES)
+]
+
+
+def pydantic_path(topic: Topic) -> None:
+    """
+    The original hot loop: build a pydantic `Trade`, serialize it with
+    `topic.serialize` and format it for the debug logs.
+    """
+    for product_id, price, volume, timestamp_ms in RAW_TRADES:
+        trade = Trade(
+            product_id=product_id,
+            price=price,
+            volume=volume,
+            timestamp_ms=timestamp_ms,
+        )
+        message = topic.serialize(key=trade.product_id, value=trade.model_dump())
+        _ = message.value
+        logger.debug(f'{trade.model_dump()}')
+
+
+def fast_path(topic: Topic) -> None:
+    """
+    The current hot loop: build a `TradeRecord`, serialize it with orjson and
+    log it lazily.
+    """
+    for product_id, price, volume, timestamp_ms in RAW_TRADES:
+        trade = TradeRecord(product_id, price, volume, timestamp_ms)
+        _ = serialize_trade(trade)
+        logger.opt(lazy=True).debug('{}', trade._asdict)
+
+
+# timestamps as they come in the websocket messages, a few trades per second
+RAW_TIMESTAMPS = [
+    datetime.fromtimestamp(1718616999.467866 + i / 5, tz=timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ'
+    )
+    for i in range(N_TRADES)
+]
+
+
+def fromisoformat_parser(_: Topic) -> None:
+    """
+    The original timestamp parser of `KrakenWebsocketTradeAPI.to_ms`
+    """
+    for timestamp in RAW_TIMESTAMPS:
+        _ = int(
+            datetime.fromisoformat(timestamp[:-1])
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+            * 1000
+        )
+
+
+def fixed_format_parser(_: Topic) -> None:
+    """
+    The current timestamp parser, `kraken_timestamp_to_ms`
+    """
+    for timestamp in RAW_TIMESTAMPS:
+        _ = kraken_timestamp_to_ms(timestamp)
+
+
+def run(name: str, fn: Callable[[Topic], None], topic: Topic) -> float:
+    """
+    Runs `fn` over `N_TRADES` trades and returns the throughput in trades/sec
+    """
+    start = perf_counter()
+    fn(topic)
+    trades_per_sec = N_TRADES / (perf_counter() - start)
+    print(f'{name:<20} {trades_per_sec:>14,.0f} trades/sec')
+    return trades_per_sec
+
+
+def main(benchmarks: List[Callable[[Topic], None]]) -> None:
+    """
+    Runs the given benchmarks one after the other and compares the first and the last
+    """
+    # the benchmark is about serialization cost, so we keep debug logs off like
+    # in production
+    logger.remove()
+    logger.add(lambda _: None, level='INFO')
+
+    # creating the topic object doesn't need a broker to be running
+    app = Application(broker_address='localhost:9092')
+    topic = app.topic(name='trades', value_serializer='json')
+
+    results = [run(fn.__name__, fn, topic) for fn in benchmarks]
+    print(f'speedup: {results[-1] / results[0]:.1f}x')
+    print(f'cost per trade: {1e9 / results[-1]:.0f} ns')
+
+
+if __name__ == '__main__':
+    print('Trade serialization')
+    main([pydantic_path, fast_path])
+
+    print('\nTimestamp parsing')
+    main([fromisoformat_parser, fixed_format_parser])
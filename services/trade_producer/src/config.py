@@ -18,6 +18,73 @@ class Config(BaseSettings):
     live_or_historical: str
     last_n_days: Optional[int] = 1  # Optional because it is not required for live data
     cache_dir_historical_data: Optional[str] = None
+    # SQLite file where we save the backfill checkpoints, to resume after a crash
+    checkpoint_db_path: Optional[str] = None
+    # replay mode: speed at which we replay the cached trades, as a multiple of
+    # real time. 0 means as fast as possible
+    replay_speed: Optional[float] = 0
+    # number of products fetched in parallel from the REST API. None means all of them
+    n_threads_historical: Optional[int] = None
+    # global rate limit for the Kraken REST API, shared by all products
+    rest_api_requests_per_sec: Optional[float] = 1
+    rest_api_burst_size: Optional[int] = 1
+    # use HTTP/2 for the REST API, if the optional httpx dependency is installed
+    rest_api_http2: Optional[bool] = False
+
+    # the trade sources we ingest from concurrently, e.g. '["kraken_websocket", "file"]'
+    # None means the default source of `live_or_historical`
+    trade_sources: Optional[List[str]] = None
+    # JSON lines file read by the 'file' trade source
+    trades_file_path: Optional[str] = None
+    # how often we log the throughput of each trade source
+    source_stats_interval_sec: Optional[int] = 60
+
+    # number of websocket connections across which we shard the product_ids
+    n_websocket_connections: Optional[int] = 1
+    # max number of decoded websocket messages waiting to be produced to Kafka
+    trade_queue_size: Optional[int] = 10_000
+
+    # we drop trades seen in the last `dedup_window_sec` seconds, remembering at most
+    # `dedup_max_trades_per_product` trades per product
+    dedup_window_sec: Optional[int] = 300
+    dedup_max_trades_per_product: Optional[int] = 100_000
+
+    # number of partitions of the trades topic. When set, the topic is created with
+    # that many partitions and each product is assigned to one of them, in the
+    # order of `product_ids`, so new products must go at the end of the list.
+    # None leaves the partitioning to the hash of the message key
+    kafka_topic_partitions: Optional[int] = None
+
+    # format of the messages in the trades topic: 'json' or 'binary'
+    trades_value_format: Optional[str] = 'json'
+
+    # Kafka producer tuning. librdkafka waits up to `producer_linger_ms` to fill
+    # batches of up to `producer_batch_size` bytes, compressed with
+    # `producer_compression_type`
+    producer_linger_ms: Optional[int] = 100
+    producer_batch_size: Optional[int] = 1_000_000
+    producer_compression_type: Optional[str] = 'lz4'
+    # max number of messages waiting for a delivery report before we stop
+    # fetching new trades
+    max_in_flight_messages: Optional[int] = 100_000
+
+    # whether the trades carry the time we got them in an 'ingest_ms' header, to
+    # trace the latency of the pipeline down to the feature store
+    trace_headers: Optional[bool] = True
+
+    # port of the Prometheus metrics endpoint. None disables it
+    metrics_port: Optional[int] = 8000
+
+    # set it to INFO or above to skip the per-trade debug logs in the hot loop
+    log_level: Optional[str] = 'DEBUG'
+
+    @field_validator('kafka_topic_partitions')
+    @classmethod
+    def validate_kafka_topic_partitions(cls, value):
+        assert (
+            value is None or value > 0
+        ), f'Invalid value for kafka_topic_partitions: {value}'
+        return value
 
     # Validate the live_or_historical argument using a pydantic field validator
     @field_validator('live_or_historical')
@@ -26,8 +93,43 @@ class Config(BaseSettings):
         assert value in {
             'live',
             'historical',
+            'replay',
         }, f'Invalid value for live_or_historical: {value}'
         return value
 
+    @field_validator('trade_sources')
+    @classmethod
+    def validate_trade_sources(cls, value):
+        if value is not None:
+            for name in value:
+                assert name in {
+                    'kraken_websocket',
+                    'kraken_rest',
+                    'kraken_replay',
+                    'file',
+                }, f'Invalid trade source: {name}'
+        return value
+
+    @field_validator('trades_value_format')
+    @classmethod
+    def validate_trades_value_format(cls, value):
+        assert value in {
+            'json',
+            'binary',
+        }, f'Invalid value for trades_value_format: {value}'
+        return value
+
+    @field_validator('producer_compression_type')
+    @classmethod
+    def validate_producer_compression_type(cls, value):
+        assert value in {
+            'none',
+            'gzip',
+            'snappy',
+            'lz4',
+            'zstd',
+        }, f'Invalid value for producer_compression_type: {value}'
+        return value
+
 
 config = Config()
@@ -0,0 +1,98 @@
+from typing import Dict, Hashable, List
+
+from kraken_api.trade import TradeRecord
+
+
+class TradeDeduplicator:
+    """
+    Drops the trades we already produced, before they reach Kafka.
+
+    Duplicates come from the REST pager, which may re-emit the trades at the
+    boundary between two pages, and from the gap backfill after a websocket
+    reconnection, which overlaps with the live stream.
+
+    For each product we remember the keys of the trades seen in the last
+    `window_ms` milliseconds (of trade time), up to `max_trades_per_product` keys,
+    so memory stays bounded no matter how long the service runs. The key is
+    Kraken's `trade_id`, or the (timestamp_ms, price, volume) tuple for trades
+    without one. Trades older than the window can't be checked, and go through.
+    """
+
+    def __init__(
+        self,
+        window_ms: int = 300_000,
+        max_trades_per_product: int = 100_000,
+    ) -> None:
+        """
+        Args:
+            window_ms (int): How long we remember a trade, in trade time.
+            max_trades_per_product (int): The maximum number of trades we remember
+                for each product.
+
+        Returns:
+            None
+        """
+        self.window_ms = window_ms
+        self.max_trades_per_product = max_trades_per_product
+
+        # {product_id: {trade key: timestamp_ms}}, in insertion order, which is
+        # (almost) time order, so the oldest keys are always at the front
+        self._seen: Dict[str, Dict[Hashable, int]] = {}
+        # the most recent timestamp we have seen for each product
+        self._latest_ms: Dict[str, int] = {}
+
+        self.n_duplicates = 0
+
+    def filter(self, trades: List[TradeRecord]) -> List[TradeRecord]:
+        """
+        Returns the given trades without the ones we have already seen
+
+        Args:
+            trades (List[TradeRecord]): The trades we are about to produce.
+
+        Returns:
+            List[TradeRecord]: The trades that are not duplicates.
+        """
+        unique_trades = []
+
+        for trade in trades:
+            seen = self._seen.setdefault(trade.product_id, {})
+            key = (
+                trade.trade_id
+                if trade.trade_id is not None
+                else (trade.timestamp_ms, trade.price, trade.volume)
+            )
+
+            if key in seen:
+                self.n_duplicates += 1
+                continue
+
+            unique_trades.append(trade)
+
+            latest_ms = max(
+                self._latest_ms.get(trade.product_id, 0), trade.timestamp_ms
+            )
+            self._latest_ms[trade.product_id] = latest_ms
+
+            if trade.timestamp_ms < latest_ms - self.window_ms:
+                # too old to be remembered
+                continue
+
+            seen[key] = trade.timestamp_ms
+            self._evict(seen, latest_ms)
+
+        return unique_trades
+
+    def _evict(self, seen: Dict[Hashable, int], latest_ms: int) -> None:
+        """
+        Forgets the oldest keys of a product, until they are all inside the time
+        window and there are at most `self.max_trades_per_product` of them.
+        """
+        while seen:
+            oldest_key = next(iter(seen))
+            if (
+                len(seen) <= self.max_trades_per_product
+                and seen[oldest_key] >= latest_ms - self.window_ms
+            ):
+                break
+            del seen[oldest_key]
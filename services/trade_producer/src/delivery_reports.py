@@ -0,0 +1,90 @@
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional
+
+from confluent_kafka import KafkaError, Message
+from loguru import logger
+
+
+class DeliveryReportCounter:
+    """
+    Delivery callback that keeps count of the messages acknowledged by the broker
+    and the ones that failed to be delivered.
+
+    Pass an instance as `on_delivery` to `producer.produce`. librdkafka calls it
+    from `producer.poll` / `producer.flush` once the broker has answered.
+    """
+
+    def __init__(self) -> None:
+        self.n_acked = 0
+        self.n_failed = 0
+
+    def __call__(self, err: Optional[KafkaError], msg: Message) -> None:
+        if err is not None:
+            self.n_failed += 1
+            logger.error(f'Failed to deliver message with key {msg.key()}: {err}')
+        else:
+            self.n_acked += 1
+
+    def __str__(self) -> str:
+        return f'acked={self.n_acked}, failed={self.n_failed}'
+
+
+class BatchDeliveryTracker:
+    """
+    Calls `on_batch_delivered` for each batch of messages once every message of the
+    batch has been acknowledged by the broker, in the order the batches were
+    produced.
+
+    We use it to save the backfill checkpoints only after the trades they cover
+    are safely in Kafka. If any message fails to be delivered, we stop calling
+    `on_batch_delivered` altogether, so a restart resumes before the lost message.
+    """
+
+    def __init__(
+        self,
+        on_batch_delivered: Callable[[Any], None],
+        delivery_reports: DeliveryReportCounter,
+    ) -> None:
+        """
+        Args:
+            on_batch_delivered (Callable[[Any], None]): Called with the `payload` of
+                each batch once all its messages are acknowledged.
+            delivery_reports (DeliveryReportCounter): Also gets every delivery report.
+
+        Returns:
+            None
+        """
+        self.on_batch_delivered = on_batch_delivered
+        self.delivery_reports = delivery_reports
+
+        # [payload, number of messages still waiting for a delivery report]
+        self._batches: Deque[List] = deque()
+        self._failed = False
+
+    def add_batch(self, payload: Any, n_messages: int) -> Callable:
+        """
+        Registers a new batch of `n_messages` messages and returns the delivery
+        callback to pass to `producer.produce` for each of them.
+        """
+        batch = [payload, n_messages]
+        self._batches.append(batch)
+
+        def on_delivery(err: Optional[KafkaError], msg: Message) -> None:
+            self.delivery_reports(err, msg)
+            if err is not None:
+                self._failed = True
+            batch[1] -= 1
+            self._pop_delivered_batches()
+
+        # empty batches are delivered right away
+        self._pop_delivered_batches()
+
+        return on_delivery
+
+    def _pop_delivered_batches(self) -> None:
+        """
+        Calls `on_batch_delivered` for the delivered batches at the head of the queue
+        """
+        while self._batches and self._batches[0][1] == 0 and not self._failed:
+            payload, _ = self._batches.popleft()
+            self.on_batch_delivered(payload)
@@ -0,0 +1,400 @@
+import asyncio
+import json
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+from kraken_api.http_client import KrakenHttpClient
+from kraken_api.pau_rest import KrakenRestAPI, ts_to_date
+from kraken_api.rate_limiter import TokenBucket
+from kraken_api.timestamps import kraken_timestamp_to_ms, kraken_timestamps_to_ms
+from kraken_api.trade import TradeRecord
+from loguru import logger
+from metrics import WEBSOCKET_DECODE_SECONDS
+
+
+class KrakenAsyncWebsocketTradeAPI:
+    """
+    An asyncio based ingestion engine for the Kraken websocket API.
+
+    The `product_ids` are sharded across `n_connections` websocket connections.
+    Each connection runs as its own asyncio task, decodes its frames and puts the
+    resulting trades into a bounded queue. The event loop lives in a background
+    thread, so `get_trades` can be called from the (synchronous) produce loop in
+    `main.produce_trades`, exactly like `KrakenWebsocketTradeAPI.get_trades`.
+
+    Dropped connections are re-established in the background, and the trades we
+    missed while disconnected are backfilled from the Kraken REST API. All the
+    connections backfill through the same rate limiter and pooled HTTP client,
+    which `close` closes.
+    """
+
+    URL = 'wss://ws.kraken.com/v2'
+
+    def __init__(
+        self,
+        product_ids: List[str],
+        n_connections: Optional[int] = 1,
+        queue_size: Optional[int] = 10_000,
+        max_batch_size: Optional[int] = 1_000,
+        reconnect_backoff_sec: Optional[float] = 1,
+        max_reconnect_backoff_sec: Optional[float] = 60,
+        rate_limiter: Optional[TokenBucket] = None,
+        http_client: Optional[KrakenHttpClient] = None,
+    ) -> None:
+        """
+        Starts the event loop and opens the websocket connections.
+
+        Args:
+            product_ids (List[str]): The product IDs for which we want to get the trades.
+            n_connections (Optional[int]): The number of websocket connections across
+                which we shard the `product_ids`.
+            queue_size (Optional[int]): The maximum number of decoded messages waiting
+                to be drained by `get_trades`. When the queue is full the connections
+                stop reading from their sockets until there is room again.
+            max_batch_size (Optional[int]): The maximum number of messages drained
+                from the queue in a single call to `get_trades`.
+            reconnect_backoff_sec (Optional[float]): The initial delay before we try
+                to reconnect a dropped connection. It doubles after each failed attempt.
+            max_reconnect_backoff_sec (Optional[float]): The maximum delay between two
+                reconnection attempts.
+            rate_limiter (Optional[TokenBucket]): The rate limiter of the REST
+                requests that backfill the gaps. Share it with any other client of
+                the Kraken REST API.
+            http_client (Optional[KrakenHttpClient]): The pooled HTTP client of the
+                REST requests that backfill the gaps.
+
+        Returns:
+            None
+        """
+        self.product_ids = product_ids
+
+        # round-robin sharding, so each connection gets a similar number of products
+        n_connections = max(1, min(n_connections, len(product_ids)))
+        self.shards = [product_ids[i::n_connections] for i in range(n_connections)]
+
+        self.queue_size = queue_size
+        self.max_batch_size = max_batch_size
+        self.reconnect_backoff_sec = reconnect_backoff_sec
+        self.max_reconnect_backoff_sec = max_reconnect_backoff_sec
+
+        # the connections that reconnect at the same time backfill concurrently,
+        # so they share the REST rate limit and connections
+        self.rate_limiter = rate_limiter or TokenBucket(rate=1, capacity=1)
+        self.http_client = http_client or KrakenHttpClient(pool_size=n_connections)
+
+        # the event loop runs in a daemon thread, so it dies with the main thread
+        self._loop = asyncio.new_event_loop()
+        self._queue: Optional[asyncio.Queue] = None
+        # when we received the oldest message of the trades returned by the last
+        # call to `get_trades`, in Unix milliseconds
+        self.last_received_ms: Optional[int] = None
+        self._consumers: Optional[asyncio.Future] = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_event_loop, name='kraken-websocket', daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+        logger.info(
+            f'Started {len(self.shards)} websocket connections for {product_ids}'
+        )
+
+    def _run_event_loop(self) -> None:
+        """
+        Runs the event loop with one consumer task per shard, until all of them stop.
+        """
+        asyncio.set_event_loop(self._loop)
+
+        # the queue has to be created inside the loop that uses it
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._consumers = asyncio.gather(
+            *[self._consume(shard) for shard in self.shards]
+        )
+        self._ready.set()
+
+        try:
+            self._loop.run_until_complete(self._consumers)
+        except asyncio.CancelledError:
+            # stopped by `close`
+            pass
+
+    async def _consume(self, product_ids: List[str]) -> None:
+        """
+        Supervises one websocket connection for the given `product_ids`.
+
+        Every decoded batch of trades is pushed into the queue. When the connection
+        drops, we reconnect with exponential backoff, re-subscribe and backfill the
+        `[last_seen_ts, reconnect_ts]` gap of each product from the REST API. The
+        live trades we read in the meantime are pushed right after the backfill.
+        """
+        # timestamp of the last trade we pushed into the queue, for each product
+        # It is empty until the first subscription succeeds, because before that
+        # there is no gap to backfill.
+        last_seen_ms: Dict[str, int] = {}
+        backoff_sec = self.reconnect_backoff_sec
+
+        while True:
+            try:
+                async with websockets.connect(self.URL) as ws:
+                    reconnect_ms = now_ms()
+                    await self._subscribe(ws, product_ids)
+
+                    if last_seen_ms:
+                        await self._backfill_while_reading(
+                            ws, last_seen_ms, reconnect_ms
+                        )
+                    else:
+                        last_seen_ms = {
+                            product_id: reconnect_ms for product_id in product_ids
+                        }
+
+                    # we got a working connection, so the next failure starts
+                    # the backoff from scratch
+                    backoff_sec = self.reconnect_backoff_sec
+
+                    async for message in ws:
+                        received_ms = now_ms()
+                        with WEBSOCKET_DECODE_SECONDS.time():
+                            trades = self._parse_message(message)
+                        if trades:
+                            # blocks this connection (and only this one) when the
+                            # queue is full, which applies backpressure to the socket
+                            await self._push(trades, received_ms, last_seen_ms)
+
+                logger.warning(f'Websocket connection for {product_ids} closed')
+            except Exception as e:
+                logger.error(f'Websocket connection for {product_ids} failed: {e}')
+
+            logger.info(f'Reconnecting in {backoff_sec} seconds for {product_ids}')
+            await asyncio.sleep(backoff_sec)
+            backoff_sec = min(2 * backoff_sec, self.max_reconnect_backoff_sec)
+
+    async def _backfill_while_reading(
+        self, ws, last_seen_ms: Dict[str, int], reconnect_ms: int
+    ) -> None:
+        """
+        Backfills the gap of each product, while a separate task keeps reading the
+        live trades from `ws` into a buffer, and then pushes the buffered trades.
+
+        The connection has to be read while we backfill, otherwise it stops
+        processing the pongs of the server and the keepalive times out.
+
+        Args:
+            ws: The websocket connection, already subscribed to the trades.
+            last_seen_ms (Dict[str, int]): The timestamp of the last trade we saw
+                for each product before the connection dropped.
+            reconnect_ms (int): The timestamp when the connection was re-established.
+
+        Returns:
+            None
+        """
+        buffer: List[Tuple[int, List[TradeRecord]]] = []
+        reader = asyncio.create_task(self._read_into(ws, buffer))
+        try:
+            await self._backfill(last_seen_ms, reconnect_ms)
+        finally:
+            reader.cancel()
+            await asyncio.wait([reader])
+
+        # the live trades come after the gap, so we resume streaming exactly
+        # where we left
+        for received_ms, trades in buffer:
+            await self._push(trades, received_ms, last_seen_ms)
+
+        if not reader.cancelled() and reader.exception() is not None:
+            raise reader.exception()
+
+    async def _read_into(self, ws, buffer: List[Tuple[int, List[TradeRecord]]]) -> None:
+        """
+        Reads and decodes the messages of `ws` into `buffer`, with the time we
+        received them, until the connection closes or the task is cancelled.
+        """
+        async for message in ws:
+            received_ms = now_ms()
+            with WEBSOCKET_DECODE_SECONDS.time():
+                trades = self._parse_message(message)
+            if trades:
+                buffer.append((received_ms, trades))
+
+    async def _push(
+        self, trades: List[TradeRecord], received_ms: int, last_seen_ms: Dict[str, int]
+    ) -> None:
+        """
+        Pushes a batch of `trades`, received at `received_ms`, into the queue and
+        records the timestamp of the last trade of each product in `last_seen_ms`.
+        """
+        for trade in trades:
+            last_seen_ms[trade.product_id] = trade.timestamp_ms
+        await self._queue.put((received_ms, trades))
+
+    async def _backfill(self, last_seen_ms: Dict[str, int], reconnect_ms: int) -> None:
+        """
+        Fetches from the Kraken REST API the trades of each product in the
+        `[last_seen_ms[product_id], reconnect_ms]` gap and pushes them into the queue.
+
+        Args:
+            last_seen_ms (Dict[str, int]): The timestamp of the last trade we saw
+                for each product before the connection dropped.
+            reconnect_ms (int): The timestamp when the connection was re-established.
+
+        Returns:
+            None
+        """
+        for product_id, from_ms in last_seen_ms.items():
+            try:
+                # the REST client is synchronous, so we run it in a worker thread
+                # to keep the other connections streaming in the meantime
+                trades = await self._loop.run_in_executor(
+                    None, self._fetch_gap, product_id, from_ms, reconnect_ms
+                )
+            except Exception as e:
+                logger.error(f'Failed to backfill the gap for {product_id}: {e}')
+                continue
+
+            logger.info(
+                f'Backfilled {len(trades)} trades for {product_id} between '
+                f'{ts_to_date(from_ms)} and {ts_to_date(reconnect_ms)}'
+            )
+            if trades:
+                await self._push(trades, now_ms(), last_seen_ms)
+
+    def _fetch_gap(
+        self, product_id: str, from_ms: int, to_ms: int
+    ) -> List[TradeRecord]:
+        """
+        Pages through the Kraken REST API to get all the trades of `product_id`
+        between `from_ms` and `to_ms`.
+        """
+        kraken_api = KrakenRestAPI(
+            product_id=product_id,
+            from_ms=from_ms,
+            to_ms=to_ms,
+            rate_limiter=self.rate_limiter,
+            http_client=self.http_client,
+        )
+
+        trades = []
+        while not kraken_api.done():
+            trades += kraken_api.get_trades()
+
+        return trades
+
+    async def _subscribe(self, ws, product_ids: List[str]) -> None:
+        """
+        Subscribe to the trade channel of the given `product_ids` on the connection `ws`
+        """
+        logger.info(f'subscribing to trade channel for {product_ids}')
+        msg = {
+            'method': 'subscribe',
+            'params': {'channel': 'trade', 'symbol': product_ids, 'snapshot': False},
+        }
+        await ws.send(json.dumps(msg))
+
+    def _parse_message(self, message: str) -> List[TradeRecord]:
+        """
+        Transforms a raw websocket message into a list of trades.
+
+        Heartbeats, subscription confirmations and any other message that does not
+        belong to the trade channel are ignored, so we don't need to know in advance
+        how many of them we get after subscribing.
+
+        Args:
+            message (str): The raw message received from the websocket.
+
+        Returns:
+            List[TradeRecord]: The trades contained in the message, if any.
+        """
+        if 'heartbeat' in message:
+            return []
+
+        message = json.loads(message)
+
+        if message.get('channel') != 'trade' or 'data' not in message:
+            return []
+
+        data = message['data']
+
+        # convert the timestamps of all the trades in the message at once
+        timestamps_ms = kraken_timestamps_to_ms([trade['timestamp'] for trade in data])
+
+        return [
+            TradeRecord(
+                trade['symbol'],
+                float(trade['price']),
+                float(trade['qty']),
+                timestamp_ms,
+                trade.get('trade_id'),
+                trade.get('side'),
+            )
+            for trade, timestamp_ms in zip(data, timestamps_ms)
+        ]
+
+    async def _next_batch(self) -> List[TradeRecord]:
+        """
+        Waits for the next decoded message in the queue and then drains whatever
+        else is already available, up to `self.max_batch_size` messages.
+        """
+        batches = [await self._queue.get()]
+        while len(batches) < self.max_batch_size and not self._queue.empty():
+            batches.append(self._queue.get_nowait())
+
+        # the live trades buffered during a backfill are pushed after it, so the
+        # first message is not always the oldest one
+        self.last_received_ms = min(received_ms for received_ms, _ in batches)
+        return [trade for _, batch in batches for trade in batch]
+
+    def get_trades(self) -> List[TradeRecord]:
+        """
+        Returns the trades received on any of the websocket connections since the
+        last call. Blocks until at least one message with trades is available.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._next_batch(), self._loop)
+        return future.result()
+
+    async def get_trades_async(self) -> List[TradeRecord]:
+        """
+        Same as `get_trades`, but awaitable from any other event loop, without
+        blocking it while we wait for the next message.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._next_batch(), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def done(self) -> bool:
+        """The websocket never stops, so we never stop fetching trades."""
+        return False
+
+    def close(self) -> None:
+        """
+        Closes the websocket connections, stops the event loop and closes the HTTP
+        client of the backfills
+        """
+        self._loop.call_soon_threadsafe(self._consumers.cancel)
+        self._thread.join()
+        self._loop.close()
+        self.http_client.close()
+        logger.info(f'Closed the websocket connections for {self.product_ids}')
+
+    @staticmethod
+    def to_ms(timestamp: str) -> int:
+        """
+        A function that transforms a timestamps expressed
+        as a string like this '2024-06-17T09:36:39.467866Z'
+        into a timestamp expressed in milliseconds.
+
+        Args:
+            timestamp (str): A timestamp expressed as a string.
+
+        Returns:
+            int: A timestamp expressed in milliseconds.
+        """
+        return kraken_timestamp_to_ms(timestamp)
+
+
+def now_ms() -> int:
+    """
+    Returns the current UTC time in Unix milliseconds
+    """
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
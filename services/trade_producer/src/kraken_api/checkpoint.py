@@ -0,0 +1,61 @@
+import sqlite3
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+
+class Checkpoint(NamedTuple):
+    """
+    How far we got backfilling one product: every trade of the time range that
+    starts at `from_ms` and is older than `last_trade_ms` has been acknowledged
+    by Kafka.
+    """
+
+    from_ms: int
+    last_trade_ms: int
+
+
+class CheckpointStore:
+    """
+    A durable, per-product store of backfill checkpoints, backed by a local SQLite
+    database.
+
+    `KrakenRestAPIMultipleProducts` reads it at startup to resume each product
+    where it stopped, and updates it every time a page of trades has been
+    acknowledged by Kafka.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(db_path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                product_id TEXT PRIMARY KEY,
+                from_ms INTEGER NOT NULL,
+                last_trade_ms INTEGER NOT NULL
+            )
+            """
+        )
+        self._db.commit()
+
+    def load(self, product_id: str) -> Optional[Checkpoint]:
+        """
+        Returns the last checkpoint saved for `product_id`, if any
+        """
+        row = self._db.execute(
+            'SELECT from_ms, last_trade_ms FROM checkpoints WHERE product_id = ?',
+            (product_id,),
+        ).fetchone()
+
+        return Checkpoint(*row) if row is not None else None
+
+    def save(self, product_id: str, checkpoint: Checkpoint) -> None:
+        """
+        Saves the checkpoint of `product_id`, replacing the previous one
+        """
+        self._db.execute(
+            'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+            (product_id, checkpoint.from_ms, checkpoint.last_trade_ms),
+        )
+        self._db.commit()
@@ -0,0 +1,105 @@
+from typing import Optional
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+
+class HttpClientError(Exception):
+    """
+    Raised when a request fails before we get a response, e.g. on a network error.
+    """
+
+
+class KrakenHttpClient:
+    """
+    A pooled HTTP client for the Kraken REST API.
+
+    Connections are kept alive and reused across requests, so paging through
+    thousands of pages only pays the TCP and TLS handshakes once per pooled
+    connection. Responses are requested gzip-compressed and decoded transparently.
+
+    With `http2=True` the client uses httpx, which multiplexes the requests of all
+    the threads over HTTP/2 connections. httpx is an optional dependency
+    (`poetry install --extras http2`), so we fall back to HTTP/1.1 keep-alive
+    with requests if it is not installed.
+
+    Create one instance and share it between all the REST API objects, like we do
+    with the rate limiter.
+    """
+
+    HEADERS = {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    }
+
+    def __init__(
+        self,
+        pool_size: Optional[int] = 10,
+        timeout_sec: Optional[float] = 30,
+        http2: Optional[bool] = False,
+    ) -> None:
+        """
+        Args:
+            pool_size (Optional[int]): The maximum number of connections kept open.
+                Set it to at least the number of threads making requests.
+            timeout_sec (Optional[float]): The timeout of each request.
+            http2 (Optional[bool]): Whether to use HTTP/2 if httpx is installed.
+
+        Returns:
+            None
+        """
+        self.timeout_sec = timeout_sec
+        self.http2 = False
+
+        if http2:
+            try:
+                import httpx
+
+                self._client = httpx.Client(
+                    http2=True,
+                    headers=self.HEADERS,
+                    timeout=timeout_sec,
+                    limits=httpx.Limits(
+                        max_connections=pool_size,
+                        max_keepalive_connections=pool_size,
+                    ),
+                )
+                self._errors = (httpx.HTTPError,)
+                self.http2 = True
+            except ImportError:
+                logger.warning('httpx is not installed. Falling back to HTTP/1.1')
+
+        if not self.http2:
+            self._client = requests.Session()
+            self._client.headers.update(self.HEADERS)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self._client.mount('https://', adapter)
+            self._client.mount('http://', adapter)
+            self._errors = (requests.RequestException,)
+
+    def get(self, url: str):
+        """
+        Makes a GET request to the given `url` over one of the pooled connections.
+
+        Args:
+            url (str): The URL to request.
+
+        Returns:
+            The response, with the decoded body in `text` and the HTTP status in
+            `status_code`.
+
+        Raises:
+            HttpClientError: If the request failed before we got a response.
+        """
+        try:
+            return self._client.get(url, timeout=self.timeout_sec)
+        except self._errors as e:
+            raise HttpClientError(str(e)) from e
+
+    def close(self) -> None:
+        """
+        Closes all the pooled connections
+        """
+        self._client.close()
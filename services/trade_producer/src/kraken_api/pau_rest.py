@@ -1,12 +1,34 @@
 import json
-from pathlib import Path
-from time import sleep
+from queue import Empty, Queue
+from time import sleep, time
 from typing import Dict, List, Optional, Tuple
 
-import requests
+from kraken_api.checkpoint import Checkpoint, CheckpointStore
+from kraken_api.http_client import HttpClientError, KrakenHttpClient
+from kraken_api.rate_limiter import RetryPolicy, TokenBucket
+from kraken_api.trade import TradeRecord
+from kraken_api.trade_cache import CachedTradeData
 from loguru import logger
+from metrics import REST_REQUEST_SECONDS
 
-from kraken_api.trade import Trade
+# the sides of the trades in the REST API responses
+SIDES = {'b': 'buy', 's': 'sell'}
+
+# errors returned by Kraken when we exceed the rate limit
+RATE_LIMIT_ERRORS = ('EGeneral:Too many requests', 'EAPI:Rate limit exceeded')
+
+# errors that go away by themselves, so it makes sense to retry the request
+RETRYABLE_ERRORS = RATE_LIMIT_ERRORS + (
+    'EService:Unavailable',
+    'EService:Busy',
+    'EGeneral:Internal error',
+)
+
+
+class KrakenRestAPIError(Exception):
+    """
+    Raised when a request to the Kraken REST API fails and retrying does not help.
+    """
 
 
 class KrakenRestAPIMultipleProducts:
@@ -16,19 +38,80 @@ class KrakenRestAPIMultipleProducts:
         last_n_days: int,
         n_threads: Optional[int] = 1,
         cache_dir: Optional[str] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        queue_size: Optional[int] = 100,
+        http_client: Optional[KrakenHttpClient] = None,
+        checkpoint_store: Optional[CheckpointStore] = None,
     ) -> None:
+        """
+        Fetches historical trades for several products.
+
+        With `n_threads > 1`, each product is paged independently by a worker of a
+        persistent thread pool, and the pages are streamed into a shared queue that
+        `get_trades` drains. A slow product does not hold back the others, and all
+        the workers share the same `rate_limiter`.
+
+        Args:
+            product_ids (List[str]): The product IDs for which we want to get the trades.
+            last_n_days (int): The number of days from which we want to get historical data.
+            n_threads (Optional[int]): The number of products fetched in parallel.
+            cache_dir (Optional[str]): The directory where we will store the historical data to
+            rate_limiter (Optional[TokenBucket]): The rate limiter shared by all products.
+            queue_size (Optional[int]): The maximum number of pages waiting to be
+                drained by `get_trades`, before the workers stop fetching.
+            http_client (Optional[KrakenHttpClient]): The pooled HTTP client shared
+                by all products.
+            checkpoint_store (Optional[CheckpointStore]): Where we read the checkpoints
+                to resume from at startup, and save them with `save_checkpoints`.
+
+        Returns:
+            None
+        """
         self.product_ids = product_ids
 
+        self.rate_limiter = rate_limiter or TokenBucket(rate=1, capacity=1)
+        self.http_client = http_client or KrakenHttpClient(pool_size=n_threads)
+
         self.kraken_apis = [
             KrakenRestAPI(
-                product_id=product_id, last_n_days=last_n_days, cache_dir=cache_dir
+                product_id=product_id,
+                last_n_days=last_n_days,
+                cache_dir=cache_dir,
+                rate_limiter=self.rate_limiter,
+                http_client=self.http_client,
             )
             for product_id in product_ids
         ]
 
+        # resume each product from its last checkpoint, if we have one
+        self.checkpoint_store = checkpoint_store
+        if self.checkpoint_store is not None:
+            for kraken_api in self.kraken_apis:
+                self._resume_from_checkpoint(kraken_api)
+
+        # the cursor of each product after the pages returned by the last call to
+        # `get_trades`, i.e. the checkpoint to save once those trades are in Kafka
+        self.last_cursors: Dict[str, int] = {}
+        # when we got the oldest page returned by the last call to `get_trades`, in
+        # Unix milliseconds
+        self.last_received_ms: Optional[int] = None
+
         self.n_threads = n_threads
 
-    def get_trades(self) -> List[Dict]:
+        if self.n_threads > 1:
+            # this is the parallel version
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._pages: Queue = Queue(maxsize=queue_size)
+            self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+            self._futures = [
+                self._executor.submit(
+                    self._fetch_all_trades_for_one_product, kraken_api
+                )
+                for kraken_api in self.kraken_apis
+            ]
+
+    def get_trades(self) -> List[TradeRecord]:
         """
         Gets trade data from each kraken_api in self.kraken_apis and retuns a list
         with all trades from all kraken_apis.
@@ -37,12 +120,14 @@ class KrakenRestAPIMultipleProducts:
             None
 
         Returns:
-            List[Dict]: A list of dictionaries, where each dictionary contains the trade
-            data, for all product_ids in self.product_ids
+            List[TradeRecord]: A list of trades, for all product_ids in self.product_ids
         """
+        self.last_cursors = {}
+        self.last_received_ms = None
+
         if self.n_threads == 1:
             # this is the sequential version
-            trades: List[Dict] = []
+            trades: List[TradeRecord] = []
 
             for kraken_api in self.kraken_apis:
                 if kraken_api.done():
@@ -50,39 +135,127 @@ class KrakenRestAPIMultipleProducts:
                     continue
                 else:
                     trades += kraken_api.get_trades()
+                    self.last_cursors[kraken_api.product_id] = kraken_api.last_trade_ms
+                    if self.last_received_ms is None:
+                        self.last_received_ms = int(time() * 1000)
         else:
             # this is the parallel version
-            from concurrent.futures import ThreadPoolExecutor
-
-            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
-                trades = list(
-                    executor.map(self.get_trades_for_one_product, self.kraken_apis)
-                )
-                # trades is a list of lists, so we need to flatten it
-                trades = [trade for sublist in trades for trade in sublist]
+            self._raise_worker_errors()
+
+            # wait for the next page, but not forever, because the last workers
+            # might finish without producing any more pages
+            try:
+                pages = [self._pages.get(timeout=1)]
+            except Empty:
+                return []
+
+            # and take whatever else is already available
+            while not self._pages.empty():
+                pages.append(self._pages.get_nowait())
+
+            trades = []
+            for product_id, cursor, _, page in pages:
+                trades += page
+                # pages of the same product come in order, so the last one wins
+                self.last_cursors[product_id] = cursor
+            self.last_received_ms = min(received_ms for _, _, received_ms, _ in pages)
 
         return trades
 
-    def get_trades_for_one_product(self, kraken_api: 'KrakenRestAPI') -> List[Trade]:
+    def _fetch_all_trades_for_one_product(self, kraken_api: 'KrakenRestAPI') -> None:
         """
-        Returns next batch of trades for a given kraken_api.
+        Pages through all the historical trades of the given kraken_api and puts
+        each page into the shared queue.
 
         Args:
             kraken_api (KrakenRestAPI): An instance of KrakenRestAPI from which we want to
             fetch trades.
 
         Returns:
-            List[Trade]: A list of trades for the given kraken_api
+            None
+        """
+        while not kraken_api.done():
+            trades = kraken_api.get_trades()
+            received_ms = int(time() * 1000)
+            # blocks when the queue is full, until the producer catches up
+            # Empty pages go through as well, because they move the cursor.
+            self._pages.put(
+                (kraken_api.product_id, kraken_api.last_trade_ms, received_ms, trades)
+            )
+
+    def _raise_worker_errors(self) -> None:
+        """
+        Re-raises here, in the main thread, the exception of the first worker that
+        crashed, so the backfill stops instead of missing the trades of its product
+        """
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _resume_from_checkpoint(self, kraken_api: 'KrakenRestAPI') -> None:
+        """
+        Moves the cursor of `kraken_api` to its saved checkpoint, if the checkpoint
+        belongs to a backfill that covers the time range of `kraken_api`.
+        """
+        checkpoint = self.checkpoint_store.load(kraken_api.product_id)
+        if checkpoint is None:
+            return
+
+        if checkpoint.from_ms <= kraken_api.from_ms < checkpoint.last_trade_ms:
+            kraken_api.last_trade_ms = checkpoint.last_trade_ms
+            logger.info(
+                f'Resuming {kraken_api.product_id} from {ts_to_date(checkpoint.last_trade_ms)}'
+            )
+
+    def save_checkpoints(self, cursors: Dict[str, int]) -> None:
+        """
+        Saves the given cursors as the new checkpoints. Call it once all the trades
+        returned by the `get_trades` call that produced `cursors` (see
+        `self.last_cursors`) have been acknowledged by Kafka.
+
+        Args:
+            cursors (Dict[str, int]): The cursor of each product.
+
+        Returns:
+            None
         """
-        if not kraken_api.done():
-            return kraken_api.get_trades()
-        return []
+        if self.checkpoint_store is None:
+            return
+
+        from_ms = {
+            kraken_api.product_id: kraken_api.from_ms for kraken_api in self.kraken_apis
+        }
+        for product_id, cursor in cursors.items():
+            self.checkpoint_store.save(
+                product_id,
+                Checkpoint(from_ms=from_ms[product_id], last_trade_ms=cursor),
+            )
+
+    def stats(self) -> str:
+        """
+        Returns a summary of the time we spent throttled and the requests we retried
+        """
+        n_retries = sum(kraken_api.n_retries for kraken_api in self.kraken_apis)
+        return (
+            f'throttled for {self.rate_limiter.throttled_sec:.1f} seconds, '
+            f'{n_retries} retried requests'
+        )
 
     def done(self) -> bool:
         """
         Returns True if all kraken_apis in self.kraken_apis are done fetching historical.
         It returns False otherwise.
         """
+        if self.n_threads > 1:
+            # the workers put their last page into the queue before finishing, so
+            # we are done when all of them finished and the queue is drained
+            finished = all(future.done() for future in self._futures)
+            if finished:
+                self._executor.shutdown()
+                # a worker that crashed also finished, but without its trades
+                self._raise_worker_errors()
+            return finished and self._pages.empty()
+
         for kraken_api in self.kraken_apis:
             if not kraken_api.done():
                 return False
@@ -96,22 +269,42 @@ class KrakenRestAPI:
     def __init__(
         self,
         product_id: str,
-        last_n_days: int,
+        last_n_days: Optional[int] = None,
         cache_dir: Optional[str] = None,
+        from_ms: Optional[int] = None,
+        to_ms: Optional[int] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        http_client: Optional[KrakenHttpClient] = None,
     ) -> None:
         """
         Basic initialization of the Kraken Rest API.
 
+        The time range is either the `last_n_days` until today at midnight, or the
+        explicit `[from_ms, to_ms]` range, which is what we use to backfill the gaps
+        left by websocket reconnections.
+
         Args:
             product_id (str): One product ID for which we want to get the trades.
-            last_n_days (int): The number of days from which we want to get historical data.
+            last_n_days (Optional[int]): The number of days from which we want to get historical data.
             cache_dir (Optional[str]): The directory where we will store the historical data to
+            from_ms (Optional[int]): The start of the time range, in Unix milliseconds.
+            to_ms (Optional[int]): The end of the time range, in Unix milliseconds.
+            rate_limiter (Optional[TokenBucket]): The rate limiter we acquire a token
+                from before each request. Pass the same instance to all the
+                KrakenRestAPI objects that run concurrently.
+            retry_policy (Optional[RetryPolicy]): How we retry failed requests.
+            http_client (Optional[KrakenHttpClient]): The pooled HTTP client used
+                for the requests. Share it between the KrakenRestAPI objects.
 
         Returns:
             None
         """
         self.product_id = product_id
-        self.from_ms, self.to_ms = self._init_from_to_ms(last_n_days)
+        if from_ms is not None and to_ms is not None:
+            self.from_ms, self.to_ms = from_ms, to_ms
+        else:
+            self.from_ms, self.to_ms = self._init_from_to_ms(last_n_days)
 
         logger.debug(
             f'Initializing KrakenRestAPI: from_ms={ts_to_date(self.from_ms)}, to_ms={ts_to_date(self.to_ms)}'
@@ -133,6 +326,13 @@ class KrakenRestAPI:
             self.cache = CachedTradeData(cache_dir)
             self.use_cache = True
 
+        # by default, at most 1 request per second, like Kraken's public endpoints
+        self.rate_limiter = rate_limiter or TokenBucket(rate=1, capacity=1)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.http_client = http_client or KrakenHttpClient()
+        # number of requests we had to retry
+        self.n_retries = 0
+
     @staticmethod
     def _init_from_to_ms(last_n_days: int) -> Tuple[int, int]:
         """
@@ -160,7 +360,7 @@ class KrakenRestAPI:
 
         return from_ms, to_ms
 
-    def get_trades(self) -> List[Trade]:
+    def get_trades(self) -> List[TradeRecord]:
         """
         Fetches a batch of trades from the Kraken Rest API and returns them as a list
         of dictionaries.
@@ -169,49 +369,24 @@ class KrakenRestAPI:
             None
 
         Returns:
-            List[Trade]: A list of dictionaries, where each dictionary contains the trade data.
+            List[TradeRecord]: A list of dictionaries, where each dictionary contains the trade data.
         """
         # Replace the placeholders in the URL with the actual values for
         # - product_id
         # - since_ns
         since_ns = self.last_trade_ms * 1_000_000
-        payload = {}
-        headers = {'Accept': 'application/json'}
         url = self.URL.format(product_id=self.product_id, since_sec=since_ns)
         logger.debug(f'{url=}')
 
-        if self.use_cache and self.cache.has(url):
+        if self.use_cache and self.cache.has(self.product_id, since_ns):
             # read the data from the cache
-            trades = self.cache.read(url)
+            trades = self.cache.read(self.product_id, since_ns)
             logger.debug(
                 f'Loaded {len(trades)} trades for {self.product_id}, since={ns_to_date(since_ns)} from the cache'
             )
         else:
-            # make the request to the Kraken REST API
-            response = requests.request('GET', url, headers=headers, data=payload)
-
-            # parse string into dictionary
-            data = json.loads(response.text)
-
-            # TODO: Error handling
-            # It can happen that we get an error response from KrakenRESTAP like the following:
-            # data = {'error': ['EGeneral:Too many requests']}
-            # To solve this have several options
-            #
-            # Option 1. Check if the `error` key is present in the `data` and has
-            # a non-empty list value. If so, we could raise an exception, or even better, implment
-            # a retry mechanism, using a library like `retry` https://github.com/invl/retry
-            #
-            # Option 2. Simply slow down the rate at which we are making requests to the Kraken API,
-            # and cross your fingers.
-            #
-            # Option 3. Implement both Option 1 and Option 2, so you don't need to cross your fingers.
-            #
-            # Here is an example of how you could implement Option 2
-            if ('error' in data) and ('EGeneral:Too many requests' in data['error']):
-                # slow down the rate at which we are making requests to the Kraken API
-                logger.info('Too many requests. Sleeping for 30 seconds')
-                sleep(30)
+            # make the request to the Kraken REST API, retrying on errors
+            data = self._request(url)
 
             # Python trick
             # Instead of initializing an empty list and appending to it, like this
@@ -226,11 +401,15 @@ class KrakenRestAPI:
             #
             # You can use a list comprehension to do the same thing
             trades = [
-                Trade(
-                    price=float(trade[0]),
-                    volume=float(trade[1]),
-                    timestamp_ms=int(trade[2] * 1000),
-                    product_id=self.product_id,
+                TradeRecord(
+                    self.product_id,
+                    float(trade[0]),
+                    float(trade[1]),
+                    int(trade[2] * 1000),
+                    # the trade_id is the 7th element, when Kraken sends it
+                    int(trade[6]) if len(trade) > 6 else None,
+                    # 'b' or 's', the side of the taker
+                    SIDES.get(trade[3]),
                 )
                 for trade in data['result'][self.product_id]
             ]
@@ -241,15 +420,16 @@ class KrakenRestAPI:
 
             if self.use_cache:
                 # write the data to the cache
-                self.cache.write(url, trades)
+                self.cache.write(self.product_id, since_ns, trades)
                 logger.debug(
                     f'Wrote to cache for {self.product_id}, since={ns_to_date(since_ns)}'
                 )
 
-            # slow down the rate at which we are making requests to the Kraken API
-            sleep(1)
-
-        if trades[-1].timestamp_ms == self.last_trade_ms:
+        if not trades:
+            # there are no trades after self.last_trade_ms yet, so there is nothing
+            # left to fetch in our time range
+            self.last_trade_ms = self.to_ms
+        elif trades[-1].timestamp_ms == self.last_trade_ms:
             # if the last trade timestamp in the batch is the same as self.last_trade_ms,
             # then we need to increment it by 1 to avoid repeating the exact same API request,
             # which would result in an infinite loop
@@ -258,7 +438,12 @@ class KrakenRestAPI:
             # otherwise, update self.last_trade_ms to the timestamp of the last trade
             # in the batch
             self.last_trade_ms = trades[-1].timestamp_ms
-        
+
+        if self.use_cache and self.done():
+            # we won't write any more pages of this product, so we compact the
+            # pages of its last day into a single file
+            self.cache.compact(self.product_id)
+
         # filter out trades that are after the end timestamp
         trades = [trade for trade in trades if trade.timestamp_ms <= self.to_ms]
 
@@ -268,72 +453,75 @@ class KrakenRestAPI:
 
         return trades
 
-    def done(self) -> bool:
-        # return self._done
-        return self.last_trade_ms >= self.to_ms
-
-
-class CachedTradeData:
-    """
-    A class to handle the caching of trade data fetched from the Kraken REST API.
-    """
-
-    def __init__(self, cache_dir: str) -> None:
-        self.cache_dir = Path(cache_dir)
-
-        if not self.cache_dir.exists():
-            # create the cache directory if it does not exist
-            self.cache_dir.mkdir(parents=True)
-
-    def read(self, url: str) -> List[Trade]:
+    def _request(self, url: str) -> dict:
         """
-        Reads from the cache the trade data for the given url
-        """
-        file_path = self._get_file_path(url)
-
-        if file_path.exists():
-            # read the data from the parquet file
-            import pandas as pd
-
-            data = pd.read_parquet(file_path)
-            # transform the data to a list of Trade objects
-            return [Trade(**trade) for trade in data.to_dict(orient='records')]
-
-        return []
-
-    def write(self, url: str, trades: List[Trade]) -> None:
-        """
-        Saves the given trades to a parquet file in the cache directory.
-        """
-        if not trades:
-            return
+        Makes a GET request to the given Kraken REST API `url` and returns the parsed
+        response.
 
-        # transform the trades to a pandas DataFrame
-        import pandas as pd
+        Transient failures are retried following `self.retry_policy`:
+        - network errors, HTTP 5xx responses and bodies that are not valid JSON,
+          e.g. an HTML error page from a proxy
+        - HTTP 429 responses and error payloads like
+          {'error': ['EGeneral:Too many requests']}, in which case we also tell the
+          rate limiter to slow down.
 
-        data = pd.DataFrame([trade.model_dump() for trade in trades])
+        Args:
+            url (str): The URL to request.
 
-        # write the DataFrame to a parquet file
-        file_path = self._get_file_path(url)
-        data.to_parquet(file_path)
+        Returns:
+            dict: The parsed response.
 
-    def has(self, url: str) -> bool:
-        """
-        Returns True if the cache has the trade data for the given url, False otherwise.
+        Raises:
+            KrakenRestAPIError: If the request still fails after all the retries, or
+                if Kraken returns an error we can't recover from by retrying.
         """
-        file_path = self._get_file_path(url)
-        return file_path.exists()
+        for attempt in range(self.retry_policy.max_retries + 1):
+            # wait until we are allowed to make the next request
+            self.rate_limiter.acquire()
+
+            try:
+                with REST_REQUEST_SECONDS.time():
+                    response = self.http_client.get(url)
+            except HttpClientError as e:
+                error = f'Request failed: {e}'
+            else:
+                if response.status_code == 429:
+                    error = 'HTTP 429'
+                    self.rate_limiter.on_rate_limited()
+                elif response.status_code >= 500:
+                    error = f'HTTP {response.status_code}'
+                else:
+                    try:
+                        # parse string into dictionary
+                        data = json.loads(response.text)
+                    except ValueError as e:
+                        # a json.JSONDecodeError, e.g. for an HTML error page
+                        error = f'Invalid JSON response: {e}'
+                    else:
+                        if not data.get('error'):
+                            self.rate_limiter.on_success()
+                            return data
+
+                        error = ', '.join(data['error'])
+                        if any(err in error for err in RATE_LIMIT_ERRORS):
+                            self.rate_limiter.on_rate_limited()
+                        elif not any(err in error for err in RETRYABLE_ERRORS):
+                            raise KrakenRestAPIError(f'{url} failed: {error}')
+
+            self.n_retries += 1
+            delay_sec = self.retry_policy.delay_sec(attempt)
+            logger.warning(
+                f'{error} for {self.product_id}. Retrying in {delay_sec:.1f} seconds'
+            )
+            sleep(delay_sec)
 
-    def _get_file_path(self, url: str) -> str:
-        """
-        Returns the file path where the trade data for the given url is (or will be) stored.
-        """
-        # use the given url to generate a unique file name in a deterministic way
-        import hashlib
+        raise KrakenRestAPIError(
+            f'{url} failed after {self.retry_policy.max_retries} retries: {error}'
+        )
 
-        url_hash = hashlib.md5(url.encode()).hexdigest()
-        return self.cache_dir / f'{url_hash}.parquet'
-        # return self.cache_dir / f'{product_id.replace ("/","-")}_{from_ms}.parquet'
+    def done(self) -> bool:
+        # return self._done
+        return self.last_trade_ms >= self.to_ms
 
 
 def ts_to_date(ts: int) -> str:
@@ -367,4 +555,4 @@ def ns_to_date(ns: int) -> str:
 
     return datetime.fromtimestamp(ns / 1_000_000_000, tz=timezone.utc).strftime(
         '%Y-%m-%d %H:%M:%S'
-    )
\ No newline at end of file
+    )
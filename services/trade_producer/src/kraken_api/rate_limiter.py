@@ -0,0 +1,136 @@
+import random
+import threading
+from time import monotonic, sleep
+
+from metrics import REST_THROTTLED_SECONDS
+
+
+class TokenBucket:
+    """
+    A thread-safe, adaptive token bucket rate limiter.
+
+    Kraken keeps a call counter per client that goes up with every request and
+    decays at a constant rate, and it rejects requests with
+    'EGeneral:Too many requests' when the counter reaches its maximum. The bucket
+    mirrors that counter: it holds up to `capacity` tokens (the room left before
+    the maximum) and is refilled at `rate` tokens per second (the decay).
+
+    Each request takes one token, and waits until one is available if the bucket
+    is empty. When Kraken still rate-limits us, `on_rate_limited` halves the refill
+    rate and empties the bucket, and every successful request slowly brings the
+    rate back to its initial value (additive increase, multiplicative decrease).
+
+    A single instance is shared by all the `KrakenRestAPI` instances, so the total
+    request rate respects Kraken's public-endpoint limits, no matter how many
+    products we fetch in parallel.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        min_rate: float = 0.05,
+        rate_increase: float = 0.01,
+    ) -> None:
+        """
+        Args:
+            rate (float): The number of tokens added to the bucket every second.
+            capacity (float): The maximum number of tokens in the bucket, i.e. the
+                size of the bursts we allow.
+            min_rate (float): The refill rate never goes below this value.
+            rate_increase (float): How much the refill rate recovers after each
+                successful request, until it is back to `rate`.
+
+        Returns:
+            None
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.rate_increase = rate_increase
+
+        # total number of seconds the callers of `acquire` spent waiting for a token
+        self.throttled_sec = 0.0
+
+        self._tokens = capacity
+        self._last_refill = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes one token from the bucket, waiting until there is one available.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_sec = (1 - self._tokens) / self.rate
+                self.throttled_sec += wait_sec
+                REST_THROTTLED_SECONDS.inc(wait_sec)
+
+            # we sleep outside of the lock, so other threads can refill meanwhile
+            sleep(wait_sec)
+
+    def on_success(self) -> None:
+        """
+        Recovers a bit of the refill rate after a request that was not rate-limited
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.rate_increase)
+
+    def on_rate_limited(self) -> None:
+        """
+        Halves the refill rate and empties the bucket, because Kraken's counter is
+        fuller than we thought.
+        """
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+
+    def _refill(self) -> None:
+        """
+        Adds the tokens accumulated since the last refill, up to `self.capacity`
+        """
+        now = monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, to retry failed requests without all
+    the workers hitting the API again at the same time.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        base_delay_sec: float = 1.0,
+        max_delay_sec: float = 60.0,
+    ) -> None:
+        """
+        Args:
+            max_retries (int): The number of retries before we give up.
+            base_delay_sec (float): The upper bound of the delay before the first retry.
+            max_delay_sec (float): The upper bound of the delay before any retry.
+
+        Returns:
+            None
+        """
+        self.max_retries = max_retries
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max_delay_sec
+
+    def delay_sec(self, attempt: int) -> float:
+        """
+        Returns how long to wait before the given retry attempt (starting at 0)
+        """
+        return random.uniform(
+            0, min(self.max_delay_sec, self.base_delay_sec * 2**attempt)
+        )
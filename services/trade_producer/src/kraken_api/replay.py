@@ -0,0 +1,139 @@
+from bisect import bisect_right
+from time import monotonic, sleep
+from typing import List, Optional
+
+import pyarrow as pa
+from kraken_api.trade import TradeRecord
+from kraken_api.trade_cache import SCHEMA, CachedTradeData, to_trade_records
+from loguru import logger
+
+
+class CachedTradeReplay:
+    """
+    Replays the trades stored in the local trade cache (see `CachedTradeData`) as
+    if they were coming from the Kraken API.
+
+    Trades of all products are replayed in timestamp order, day by day, and the
+    trades of each product keep the order in which they were fetched. With
+    `speed=0` they are replayed as fast as possible, otherwise at `speed` times
+    real time, e.g. `speed=60` replays one hour of trades in one minute.
+
+    The trades of a day stay in a columnar arrow table, and only the trades of
+    the batch we return are turned into TradeRecord tuples.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        product_ids: List[str],
+        speed: Optional[float] = 0,
+        batch_size: Optional[int] = 10_000,
+    ) -> None:
+        """
+        Args:
+            cache_dir (str): The directory of the trade cache we replay.
+            product_ids (List[str]): The products we replay.
+            speed (Optional[float]): The replay speed, as a multiple of real time.
+                0 means as fast as possible.
+            batch_size (Optional[int]): The maximum number of trades returned by
+                each call to `get_trades`.
+
+        Returns:
+            None
+        """
+        self.cache = CachedTradeData(cache_dir)
+        self.product_ids = product_ids
+        self.speed = speed
+        self.batch_size = batch_size
+
+        # the days we have to replay, for any of the products
+        self._days = sorted(
+            {
+                day
+                for product_id in product_ids
+                for day in self.cache.segments(product_id)
+            }
+        )
+        logger.info(f'Replaying {len(self._days)} days of trades for {product_ids}')
+
+        # the trades of the day we are replaying, their timestamps, and the
+        # position of the next one
+        self._trades = SCHEMA.empty_table()
+        self._timestamps_ms: List[int] = []
+        self._position = 0
+
+        # wall-clock time and trade timestamp of the first replayed trade, to pace
+        # the replay when self.speed > 0
+        self._start_sec: Optional[float] = None
+        self._start_ms: Optional[int] = None
+
+        self.n_trades = 0
+
+    def _load_next_day(self) -> None:
+        """
+        Loads the trades of all products for the next day, sorted by timestamp
+        """
+        day = self._days.pop(0)
+
+        tables = [
+            self.cache.read_segment(product_id, day)
+            for product_id in self.product_ids
+            if day in self.cache.segments(product_id)
+        ]
+        # the sort is stable, so trades of a product with the same timestamp keep
+        # their original order
+        self._trades = pa.concat_tables(tables).sort_by('timestamp_ms')
+        if self.speed > 0:
+            # only needed to pace the replay
+            self._timestamps_ms = self._trades.column('timestamp_ms').to_pylist()
+        self._position = 0
+
+    def get_trades(self) -> List[TradeRecord]:
+        """
+        Returns the next batch of trades to replay. If we replay at a given speed,
+        it waits until the first trade of the batch is due, and only returns the
+        trades that are due.
+        """
+        if self._position >= self._trades.num_rows:
+            if not self._days:
+                return []
+            self._load_next_day()
+            return []
+
+        end = min(self._position + self.batch_size, self._trades.num_rows)
+
+        if self.speed > 0:
+            first_ms = self._timestamps_ms[self._position]
+            if self._start_sec is None:
+                self._start_sec, self._start_ms = monotonic(), first_ms
+
+            # wait until the first trade of the batch is due
+            due_sec = self._start_sec + (first_ms - self._start_ms) / 1000 / self.speed
+            sleep(max(0, due_sec - monotonic()))
+
+            # and stop the batch at the first trade that is not due yet
+            now_ms = (
+                self._start_ms + (monotonic() - self._start_sec) * 1000 * self.speed
+            )
+            position = bisect_right(self._timestamps_ms, now_ms, self._position, end)
+            end = max(position, self._position + 1)
+
+        trades = to_trade_records(
+            self._trades.slice(self._position, end - self._position)
+        )
+        self._position = end
+        self.n_trades += len(trades)
+
+        return trades
+
+    def done(self) -> bool:
+        """
+        Returns True once every cached trade has been replayed
+        """
+        return not self._days and self._position >= self._trades.num_rows
+
+    def stats(self) -> str:
+        """
+        Returns a summary of the replay
+        """
+        return f'replayed {self.n_trades} trades'
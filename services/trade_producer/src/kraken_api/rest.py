@@ -1,9 +1,9 @@
 import json
 from datetime import datetime, timezone
 from time import sleep
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import requests
+from kraken_api.http_client import KrakenHttpClient
 from loguru import logger
 
 
@@ -15,11 +15,18 @@ class KrakenRestAPIMultipleProducts:
         last_n_days: int,
         # n_threads: Optional[int] = 1,
         # cache_dir: Optional[str] = None,
+        http_client: Optional[KrakenHttpClient] = None,
     ) -> None:
         self.product_ids = product_ids
+        # all the products share the same pool of keep-alive connections
+        self.http_client = http_client or KrakenHttpClient()
         # create an instance of the KrakenRestAPI for each product_id we want to fetch data for
         self.kraken_apis = [
-            KrakenRestAPI(product_id=product_id, last_n_days=last_n_days)
+            KrakenRestAPI(
+                product_id=product_id,
+                last_n_days=last_n_days,
+                http_client=self.http_client,
+            )
             for product_id in product_ids
         ]
 
@@ -60,17 +67,25 @@ class KrakenRestAPI:
 
     url = 'https://api.kraken.com/0/public/Trades?pair={product_id}&since={since_sec}'
 
-    def __init__(self, product_id: str, last_n_days: int) -> None:
+    def __init__(
+        self,
+        product_id: str,
+        last_n_days: int,
+        http_client: Optional[KrakenHttpClient] = None,
+    ) -> None:
         """Initializes the Kraken REST API
 
         Args:
             product_ids (List[str]): A list of product ids
             last_n_days (int): The number of days to fetch data from the Kraken API
+            http_client (Optional[KrakenHttpClient]): The pooled HTTP client used for the requests
 
         Returns:
             None
         """
         self.product_id = product_id
+        # reuse the keep-alive connections of the client instead of opening a new one per page
+        self.http_client = http_client or KrakenHttpClient()
         self.from_ms, self.to_ms = self._init_from_to_ms(last_n_days)
         # use it to check if we are done fetching historical data
         self.is_done: bool = False
@@ -115,12 +130,10 @@ class KrakenRestAPI:
             List[dict]: _description_
         """
 
-        payload = {}
-        headers = {'Accept': 'application/json'}
         since_sec = self.last_ts_in_ms // 1000
         url = self.url.format(product_id=self.product_id, since_sec=since_sec)
         # breakpoint()
-        response = requests.request('GET', url, headers=headers, data=payload)
+        response = self.http_client.get(url)
         # parse string into dicrionary
         data = json.loads(response.text)
         # breakpoint()
@@ -0,0 +1,63 @@
+from calendar import timegm
+from typing import Dict, List
+
+# Unix milliseconds of the 'YYYY-MM-DDTHH:MM:SS' prefix of the timestamps we parsed
+# recently. Trades come in bursts, so most of them share the prefix of the previous
+# one, and we only pay for the date arithmetic once per second of trades.
+_PREFIX_CACHE: Dict[str, int] = {}
+_PREFIX_CACHE_SIZE = 4096
+
+
+def kraken_timestamp_to_ms(timestamp: str) -> int:
+    """
+    Transforms a Kraken timestamp like '2024-06-17T09:36:39.467866Z' into Unix
+    milliseconds.
+
+    It only supports the fixed 'YYYY-MM-DDTHH:MM:SS.ffffffZ' format that Kraken
+    uses, which lets us slice the string instead of parsing it.
+
+    Args:
+        timestamp (str): A timestamp expressed as a string.
+
+    Returns:
+        int: A timestamp expressed in milliseconds.
+    """
+    prefix = timestamp[:19]
+    try:
+        seconds_ms = _PREFIX_CACHE[prefix]
+    except KeyError:
+        if len(_PREFIX_CACHE) >= _PREFIX_CACHE_SIZE:
+            _PREFIX_CACHE.clear()
+        seconds_ms = _PREFIX_CACHE[prefix] = 1000 * timegm(
+            (
+                int(prefix[0:4]),
+                int(prefix[5:7]),
+                int(prefix[8:10]),
+                int(prefix[11:13]),
+                int(prefix[14:16]),
+                int(prefix[17:19]),
+            )
+        )
+
+    # the milliseconds are the first 3 digits of the fraction
+    if len(timestamp) == 27:
+        # the usual case, with the 6 digits of microseconds
+        return seconds_ms + int(timestamp[20:23])
+    if len(timestamp) > 20:
+        # fractions with less than 6 digits, if Kraken ever trims them
+        return seconds_ms + int(timestamp[20:23].rstrip('Z').ljust(3, '0'))
+    return seconds_ms
+
+
+def kraken_timestamps_to_ms(timestamps: List[str]) -> List[int]:
+    """
+    Vectorized version of `kraken_timestamp_to_ms`, to convert the timestamps of
+    all the trades in a websocket message at once.
+
+    Args:
+        timestamps (List[str]): Timestamps expressed as strings.
+
+    Returns:
+        List[int]: The timestamps expressed in milliseconds.
+    """
+    return list(map(kraken_timestamp_to_ms, timestamps))
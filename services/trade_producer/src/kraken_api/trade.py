@@ -1,3 +1,5 @@
+from typing import NamedTuple, Optional
+
 from pydantic import BaseModel
 
 
@@ -10,3 +12,26 @@ class Trade(BaseModel):
     price: float
     volume: float
     timestamp_ms: int
+    # Kraken's sequential id of the trade, per product
+    trade_id: Optional[int] = None
+    # 'buy' or 'sell', the side of the taker
+    side: Optional[str] = None
+
+
+class TradeRecord(NamedTuple):
+    """
+    A lightweight, tuple-backed version of `Trade` for the hot path.
+
+    It has the same fields as `Trade`, but building one costs about as much as
+    building a tuple, because there is no validation involved. We use it for every
+    trade that flows from the Kraken APIs to Kafka.
+    """
+
+    product_id: str
+    price: float
+    volume: float
+    timestamp_ms: int
+    # Kraken's sequential id of the trade, per product
+    trade_id: Optional[int] = None
+    # 'buy' or 'sell', the side of the taker
+    side: Optional[str] = None
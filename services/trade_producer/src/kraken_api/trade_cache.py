@@ -0,0 +1,375 @@
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from kraken_api.trade import TradeRecord
+
+# the columns of each segment, in the order of the TradeRecord fields
+SCHEMA = pa.schema(
+    [
+        ('product_id', pa.string()),
+        ('price', pa.float64()),
+        ('volume', pa.float64()),
+        ('timestamp_ms', pa.int64()),
+        ('trade_id', pa.int64()),
+        # segments written before we stored the side read it as null
+        ('side', pa.string()),
+    ]
+)
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+class CachedTradeData:
+    """
+    A class to handle the caching of trade data fetched from the Kraken REST API.
+
+    Trades are stored in one parquet segment per product and per day:
+
+        cache_dir/
+            BTC-USD/
+                index.jsonl
+                2024-06-17.parquet
+                2024-06-18.parquet
+                2024-06-19/
+                    000000000.parquet
+                    000001000.parquet
+                    ...
+
+    Each page of trades we fetch adds a file to the segment(s) of the day(s) it
+    covers, named after the row of the segment the page starts at, and a line to
+    `index.jsonl` that maps the `since` cursor of the page to the rows of the
+    segments that hold it. Writing a page never rewrites what is already on disk,
+    so backfilling a day costs linear time.
+
+    Pages come in time order, so once we write a page of a later day, the pages of
+    the earlier days are compacted into a single file per day, and so are the
+    pages of the last day when the backfill is over (see `compact`). Replaying a
+    90-day backfill then opens 90 files, and reads each of them as a single arrow
+    table.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = Path(cache_dir)
+
+        if not self.cache_dir.exists():
+            # create the cache directory if it does not exist
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # index of each product, loaded lazily from its index.jsonl
+        # {product_id: {since_ns: [(segment, offset, length), ...]}}
+        self._indexes: Dict[str, Dict[str, List[Tuple[str, int, int]]]] = {}
+
+        # number of rows of each segment referenced by the index, for each product
+        # {product_id: {segment: n_rows}}
+        self._n_rows: Dict[str, Dict[str, int]] = {}
+
+        # number of rows in the compacted file of each segment that has one
+        # {product_id: {segment: n_rows}}
+        self._compacted_rows: Dict[str, Dict[str, int]] = {}
+
+        # the segments that have pages not compacted yet, for each product
+        self._paged_segments: Dict[str, Set[str]] = {}
+
+        # the last compacted segment we read, because the pages of a day are
+        # read one after the other
+        self._last_compacted: Optional[Tuple[str, str, pa.Table]] = None
+
+    def has(self, product_id: str, since_ns: int) -> bool:
+        """
+        Returns True if the cache has the page of trades for the given `product_id`
+        starting at the `since_ns` cursor, False otherwise.
+        """
+        return str(since_ns) in self._get_index(product_id)
+
+    def read(self, product_id: str, since_ns: int) -> List[TradeRecord]:
+        """
+        Reads from the cache the page of trades for the given `product_id` starting
+        at the `since_ns` cursor.
+        """
+        return to_trade_records(self.read_table(product_id, since_ns))
+
+    def read_table(self, product_id: str, since_ns: int) -> pa.Table:
+        """
+        Same as `read`, but returns the page as a columnar arrow table, without
+        building any per-trade object.
+        """
+        parts = self._get_index(product_id).get(str(since_ns), [])
+        return pa.concat_tables(
+            [SCHEMA.empty_table()]
+            + [
+                self._read_part(product_id, segment, offset, length)
+                for segment, offset, length in parts
+            ]
+        )
+
+    def write(self, product_id: str, since_ns: int, trades: List[TradeRecord]) -> None:
+        """
+        Appends the given page of trades to the segments of the days it covers, and
+        records in the index where the page starting at `since_ns` is stored.
+        """
+        if not trades:
+            return
+
+        self._get_index(product_id)
+        n_rows = self._n_rows[product_id]
+        chunks = self._split_by_day(trades)
+
+        # no later page has trades of the days before this one
+        first_segment = min(chunks)
+        for segment in sorted(self._paged_segments[product_id]):
+            if segment < first_segment:
+                self._compact(product_id, segment)
+
+        # pages are sorted by time, so splitting them by day gives contiguous chunks
+        parts = []
+        for segment, chunk in chunks.items():
+            # A file after the rows referenced by the index belongs to a page we
+            # wrote before crashing, without updating the index. It is replaced,
+            # because that page is being written again right now.
+            offset = n_rows.get(segment, 0)
+            self._write_part(
+                product_id,
+                segment,
+                offset,
+                pa.Table.from_pylist(
+                    [trade._asdict() for trade in chunk], schema=SCHEMA
+                ),
+            )
+            self._paged_segments[product_id].add(segment)
+            parts.append((segment, offset, len(chunk)))
+
+        self._append_to_index(product_id, since_ns, parts)
+
+    def compact(self, product_id: str) -> None:
+        """
+        Compacts the pages of every segment of `product_id` into a single file per
+        segment. Call it once no more pages of `product_id` are written.
+        """
+        self._get_index(product_id)
+        for segment in sorted(self._paged_segments[product_id]):
+            self._compact(product_id, segment)
+
+    def segments(self, product_id: str) -> List[str]:
+        """
+        Returns the days for which `product_id` has a segment, in chronological order
+        """
+        self._get_index(product_id)
+        return sorted(self._n_rows[product_id])
+
+    def read_segment(self, product_id: str, segment: str) -> pa.Table:
+        """
+        Returns all the cached trades of `product_id` for the given day, as a
+        columnar arrow table, without building any per-trade object.
+        """
+        self._get_index(product_id)
+        n_rows = self._n_rows[product_id].get(segment, 0)
+        compacted_rows = self._compacted_rows[product_id].get(segment, 0)
+
+        tables = [SCHEMA.empty_table()]
+        if compacted_rows:
+            tables.append(self._read_compacted(product_id, segment))
+
+        if segment in self._paged_segments[product_id]:
+            # The pages are named after their first row, so they sort in row order.
+            # A page before the compacted rows was left by a crash during the
+            # compaction, and a page past the rows referenced by the index by a
+            # crash before we updated it.
+            file_paths = sorted(
+                file_path
+                for file_path in (self._get_product_dir(product_id) / segment).glob(
+                    '*.parquet'
+                )
+                if compacted_rows <= int(file_path.stem) < n_rows
+            )
+            tables += [
+                pq.read_table(file_path, schema=SCHEMA) for file_path in file_paths
+            ]
+
+        return pa.concat_tables(tables)
+
+    def iter_segments(self, product_id: str) -> Iterator[pa.Table]:
+        """
+        Yields the cached trades of `product_id` as columnar arrow tables, one per
+        day and in chronological order.
+        """
+        for segment in self.segments(product_id):
+            yield self.read_segment(product_id, segment)
+
+    def product_ids(self) -> List[str]:
+        """
+        Returns the product IDs that have data in the cache
+        """
+        return [
+            path.name.replace('-', '/')
+            for path in sorted(self.cache_dir.iterdir())
+            if (path / 'index.jsonl').exists()
+        ]
+
+    @staticmethod
+    def _split_by_day(trades: List[TradeRecord]) -> Dict[str, List[TradeRecord]]:
+        """
+        Groups the given trades by the UTC day of their timestamp
+        """
+        chunks: Dict[str, List[TradeRecord]] = {}
+        for trade in trades:
+            day = trade.timestamp_ms // MS_PER_DAY
+            chunks.setdefault(day, []).append(trade)
+
+        return {
+            datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime(
+                '%Y-%m-%d'
+            ): chunk
+            for day, chunk in chunks.items()
+        }
+
+    def _get_product_dir(self, product_id: str) -> Path:
+        """
+        Returns the directory with the segments and the index of `product_id`
+        """
+        product_dir = self.cache_dir / product_id.replace('/', '-')
+        product_dir.mkdir(exist_ok=True)
+        return product_dir
+
+    def _get_index(self, product_id: str) -> Dict[str, List[Tuple[str, int, int]]]:
+        """
+        Returns the index of `product_id`, loading it from disk the first time
+        """
+        if product_id not in self._indexes:
+            file_path = self._get_product_dir(product_id) / 'index.jsonl'
+            index = {}
+            if file_path.exists():
+                with open(file_path, 'rb') as f:
+                    lines = f.read().split(b'\n')
+                # A crash while appending leaves a partial last line, without its
+                # newline. We cut it, so the next page is appended after the last
+                # complete one.
+                if lines[-1]:
+                    with open(file_path, 'r+b') as f:
+                        f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+                for line in lines[:-1]:
+                    since_ns, parts = json.loads(line)
+                    index[since_ns] = [tuple(part) for part in parts]
+            self._indexes[product_id] = index
+
+            n_rows = {}
+            for parts in index.values():
+                for segment, offset, length in parts:
+                    n_rows[segment] = max(n_rows.get(segment, 0), offset + length)
+            self._n_rows[product_id] = n_rows
+
+            product_dir = self._get_product_dir(product_id)
+            self._compacted_rows[product_id] = {
+                file_path.stem: pq.read_metadata(file_path).num_rows
+                for file_path in product_dir.glob('*.parquet')
+            }
+            self._paged_segments[product_id] = {
+                path.name for path in product_dir.iterdir() if path.is_dir()
+            }
+
+        return self._indexes[product_id]
+
+    def _append_to_index(
+        self, product_id: str, since_ns: int, parts: List[Tuple[str, int, int]]
+    ) -> None:
+        """
+        Records that the page of `product_id` starting at `since_ns` is stored in
+        the given `parts` of its segments, in memory and at the end of its
+        index.jsonl
+        """
+        file_path = self._get_product_dir(product_id) / 'index.jsonl'
+        with open(file_path, 'a') as f:
+            f.write(json.dumps([str(since_ns), parts]) + '\n')
+
+        self._indexes[product_id][str(since_ns)] = parts
+        n_rows = self._n_rows[product_id]
+        for segment, offset, length in parts:
+            n_rows[segment] = offset + length
+
+    def _get_part_path(self, product_id: str, segment: str, offset: int) -> Path:
+        """
+        Returns the file of the page that starts at row `offset` of `segment`
+        """
+        return self._get_product_dir(product_id) / segment / f'{offset:09d}.parquet'
+
+    def _get_segment_path(self, product_id: str, segment: str) -> Path:
+        """
+        Returns the file of `segment` once its pages are compacted
+        """
+        return self._get_product_dir(product_id) / f'{segment}.parquet'
+
+    def _read_part(
+        self, product_id: str, segment: str, offset: int, length: int
+    ) -> pa.Table:
+        """
+        Returns the `length` trades of the page that starts at row `offset` of
+        `segment`, from its own file or from the compacted segment
+        """
+        if offset >= self._compacted_rows[product_id].get(segment, 0):
+            return pq.read_table(
+                self._get_part_path(product_id, segment, offset), schema=SCHEMA
+            )
+        return self._read_compacted(product_id, segment).slice(offset, length)
+
+    def _read_compacted(self, product_id: str, segment: str) -> pa.Table:
+        """
+        Returns the trades of the compacted file of `segment`
+        """
+        if self._last_compacted is None or self._last_compacted[:2] != (
+            product_id,
+            segment,
+        ):
+            table = pq.read_table(
+                self._get_segment_path(product_id, segment), schema=SCHEMA
+            )
+            self._last_compacted = (product_id, segment, table)
+        return self._last_compacted[2]
+
+    def _write_part(
+        self, product_id: str, segment: str, offset: int, table: pa.Table
+    ) -> None:
+        """
+        Atomically writes the page that starts at row `offset` of `segment`
+        """
+        file_path = self._get_part_path(product_id, segment, offset)
+        file_path.parent.mkdir(exist_ok=True)
+        write_atomically(table, file_path)
+
+    def _compact(self, product_id: str, segment: str) -> None:
+        """
+        Replaces the compacted file and the pages of `segment` with a single file
+        with all its rows
+        """
+        table = self.read_segment(product_id, segment)
+        write_atomically(table, self._get_segment_path(product_id, segment))
+        # the pages are only removed once the compacted file has all their rows
+        shutil.rmtree(self._get_product_dir(product_id) / segment)
+
+        self._compacted_rows[product_id][segment] = table.num_rows
+        self._paged_segments[product_id].discard(segment)
+        self._last_compacted = None
+
+
+def write_atomically(table: pa.Table, file_path: Path) -> None:
+    """
+    Writes `table` to the parquet file `file_path`, which is either replaced as a
+    whole or left untouched if we crash
+    """
+    tmp_path = file_path.with_suffix('.tmp')
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+def to_trade_records(table: pa.Table) -> List[TradeRecord]:
+    """
+    Turns the rows of `table` into TradeRecord tuples straight from the arrow
+    columns, without going through a dictionary or a pydantic model per row.
+    """
+    return list(
+        map(TradeRecord._make, zip(*(column.to_pylist() for column in table.columns)))
+    )
@@ -1,7 +1,7 @@
 import json
-from datetime import datetime, timezone
 from typing import List
 
+from kraken_api.timestamps import kraken_timestamp_to_ms
 from kraken_api.trade import Trade
 from loguru import logger
 from websocket import create_connection
@@ -104,13 +104,4 @@ class KrakenWebsocketTradeAPI:
         Returns:
         int: A timestamp expressed in milliseconds.
         """
-        # parse a string like this '2024-06-17T09:36:39.467866Z'
-        # into a datetime object assuming UTC timezone
-        # and then transform this datetime object into Unix timestamp
-        # expressed in milliseconds
-        timestamp = datetime.fromisoformat(timestamp[:-1]).replace(
-            tzinfo=timezone.utc
-        )  # remove the 'Z' at the end of the string and converting to UTC timezone
-        return int(
-            timestamp.timestamp() * 1000
-        )  # transform the timestamp into milliseconds
+        return kraken_timestamp_to_ms(timestamp)
@@ -1,13 +1,47 @@
-from typing import List
+import sys
+from collections import Counter, defaultdict
+from time import time
+from typing import Dict, List, Optional
 
 from loguru import logger
+from prometheus_client import start_http_server
 from quixstreams import Application
+from quixstreams.models.topics import TopicAdmin, TopicConfig
 
 # from src import config
 from config import config
-from kraken_api.trade import Trade
-from kraken_api.websocket import KrakenWebsocketTradeAPI
-from kraken_api.pau_rest import KrakenRestAPIMultipleProducts
+from dedup import TradeDeduplicator
+from delivery_reports import BatchDeliveryTracker, DeliveryReportCounter
+from kraken_api.trade import TradeRecord
+from metrics import (
+    HEARTBEAT,
+    PRODUCER_QUEUE_DEPTH,
+    TRADE_LATENCY_SECONDS,
+    TRADES_PRODUCED,
+)
+from partitioning import ProductPartitioner
+from serialization import get_trade_serializer
+from trade_sources import MultiSourceRunner, create_trade_source
+
+# the header with the time we got a trade from its source, which `trade_to_ohlc`
+# passes on to the candles to trace their latency
+INGEST_MS_HEADER = 'ingest_ms'
+
+# the trade sources we run when the TRADE_SOURCES setting is not set
+DEFAULT_TRADE_SOURCES = {
+    'live': ['kraken_websocket'],
+    'historical': ['kraken_rest'],
+    'replay': ['kraken_replay'],
+}
+
+
+def get_n_partitions(kafka_broker_address: str, kafka_topic_name: str) -> int:
+    """
+    Returns the number of partitions the topic has on the broker, which differs
+    from KAFKA_TOPIC_PARTITIONS when the topic existed before we started.
+    """
+    topics = TopicAdmin(broker_address=kafka_broker_address).list_topics(timeout=30)
+    return len(topics[kafka_topic_name].partitions)
 
 
 def produce_trades(
@@ -18,13 +52,15 @@ def produce_trades(
     last_n_days: int,
 ) -> None:
     """
-    Reads trades from the Kraken websocket API and saves them into a Kafka topic.
+    Reads trades from the trade sources (the Kraken websocket API by default) and
+    saves them into a Kafka topic.
 
     Args:
         kafka_broker_addres (str): The address of the Kafka broker.
         kafka_topic (str): The name of the Kafka topic.
         product_ids (List[str]): The product IDs for which we want to get the trades.
-        live_or_historical (str): Whether we want to get live or historical data.
+        live_or_historical (str): Whether we want to get live or historical data, or
+            replay the historical data cached in `config.cache_dir_historical_data`.
         last_n_days (int): The number of days from which we want to get historical data.
 
     Returns:
@@ -39,62 +75,165 @@ def produce_trades(
     #     'historical',
     # }, f'Invalid value for live_or_historical: {live_or_historical}'
 
-    app = Application(broker_address=kafka_broker_addres)
+    app = Application(
+        broker_address=kafka_broker_addres,
+        # let librdkafka batch and compress messages, instead of relying on its
+        # defaults, which are tuned for latency rather than throughput
+        producer_extra_config={
+            'linger.ms': config.producer_linger_ms,
+            'batch.size': config.producer_batch_size,
+            'compression.type': config.producer_compression_type,
+        },
+    )
 
     # the topic where we will save the trades
-    topic = app.topic(name=kafka_topic_name, value_serializer='json')
+    if config.kafka_topic_partitions is None:
+        topic = app.topic(name=kafka_topic_name, value_serializer='json')
+    else:
+        topic = app.topic(
+            name=kafka_topic_name,
+            value_serializer='json',
+            config=TopicConfig(
+                num_partitions=config.kafka_topic_partitions, replication_factor=1
+            ),
+        )
 
-    logger.info(f'Creating the Kraken API to fetch data for {product_ids}')
+    # we serialize the trades ourselves, either as JSON or in the compact binary format
+    serialize_trade = get_trade_serializer(config.trades_value_format)
 
-    # Create an instance of the Kraken API
-    if live_or_historical == 'live':
-        kraken_api = KrakenWebsocketTradeAPI(product_ids=product_ids)
-    else:
-        # I need historical data, so
+    # run all the trade sources we ingest from, concurrently
+    trade_source_names = (
+        config.trade_sources or DEFAULT_TRADE_SOURCES[live_or_historical]
+    )
+    logger.info(f'Creating the trade sources {trade_source_names} for {product_ids}')
+    trade_sources = MultiSourceRunner(
+        sources=[
+            create_trade_source(name, config, product_ids, last_n_days)
+            for name in trade_source_names
+        ],
+        stats_interval_sec=config.source_stats_interval_sec,
+    )
+
+    logger.info('Creating the producer...')
 
-        kraken_api = KrakenRestAPIMultipleProducts(
-            product_ids=product_ids,
-            last_n_days=last_n_days,
-            n_threads=1,  # len(product_ids),
-            cache_dir=config.cache_dir_historical_data,
+    # remembers the recent trades of each product, to drop duplicates
+    # Each source gets its own, because the trade IDs of two venues may collide.
+    deduplicators: Dict[Optional[str], TradeDeduplicator] = defaultdict(
+        lambda: TradeDeduplicator(
+            window_ms=config.dedup_window_sec * 1000,
+            max_trades_per_product=config.dedup_max_trades_per_product,
         )
+    )
 
-    logger.info('Creating the producer...')
+    # counts the messages acked / failed by the broker
+    delivery_reports = DeliveryReportCounter()
+
+    # for the sources that can resume from a checkpoint, like the REST backfill, we
+    # save the checkpoints of each batch of trades once the whole batch is
+    # acknowledged by the broker
+    batch_tracker = BatchDeliveryTracker(
+        on_batch_delivered=trade_sources.save_checkpoints,
+        delivery_reports=delivery_reports,
+    )
 
-    # Create a Producer instance
+    # Create a Producer instance, which creates the topic if it does not exist
     with app.get_producer() as producer:
+        partitioner = None
+        if config.kafka_topic_partitions is not None:
+            # we pick the partition of each product ourselves, so we can scale
+            # trade_to_ohlc by adding replicas, up to one per partition. An
+            # existing topic keeps its partitions, so we ask the broker for them.
+            n_partitions = get_n_partitions(kafka_broker_addres, kafka_topic_name)
+            if n_partitions != config.kafka_topic_partitions:
+                logger.warning(
+                    f'Topic {kafka_topic_name} has {n_partitions} partitions, not '
+                    f'KAFKA_TOPIC_PARTITIONS={config.kafka_topic_partitions}, so we '
+                    f'spread the products across {n_partitions} partitions'
+                )
+            partitioner = ProductPartitioner(product_ids, n_partitions)
+            logger.info(f'Products of each partition: {partitioner.assignment()}')
+
         while True:
             # check if we are done fetching historical data
-            if kraken_api.done():
-                logger.info('Done fetching historical data')
+            if trade_sources.done():
+                logger.info(f'Done fetching trades: {trade_sources.stats()}')
                 break
 
             # breakpoint()
 
-            # Get the trades from the Kraken API
-            trades: List[Trade] = kraken_api.get_trades()
+            # Get the next batch of trades from any of the trade sources
+            batch = trade_sources.get_batch()
 
-            # Challenge 1: Send a heartbeat to Prometheus to check the service is alive
-            # Challenge 2: Send an event with trade latency to Prometheus, to monitor the trade latency
+            # drop the trades we already produced
+            trades: List[TradeRecord] = deduplicators[batch.source].filter(batch.trades)
 
-            for trade in trades:
-                # Serialize an event using the defined Topic
-                message = topic.serialize(
-                    key=trade.product_id,
-                    value=trade.model_dump(),
+            on_delivery = delivery_reports
+            if batch.cursors is not None:
+                on_delivery = batch_tracker.add_batch(
+                    payload=(batch.source, batch.cursors), n_messages=len(trades)
                 )
 
+            # heartbeat, to check the service is alive
+            HEARTBEAT.set_to_current_time()
+
+            # the trace header of the trades, with the time the source received
+            # them, see `trade_to_ohlc/src/tracing.py`
+            headers = None
+            if trades:
+                if config.trace_headers:
+                    headers = [(INGEST_MS_HEADER, str(batch.received_ms).encode())]
+                # how late each trade reaches Kafka, compared to the exchange
+                now_ms = time() * 1000
+                latency = TRADE_LATENCY_SECONDS.labels(source=batch.source)
+                for trade in trades:
+                    latency.observe((now_ms - trade.timestamp_ms) / 1000)
+
+                # one counter update per product, instead of one per trade
+                n_trades_per_product = Counter(trade.product_id for trade in trades)
+                for product_id, n_trades in n_trades_per_product.items():
+                    TRADES_PRODUCED.labels(
+                        source=batch.source, product_id=product_id
+                    ).inc(n_trades)
+
+            for trade in trades:
                 # Produce a message into the Kafka topic
+                # We serialize the trade ourselves instead of going through
+                # `topic.serialize`, which is the bottleneck when replaying
+                # historical trades
                 producer.produce(
                     topic=topic.name,
-                    value=message.value,
-                    key=message.key,
+                    value=serialize_trade(trade),
+                    key=trade.product_id,
+                    headers=headers,
+                    partition=(
+                        partitioner.partition(trade.product_id)
+                        if partitioner is not None
+                        else None
+                    ),
+                    on_delivery=on_delivery,
                 )
 
-                logger.debug(f'{trade.model_dump()}')
+                # lazy=True so the trade is only formatted when debug logs are on
+                logger.opt(lazy=True).debug('{}', trade._asdict)
+
+            # Backpressure: if too many messages are waiting for a delivery report,
+            # we stop fetching trades until the broker catches up
+            while len(producer) > config.max_in_flight_messages:
+                producer.poll(0.1)
+
+            PRODUCER_QUEUE_DEPTH.set(len(producer))
 
             # logger.info(f'Produced {len(trades)} trades to Kafka topic {topic.name}')
 
+    # the producer is flushed when we leave the `with` block, so by now we have a
+    # delivery report for every message
+    logger.info(f'Delivery reports: {delivery_reports}')
+    logger.info(
+        'Dropped '
+        f'{sum(dedup.n_duplicates for dedup in deduplicators.values())} '
+        'duplicate trades'
+    )
+
 
 if __name__ == '__main__':
     # You can also pass configuration parameters using the command line
@@ -106,6 +245,14 @@ if __name__ == '__main__':
     # parser.add_argument('--kafka_topic', type=str, required=True)
     # args = parser.parse_args()
 
+    # with a level above DEBUG, the per-trade debug logs cost nothing
+    logger.remove()
+    logger.add(sys.stderr, level=config.log_level)
+
+    if config.metrics_port is not None:
+        # Prometheus scrapes the metrics from http://<host>:<metrics_port>/metrics
+        start_http_server(config.metrics_port)
+
     logger.debug('Configuration:')
     logger.debug(config.model_dump())
 
@@ -123,4 +270,4 @@ if __name__ == '__main__':
             last_n_days=config.last_n_days,
         )
     except KeyboardInterrupt:
-        logger.info('Exiting...')
\ No newline at end of file
+        logger.info('Exiting...')
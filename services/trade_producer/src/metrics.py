@@ -0,0 +1,46 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics of the trade_producer, served on METRICS_PORT by `main`.
+# Together they tell where the lag comes from: the exchange (trade latency going
+# up while decode and request times stay flat), our parsing (decode time) or
+# Kafka (producer queue depth).
+
+TRADES_PRODUCED = Counter(
+    'trade_producer_trades_total',
+    'Trades produced to Kafka. Use rate() to get the trades/sec of each product',
+    ['source', 'product_id'],
+)
+
+TRADE_LATENCY_SECONDS = Histogram(
+    'trade_producer_trade_latency_seconds',
+    'Time between the trade on the exchange and the moment we produce it',
+    ['source'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+WEBSOCKET_DECODE_SECONDS = Histogram(
+    'kraken_websocket_decode_seconds',
+    'Time to decode one websocket frame into trades',
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005),
+)
+
+REST_REQUEST_SECONDS = Histogram(
+    'kraken_rest_request_seconds',
+    'Latency of the requests to the Kraken REST API, one page of trades each',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+REST_THROTTLED_SECONDS = Counter(
+    'kraken_rest_throttled_seconds_total',
+    'Time spent waiting for the rate limiter before calling the Kraken REST API',
+)
+
+PRODUCER_QUEUE_DEPTH = Gauge(
+    'trade_producer_queue_depth',
+    'Messages waiting in the Kafka producer for a delivery report',
+)
+
+HEARTBEAT = Gauge(
+    'trade_producer_last_heartbeat_timestamp_seconds',
+    'Last time the produce loop went through an iteration',
+)
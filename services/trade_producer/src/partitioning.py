@@ -0,0 +1,61 @@
+from collections import defaultdict
+from typing import Dict, List
+from zlib import crc32
+
+from trade_sources.normalization import TradeNormalizer
+
+
+class ProductPartitioner:
+    """
+    Assigns each product to a partition of the trades topic, so the replicas of
+    `trade_to_ohlc` split the products between them in a way we control.
+
+    The configured products are assigned round-robin, in the order of
+    `product_ids`, so they are spread evenly across the partitions, and adding a
+    product at the end of the list doesn't move any of the others, which would
+    split their open candles between two replicas. With at least as many
+    partitions as products, each product gets a partition of its own.
+
+    Products we were not configured with, e.g. the ones in a trades file, are
+    assigned by a hash of their product ID, which is stable across restarts,
+    unlike Python's `hash`.
+    """
+
+    def __init__(self, product_ids: List[str], n_partitions: int) -> None:
+        """
+        Args:
+            product_ids (List[str]): The products we produce trades for.
+            n_partitions (int): The number of partitions of the trades topic.
+
+        Returns:
+            None
+        """
+        self.n_partitions = n_partitions
+
+        # the trades reach us with normalized product IDs, e.g. 'BTC/USD' for
+        # 'XBT/USD', so the assignment is keyed on them as well
+        normalizer = TradeNormalizer()
+        self._partitions: Dict[str, int] = {}
+        for product_id in product_ids:
+            product_id = normalizer.normalize_product_id(product_id)
+            if product_id not in self._partitions:
+                self._partitions[product_id] = len(self._partitions) % n_partitions
+
+    def partition(self, product_id: str) -> int:
+        """
+        Returns the partition of the trades of `product_id`
+        """
+        partition = self._partitions.get(product_id)
+        if partition is None:
+            partition = crc32(product_id.encode()) % self.n_partitions
+            self._partitions[product_id] = partition
+        return partition
+
+    def assignment(self) -> Dict[int, List[str]]:
+        """
+        Returns the products of each partition, for logging
+        """
+        assignment = defaultdict(list)
+        for product_id, partition in self._partitions.items():
+            assignment[partition].append(product_id)
+        return dict(assignment)
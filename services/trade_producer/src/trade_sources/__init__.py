@@ -0,0 +1,10 @@
+# importing the sources registers them, see `register_trade_source`
+from trade_sources import file, kraken  # noqa: F401
+from trade_sources.base import (  # noqa: F401
+    TRADE_SOURCES,
+    SourceBatch,
+    TradeSource,
+    create_trade_source,
+    register_trade_source,
+)
+from trade_sources.runner import MultiSourceRunner  # noqa: F401
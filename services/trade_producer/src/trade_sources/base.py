@@ -0,0 +1,133 @@
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Type
+
+from kraken_api.trade import TradeRecord
+
+
+class SourceBatch(NamedTuple):
+    """
+    A batch of normalized trades coming from one trade source.
+    """
+
+    # name of the source the trades come from
+    source: Optional[str]
+    trades: List[TradeRecord]
+    # how far the source got once these trades are in Kafka, e.g. the backfill
+    # cursor of each product, or None if the source has nothing to checkpoint
+    cursors: Optional[Dict[str, int]]
+    # when the source received the oldest of these trades, in Unix milliseconds
+    received_ms: Optional[int]
+
+
+class TradeSource(ABC):
+    """
+    An asynchronous source of trades, e.g. one exchange API or a file.
+
+    The `MultiSourceRunner` calls `start` once, then awaits `get_trades` until
+    `done` returns True, and finally calls `close`. Sources return raw trades;
+    their product IDs and values are normalized by the runner, so each source
+    only has to map its own payloads to `TradeRecord`.
+    """
+
+    # the name under which the source is registered, set by `create_trade_source`
+    name: str = ''
+
+    # asset codes of the venue that the normalization stage has to rename,
+    # e.g. {'XBT': 'BTC'}
+    asset_aliases: Optional[Dict[str, str]] = None
+
+    # updated by `get_trades` with the cursors of the trades it just returned, for
+    # sources that can resume from a checkpoint
+    last_cursors: Optional[Dict[str, int]] = None
+
+    # updated by `get_trades` with when the source received the oldest of the
+    # trades it just returned, for sources that buffer them before. The runner
+    # uses the time `get_trades` returned otherwise
+    last_received_ms: Optional[int] = None
+
+    @classmethod
+    @abstractmethod
+    def from_config(
+        cls, config: Any, product_ids: List[str], last_n_days: int
+    ) -> 'TradeSource':
+        """
+        Builds the source from the service configuration.
+        """
+
+    async def start(self) -> None:
+        """
+        Opens the connections the source needs. Does nothing by default.
+        """
+
+    @abstractmethod
+    async def get_trades(self) -> List[TradeRecord]:
+        """
+        Returns the next trades of the source. It may return an empty list.
+        """
+
+    @abstractmethod
+    def done(self) -> bool:
+        """
+        Returns True once the source has no more trades to return.
+        """
+
+    async def close(self) -> None:
+        """
+        Releases the resources of the source. Does nothing by default.
+        """
+
+    def save_checkpoints(self, cursors: Dict[str, int]) -> None:
+        """
+        Called with `last_cursors` once the trades they cover are in Kafka.
+        Does nothing by default.
+        """
+
+    def stats(self) -> str:
+        """
+        Returns a summary of the source's own metrics, if it has any.
+        """
+        return ''
+
+
+# {name: TradeSource subclass}
+TRADE_SOURCES: Dict[str, Type[TradeSource]] = {}
+
+
+def register_trade_source(
+    name: str,
+) -> Callable[[Type[TradeSource]], Type[TradeSource]]:
+    """
+    Class decorator that registers a `TradeSource` under the given `name`, so it
+    can be selected with the `TRADE_SOURCES` setting.
+    """
+
+    def decorator(source_class: Type[TradeSource]) -> Type[TradeSource]:
+        assert name not in TRADE_SOURCES, f'Trade source {name} already registered'
+        TRADE_SOURCES[name] = source_class
+        return source_class
+
+    return decorator
+
+
+def create_trade_source(
+    name: str, config: Any, product_ids: List[str], last_n_days: int
+) -> TradeSource:
+    """
+    Builds the trade source registered under `name` from the service configuration.
+
+    Args:
+        name (str): The name of a registered trade source.
+        config (Any): The service configuration, see `config.Config`.
+        product_ids (List[str]): The product IDs for which we want to get the trades.
+        last_n_days (int): The number of days of historical data, for the sources
+            that need it.
+
+    Returns:
+        TradeSource: The trade source.
+    """
+    assert (
+        name in TRADE_SOURCES
+    ), f'Unknown trade source {name}, available ones are {list(TRADE_SOURCES)}'
+    source = TRADE_SOURCES[name].from_config(config, product_ids, last_n_days)
+    source.name = name
+    return source
@@ -0,0 +1,123 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import orjson
+from kraken_api.trade import TradeRecord
+from loguru import logger
+from trade_sources.base import TradeSource, register_trade_source
+from trade_sources.normalization import TradeNormalizer
+
+
+@register_trade_source('file')
+class FileTradeSource(TradeSource):
+    """
+    Reads trades from a local JSON lines file, with one trade per line in the same
+    format as the JSON messages of the trades topic, e.g.
+
+        {"product_id": "BTC/USD", "price": 64000.1, "volume": 0.01,
+         "timestamp_ms": 1718617000000, "trade_id": 123}
+
+    It needs no network, so it is a stand-in for the exchange APIs when running the
+    pipeline offline. A dump of the trades topic can be used as is.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        product_ids: Optional[List[str]] = None,
+        batch_size: Optional[int] = 1_000,
+    ) -> None:
+        """
+        Args:
+            file_path (str): The JSON lines file to read.
+            product_ids (Optional[List[str]]): Only the trades of these products are
+                returned. None means all of them.
+            batch_size (Optional[int]): The maximum number of lines read by each call
+                to `get_trades`.
+
+        Returns:
+            None
+        """
+        self.file_path = file_path
+        self._normalizer = TradeNormalizer()
+        self.product_ids = (
+            {self._normalizer.normalize_product_id(p) for p in product_ids}
+            if product_ids
+            else None
+        )
+        # {raw product ID in the file: whether we return its trades}
+        self._selected: Dict[str, bool] = {}
+        self.batch_size = batch_size
+
+        self._file = None
+        self._eof = False
+
+    @classmethod
+    def from_config(
+        cls, config: Any, product_ids: List[str], last_n_days: int
+    ) -> 'FileTradeSource':
+        assert (
+            config.trades_file_path is not None
+        ), 'The file trade source needs the TRADES_FILE_PATH to read from'
+        return cls(file_path=config.trades_file_path, product_ids=product_ids)
+
+    async def start(self) -> None:
+        logger.info(f'Reading trades from {self.file_path}')
+        self._file = open(self.file_path, 'rb')
+
+    async def get_trades(self) -> List[TradeRecord]:
+        # reading a batch of lines is quick, but it is still blocking I/O
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read_batch)
+
+    def _read_batch(self) -> List[TradeRecord]:
+        """
+        Reads the next `self.batch_size` lines of the file and returns their trades
+        """
+        trades = []
+        for _ in range(self.batch_size):
+            line = self._file.readline()
+            if not line:
+                self._eof = True
+                break
+            if not line.strip():
+                continue
+
+            trade = orjson.loads(line)
+            if self._is_selected(trade['product_id']):
+                trades.append(
+                    TradeRecord(
+                        trade['product_id'],
+                        trade['price'],
+                        trade['volume'],
+                        trade['timestamp_ms'],
+                        trade.get('trade_id'),
+                        trade.get('side'),
+                    )
+                )
+
+        return trades
+
+    def _is_selected(self, product_id: str) -> bool:
+        """
+        Returns True if we have to return the trades of `product_id`, comparing
+        normalized product IDs, so 'BTC-USD' in the file matches 'BTC/USD'
+        """
+        if self.product_ids is None:
+            return True
+
+        selected = self._selected.get(product_id)
+        if selected is None:
+            selected = self._normalizer.normalize_product_id(product_id) in (
+                self.product_ids
+            )
+            self._selected[product_id] = selected
+
+        return selected
+
+    def done(self) -> bool:
+        return self._eof
+
+    async def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
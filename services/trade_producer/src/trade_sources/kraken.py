@@ -0,0 +1,166 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, List
+
+from kraken_api.async_websocket import KrakenAsyncWebsocketTradeAPI
+from kraken_api.checkpoint import CheckpointStore
+from kraken_api.http_client import KrakenHttpClient
+from kraken_api.pau_rest import KrakenRestAPIMultipleProducts
+from kraken_api.rate_limiter import TokenBucket
+from kraken_api.replay import CachedTradeReplay
+from kraken_api.trade import TradeRecord
+from trade_sources.base import TradeSource, register_trade_source
+
+
+@lru_cache(maxsize=None)
+def get_rest_rate_limiter(requests_per_sec: float, burst_size: float) -> TokenBucket:
+    """
+    Returns the rate limiter of the Kraken REST API. Kraken counts the requests
+    per client, so the backfill of the websocket gaps and the REST source share
+    the same one when they run together.
+    """
+    return TokenBucket(rate=requests_per_sec, capacity=burst_size)
+
+
+class BlockingTradeSource(TradeSource):
+    """
+    Adapts one of our synchronous Kraken clients, which expose blocking
+    `get_trades` / `done` methods, to the `TradeSource` interface.
+
+    `get_trades` runs in a dedicated worker thread, so a slow page from the REST
+    API doesn't stop the other sources sharing the event loop.
+    """
+
+    def __init__(self, api: Any) -> None:
+        self.api = api
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def get_trades(self) -> List[TradeRecord]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.api.get_trades)
+
+    def done(self) -> bool:
+        return self.api.done()
+
+    async def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> str:
+        return self.api.stats()
+
+
+@register_trade_source('kraken_websocket')
+class KrakenWebsocketSource(TradeSource):
+    """
+    Live trades from the Kraken websocket API, see `KrakenAsyncWebsocketTradeAPI`.
+    """
+
+    asset_aliases = {'XBT': 'BTC'}
+
+    def __init__(self, api: KrakenAsyncWebsocketTradeAPI) -> None:
+        self.api = api
+
+    @classmethod
+    def from_config(
+        cls, config: Any, product_ids: List[str], last_n_days: int
+    ) -> 'KrakenWebsocketSource':
+        return cls(
+            KrakenAsyncWebsocketTradeAPI(
+                product_ids=product_ids,
+                n_connections=config.n_websocket_connections,
+                queue_size=config.trade_queue_size,
+                rate_limiter=get_rest_rate_limiter(
+                    config.rest_api_requests_per_sec, config.rest_api_burst_size
+                ),
+                http_client=KrakenHttpClient(
+                    pool_size=config.n_websocket_connections,
+                    http2=config.rest_api_http2,
+                ),
+            )
+        )
+
+    async def get_trades(self) -> List[TradeRecord]:
+        # the websocket connections have their own event loop, we just wait for
+        # their next batch without blocking ours
+        trades = await self.api.get_trades_async()
+        self.last_received_ms = self.api.last_received_ms
+        return trades
+
+    def done(self) -> bool:
+        return self.api.done()
+
+    async def close(self) -> None:
+        # joins the thread of the websocket event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.api.close)
+
+
+@register_trade_source('kraken_rest')
+class KrakenRestSource(BlockingTradeSource):
+    """
+    Historical trades from the Kraken REST API, see `KrakenRestAPIMultipleProducts`.
+
+    It reports the backfill cursor of each product in `last_cursors`, so the
+    checkpoints are saved once the trades are in Kafka.
+    """
+
+    asset_aliases = {'XBT': 'BTC'}
+
+    @classmethod
+    def from_config(
+        cls, config: Any, product_ids: List[str], last_n_days: int
+    ) -> 'KrakenRestSource':
+        n_threads = config.n_threads_historical or len(product_ids)
+        return cls(
+            KrakenRestAPIMultipleProducts(
+                product_ids=product_ids,
+                last_n_days=last_n_days,
+                n_threads=n_threads,
+                cache_dir=config.cache_dir_historical_data,
+                rate_limiter=get_rest_rate_limiter(
+                    config.rest_api_requests_per_sec, config.rest_api_burst_size
+                ),
+                http_client=KrakenHttpClient(
+                    pool_size=n_threads,
+                    http2=config.rest_api_http2,
+                ),
+                checkpoint_store=(
+                    CheckpointStore(config.checkpoint_db_path)
+                    if config.checkpoint_db_path is not None
+                    else None
+                ),
+            )
+        )
+
+    async def get_trades(self) -> List[TradeRecord]:
+        trades = await super().get_trades()
+        # set by the call above, and only read by the runner before the next one
+        self.last_cursors = dict(self.api.last_cursors)
+        self.last_received_ms = self.api.last_received_ms
+        return trades
+
+    def save_checkpoints(self, cursors) -> None:
+        self.api.save_checkpoints(cursors)
+
+
+@register_trade_source('kraken_replay')
+class KrakenReplaySource(BlockingTradeSource):
+    """
+    Replays the trades cached by previous historical runs, see `CachedTradeReplay`.
+    """
+
+    @classmethod
+    def from_config(
+        cls, config: Any, product_ids: List[str], last_n_days: int
+    ) -> 'KrakenReplaySource':
+        # replay the trades we cached during previous historical runs
+        assert (
+            config.cache_dir_historical_data is not None
+        ), 'The replay mode needs the CACHE_DIR_HISTORICAL_DATA to replay from'
+        return cls(
+            CachedTradeReplay(
+                cache_dir=config.cache_dir_historical_data,
+                product_ids=product_ids,
+                speed=config.replay_speed,
+            )
+        )
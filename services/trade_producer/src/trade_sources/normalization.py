@@ -0,0 +1,86 @@
+from math import inf
+from typing import Dict, List, Optional
+
+from kraken_api.trade import TradeRecord
+
+# asset codes some venues use instead of the usual ones
+DEFAULT_ASSET_ALIASES = {
+    'XBT': 'BTC',
+    'XDG': 'DOGE',
+}
+
+
+class TradeNormalizer:
+    """
+    Turns the raw trades of one source into the `Trade` schema we produce to Kafka.
+
+    - product IDs are mapped to the 'BASE/QUOTE' form we use everywhere else,
+      e.g. 'xbt-usd' or 'XBT_USD' become 'BTC/USD'
+    - prices and volumes become floats and timestamps integer milliseconds
+    - trades with a non-positive or non-finite price or volume, or without a
+      timestamp, are dropped and counted in `n_invalid`
+    """
+
+    def __init__(
+        self,
+        asset_aliases: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """
+        Args:
+            asset_aliases (Optional[Dict[str, str]]): Asset codes to rename, on top
+                of `DEFAULT_ASSET_ALIASES`.
+
+        Returns:
+            None
+        """
+        self.asset_aliases = {**DEFAULT_ASSET_ALIASES, **(asset_aliases or {})}
+
+        # each source only has a handful of products, so we map each raw product ID
+        # once and then look it up
+        self._product_ids: Dict[str, str] = {}
+
+        self.n_invalid = 0
+
+    def normalize(self, trades: List[TradeRecord]) -> List[TradeRecord]:
+        """
+        Returns the valid trades among the given ones, normalized.
+
+        Args:
+            trades (List[TradeRecord]): The raw trades of the source.
+
+        Returns:
+            List[TradeRecord]: The normalized trades, in the same order.
+        """
+        normalized = []
+        for trade in trades:
+            product_id = self._product_ids.get(trade.product_id)
+            if product_id is None:
+                product_id = self.normalize_product_id(trade.product_id)
+                self._product_ids[trade.product_id] = product_id
+
+            price = float(trade.price)
+            volume = float(trade.volume)
+            # the chained comparisons are also False for NaN
+            if not (0 < price < inf and 0 < volume < inf) or not trade.timestamp_ms:
+                self.n_invalid += 1
+                continue
+
+            normalized.append(
+                TradeRecord(
+                    product_id,
+                    price,
+                    volume,
+                    int(trade.timestamp_ms),
+                    trade.trade_id,
+                    trade.side,
+                )
+            )
+
+        return normalized
+
+    def normalize_product_id(self, product_id: str) -> str:
+        """
+        Maps a product ID of the source to the 'BASE/QUOTE' form
+        """
+        assets = product_id.upper().replace('-', '/').replace('_', '/').split('/')
+        return '/'.join(self.asset_aliases.get(asset, asset) for asset in assets)
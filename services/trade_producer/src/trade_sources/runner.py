@@ -0,0 +1,223 @@
+import asyncio
+import threading
+from time import monotonic, time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from trade_sources.base import SourceBatch, TradeSource
+from trade_sources.normalization import TradeNormalizer
+
+
+class SourceStats:
+    """
+    Throughput metrics of one trade source
+    """
+
+    def __init__(self) -> None:
+        self.n_batches = 0
+        self.n_trades = 0
+        self.start_sec = monotonic()
+
+        # number of trades at the last periodic report, to compute the throughput
+        # over the last interval
+        self.last_report_n_trades = 0
+        self.last_report_sec = self.start_sec
+
+    def trades_per_sec(self) -> float:
+        """
+        Returns the average throughput since the source started
+        """
+        return self.n_trades / max(monotonic() - self.start_sec, 1e-9)
+
+
+class MultiSourceRunner:
+    """
+    Runs several `TradeSource`s concurrently in one process and merges their
+    trades into a single stream of `SourceBatch`es.
+
+    Each source gets its own task on an event loop that lives in a background
+    thread. The tasks normalize the trades of their source and put them into a
+    bounded queue, which `get_batch` drains from the (synchronous) produce loop
+    in `main.produce_trades`. When the queue is full, all the sources wait until
+    there is room again.
+    """
+
+    def __init__(
+        self,
+        sources: List[TradeSource],
+        queue_size: Optional[int] = 100,
+        stats_interval_sec: Optional[float] = 60,
+    ) -> None:
+        """
+        Starts the sources.
+
+        Args:
+            sources (List[TradeSource]): The trade sources to run, with unique names.
+            queue_size (Optional[int]): The maximum number of batches waiting to be
+                drained by `get_batch`.
+            stats_interval_sec (Optional[float]): How often we log the throughput of
+                each source.
+
+        Returns:
+            None
+        """
+        names = [source.name for source in sources]
+        assert len(set(names)) == len(names), f'Duplicate trade sources in {names}'
+
+        self.sources = {source.name: source for source in sources}
+        self.normalizers = {
+            source.name: TradeNormalizer(asset_aliases=source.asset_aliases)
+            for source in sources
+        }
+        self._stats = {source.name: SourceStats() for source in sources}
+
+        self.queue_size = queue_size
+        self.stats_interval_sec = stats_interval_sec
+
+        # number of sources whose end marker we took out of the queue
+        self._n_finished = 0
+        # the first exception raised by a source, re-raised in the main thread
+        self._error: Optional[Tuple[str, Exception]] = None
+
+        # the event loop runs in a daemon thread, so it dies with the main thread
+        self._loop = asyncio.new_event_loop()
+        self._queue: Optional[asyncio.Queue] = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_event_loop, name='trade-sources', daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+        logger.info(f'Started trade sources {names}')
+
+    def _run_event_loop(self) -> None:
+        """
+        Runs the event loop with one task per source.
+        """
+        asyncio.set_event_loop(self._loop)
+
+        # the queue has to be created inside the loop that uses it
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._ready.set()
+
+        for source in self.sources.values():
+            self._loop.create_task(self._pump(source))
+        self._loop.create_task(self._report_stats())
+
+        # the loop keeps running after the sources are done, because `get_batch`
+        # still has to drain the queue through it
+        self._loop.run_forever()
+
+    async def _pump(self, source: TradeSource) -> None:
+        """
+        Moves the trades of `source` into the queue until the source is done, then
+        puts an end marker (None) into the queue.
+        """
+        normalizer = self.normalizers[source.name]
+        stats = self._stats[source.name]
+
+        try:
+            await source.start()
+
+            while not source.done():
+                trades = normalizer.normalize(await source.get_trades())
+                cursors = source.last_cursors
+                received_ms = source.last_received_ms or int(time() * 1000)
+
+                stats.n_batches += 1
+                stats.n_trades += len(trades)
+
+                # batches without trades still matter when they move the cursors
+                if trades or cursors:
+                    await self._queue.put(
+                        SourceBatch(source.name, trades, cursors, received_ms)
+                    )
+        except Exception as e:
+            logger.error(f'Trade source {source.name} failed: {e}')
+            if self._error is None:
+                self._error = (source.name, e)
+        finally:
+            await source.close()
+            await self._queue.put(None)
+
+    async def _report_stats(self) -> None:
+        """
+        Logs the throughput of each source every `self.stats_interval_sec` seconds
+        """
+        while True:
+            await asyncio.sleep(self.stats_interval_sec)
+
+            now_sec = monotonic()
+            for name, stats in self._stats.items():
+                trades_per_sec = (stats.n_trades - stats.last_report_n_trades) / (
+                    now_sec - stats.last_report_sec
+                )
+                stats.last_report_n_trades = stats.n_trades
+                stats.last_report_sec = now_sec
+                logger.info(f'Trade source {name}: {trades_per_sec:.1f} trades/sec')
+
+    async def _next_batch(self) -> SourceBatch:
+        """
+        Waits for the next batch of any source. Returns an empty batch once all the
+        sources are done.
+        """
+        while self._n_finished < len(self.sources):
+            batch = await self._queue.get()
+            if batch is not None:
+                return batch
+            self._n_finished += 1
+
+        return SourceBatch(None, [], None, None)
+
+    def get_batch(self) -> SourceBatch:
+        """
+        Returns the next batch of trades of any source. Blocks until one is
+        available, or all the sources are done.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._next_batch(), self._loop)
+        batch = future.result()
+
+        if self._error is not None:
+            name, error = self._error
+            raise RuntimeError(f'Trade source {name} failed') from error
+
+        return batch
+
+    def done(self) -> bool:
+        """
+        Returns True once all the sources are done and their trades were drained
+        """
+        return self._n_finished == len(self.sources)
+
+    def save_checkpoints(self, payload: Tuple[str, Dict[str, int]]) -> None:
+        """
+        Saves the cursors of a batch, once its trades are in Kafka.
+
+        Args:
+            payload (Tuple[str, Dict[str, int]]): The name of the source of the
+                batch, and its cursors.
+
+        Returns:
+            None
+        """
+        name, cursors = payload
+        self.sources[name].save_checkpoints(cursors)
+
+    def stats(self) -> str:
+        """
+        Returns a summary of the metrics of each source
+        """
+        summaries = []
+        for name, source in self.sources.items():
+            stats = self._stats[name]
+            summary = (
+                f'{name}: {stats.n_trades} trades in {stats.n_batches} batches '
+                f'({stats.trades_per_sec():.1f} trades/sec), '
+                f'{self.normalizers[name].n_invalid} invalid'
+            )
+            if source.stats():
+                summary += f', {source.stats()}'
+            summaries.append(summary)
+
+        return '; '.join(summaries)
@@ -0,0 +1,47 @@
+import pytest
+from kraken_api.pau_rest import (
+    KrakenRestAPI,
+    KrakenRestAPIError,
+    KrakenRestAPIMultipleProducts,
+)
+
+
+@pytest.fixture
+def failing_eth_usd(monkeypatch):
+    """
+    Makes the REST API fail for ETH/USD with an error we don't retry, and return
+    a single empty page for every other product
+    """
+
+    def get_trades(self):
+        if self.product_id == 'ETH/USD':
+            raise KrakenRestAPIError('EQuery:Unknown asset pair')
+        self.last_trade_ms = self.to_ms
+        return []
+
+    monkeypatch.setattr(KrakenRestAPI, 'get_trades', get_trades)
+
+
+def test_done_raises_the_error_of_a_failed_worker(failing_eth_usd):
+    kraken_api = KrakenRestAPIMultipleProducts(
+        product_ids=['BTC/USD', 'ETH/USD'], last_n_days=1, n_threads=2
+    )
+
+    with pytest.raises(KrakenRestAPIError, match='Unknown asset pair'):
+        # the backfill loop of `main.produce_trades`
+        while not kraken_api.done():
+            kraken_api.get_trades()
+
+
+def test_done_raises_when_the_failed_worker_finishes_last(failing_eth_usd):
+    kraken_api = KrakenRestAPIMultipleProducts(
+        product_ids=['BTC/USD', 'ETH/USD'], last_n_days=1, n_threads=2
+    )
+    # all the pages are drained before we look at the workers again
+    for future in kraken_api._futures:
+        future.exception()
+    while not kraken_api._pages.empty():
+        kraken_api._pages.get_nowait()
+
+    with pytest.raises(KrakenRestAPIError, match='Unknown asset pair'):
+        kraken_api.done()
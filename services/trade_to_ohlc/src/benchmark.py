@@ -0,0 +1,153 @@
+"""
+Micro-benchmarks for the candle aggregation of `main.trade_to_ohlc`.
+
+Run them with `make benchmark`. They don't need a Kafka broker, because they only
+measure the per-trade work of the reducers and of the native engine, without the
+Quix Streams state store around them.
+"""
+
+from time import perf_counter
+from typing import Callable, List
+
+from bulk import BulkOHLC
+from candles import init_ohlc_candle, update_ohlc_candle
+from ohlc_engine import OHLCEngine
+
+N_TRADES = 500_000
+WINDOW_MS = 60_000
+
+# a few products trading a few times per second, as they come out of the
+# TradeDeserializer
+TRADES = [
+    {
+        'product_id': ('BTC/USD', 'ETH/USD', 'SOL/USD')[i % 3],
+        'price': 65000.0 + i % 100,
+        'volume': 0.001 * (i % 7 + 1),
+        'timestamp_ms': 1718616999467 + i * 100,
+        'trade_id': i,
+        'side': 'buy' if i % 2 else 'sell',
+    }
+    for i in range(N_TRADES)
+]
+
+
+def ohlc_only_reducer() -> None:
+    """
+    The previous reducer, which only tracked the prices and returned a new dict
+    for every trade.
+    """
+
+    def init(trade: dict) -> dict:
+        return {
+            'open': trade['price'],
+            'high': trade['price'],
+            'low': trade['price'],
+            'close': trade['price'],
+            'product_id': trade['product_id'],
+        }
+
+    def update(candle: dict, trade: dict) -> dict:
+        return {
+            'open': candle['open'],
+            'high': max(candle['high'], trade['price']),
+            'low': min(candle['low'], trade['price']),
+            'close': trade['price'],
+            'product_id': trade['product_id'],
+        }
+
+    reduce(init, update)
+
+
+def volume_reducer() -> None:
+    """
+    The current reducer, which also tracks volume, notional, trade count and the
+    buy / sell volume.
+    """
+    reduce(init_ohlc_candle, update_ohlc_candle)
+
+
+def reduce(init: Callable[[dict], dict], update: Callable[[dict, dict], dict]) -> None:
+    """
+    Feeds the trades to the given reducer, one tumbling window per product, like
+    `tumbling_window(...).reduce(...)` does
+    """
+    candles = {}
+    for trade in TRADES:
+        key = (
+            trade['product_id'],
+            trade['timestamp_ms'] - trade['timestamp_ms'] % WINDOW_MS,
+        )
+        candle = candles.get(key)
+        candles[key] = init(trade) if candle is None else update(candle, trade)
+
+
+# the same trades, as the tuples the native engine works with
+TRADE_TUPLES = [
+    (
+        trade['product_id'],
+        trade['price'],
+        trade['volume'],
+        trade['timestamp_ms'],
+        trade['side'],
+        # the offset of the trade in its partition
+        i,
+    )
+    for i, trade in enumerate(TRADES)
+]
+
+
+def native_engine() -> None:
+    """
+    The native engine, in micro-batches of 10k trades
+    """
+    engine = OHLCEngine(window_ms=WINDOW_MS)
+    for i in range(0, N_TRADES, 10_000):
+        engine.update(TRADE_TUPLES[i : i + 10_000])
+
+
+# the same trades, as the columns the bulk backfill works with
+TRADE_COLUMNS = {
+    column: [trade[i] for trade in TRADE_TUPLES]
+    for i, column in enumerate(
+        ['product_id', 'price', 'volume', 'timestamp_ms', 'side', 'offset']
+    )
+}
+
+
+def bulk_backfill() -> None:
+    """
+    The pandas backfill, in batches of 100k trades
+    """
+    bulk = BulkOHLC(window_secs=[WINDOW_MS // 1000])
+    for i in range(0, N_TRADES, 100_000):
+        bulk.update(
+            {
+                column: values[i : i + 100_000]
+                for column, values in TRADE_COLUMNS.items()
+            }
+        )
+
+
+def run(name: str, fn: Callable[[], None]) -> float:
+    """
+    Runs `fn` once and returns the number of trades it processed per second
+    """
+    start = perf_counter()
+    fn()
+    trades_per_sec = N_TRADES / (perf_counter() - start)
+    print(f'{name:<20} {trades_per_sec:>14,.0f} trades/sec')
+    return trades_per_sec
+
+
+def main(benchmarks: List[Callable[[], None]]) -> None:
+    """
+    Runs the given benchmarks one after the other and compares each of them with
+    the first one
+    """
+    results = [run(fn.__name__, fn) for fn in benchmarks]
+    for fn, result in zip(benchmarks[1:], results[1:]):
+        print(f'{fn.__name__} vs {benchmarks[0].__name__}: {result / results[0]:.2f}x')
+
+
+if __name__ == '__main__':
+    main([ohlc_only_reducer, volume_reducer, native_engine, bulk_backfill])
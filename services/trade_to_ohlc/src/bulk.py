@@ -0,0 +1,492 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from confluent_kafka import TopicPartition
+from loguru import logger
+from quixstreams import Application
+from quixstreams.kafka import Consumer
+from quixstreams.models.topics import Topic
+
+from indicators import IndicatorStage
+from ohlc_engine import ResumePoint, get_resume_points, get_resume_position
+from tracing import candle_trace_headers, get_ingest_ms
+from wire_format import parse_trade
+
+# the fields of the candles, in the order of the OHLC topic
+CANDLE_COLUMNS = [
+    'timestamp',
+    'open',
+    'high',
+    'low',
+    'close',
+    'product_id',
+    'volume',
+    'notional',
+    'trade_count',
+    'buy_volume',
+    'sell_volume',
+    'vwap',
+    'is_synthetic',
+]
+
+
+# the oldest possible window start, for the products without a floor or a candle
+NO_WINDOW = np.iinfo(np.int64).min
+
+
+class BulkOHLC:
+    """
+    Builds the candles of several resolutions out of large batches of the trades
+    of one partition, with a vectorized group-by over (product, window start) for
+    each resolution, for backfills.
+
+    Like `OHLCEngine`, each product has a slot, here an index in numpy arrays, so
+    the group-bys and the lookups of the state of each trade work on integers.
+
+    The trades of the open window of the coarsest resolution of each product are
+    carried over to the next batch, and trades of older windows in a later batch
+    are dropped as late, like the native engine does without allowed lateness.
+    Trades that arrive out of order within a batch are added to their candle.
+    """
+
+    def __init__(
+        self,
+        window_secs: List[int],
+        fill_gaps: bool = False,
+        resume_points: Optional[Dict[str, ResumePoint]] = None,
+        indicators: Optional[dict] = None,
+    ) -> None:
+        """
+        Args:
+            window_secs (List[int]): The resolutions, in seconds.
+            fill_gaps (bool): Whether we emit synthetic candles for the windows
+                without trades.
+            resume_points (Optional[Dict[str, ResumePoint]]): The resume points
+                committed for the partition, if we don't start from its beginning.
+            indicators (Optional[dict]): The settings of the `IndicatorStage` that
+                adds the indicators to the candles, or None to not add them.
+
+        Returns:
+            None
+        """
+        self.window_secs = sorted(window_secs)
+        self.fill_gaps = fill_gaps
+        self.indicators = (
+            IndicatorStage(**indicators) if indicators is not None else None
+        )
+        self._resume_points = dict(resume_points or {})
+
+        # {product_id: slot}
+        self._slots: Dict[str, int] = {}
+        self._product_ids: List[str] = []
+
+        # the state of each slot:
+        # the offset of the first trade we haven't produced a candle of yet
+        self._resume_offsets = np.zeros(0, dtype=np.int64)
+        # the start of the open window of the coarsest resolution, the trades of
+        # older windows are late
+        self._floor_ms = np.zeros(0, dtype=np.int64)
+        # {window_sec: start of the last window we emitted}, because the trades we
+        # carry over also span finer windows we already emitted
+        self._last_window = {
+            window_sec: np.zeros(0, dtype=np.int64) for window_sec in self.window_secs
+        }
+        # {window_sec: close of the last candle we emitted}, for the synthetic
+        # candles after it
+        self._last_close = {
+            window_sec: np.zeros(0) for window_sec in self.window_secs
+        }
+
+        for product_id, (offset, floor_ms) in self._resume_points.items():
+            slot = self._add_product(product_id)
+            self._resume_offsets[slot] = offset
+            self._floor_ms[slot] = floor_ms
+
+        # the trades of the open windows
+        self._carry: Optional[pd.DataFrame] = None
+
+        self.n_late_trades = 0
+
+    def update(self, trades: Dict[str, list]) -> List[dict]:
+        """
+        Adds a batch of trades and returns the candles of every resolution they
+        close.
+
+        Args:
+            trades (Dict[str, list]): The columns of the trades, 'product_id',
+                'price', 'volume', 'timestamp_ms', 'side' and 'offset', in the order
+                they were consumed.
+
+        Returns:
+            List[dict]: The closed candles, tagged with their `window_sec`.
+        """
+        slots = self._slots
+        for product_id in set(trades['product_id']).difference(slots):
+            self._add_product(product_id)
+        slot = np.array([slots[product_id] for product_id in trades['product_id']])
+
+        price = np.array(trades['price'], dtype=np.float64)
+        volume = np.array(trades['volume'], dtype=np.float64)
+        side = np.array(trades['side'], dtype=object)
+        df = pd.DataFrame(
+            {
+                'slot': slot,
+                'price': price,
+                'volume': volume,
+                'notional': price * volume,
+                'timestamp_ms': np.array(trades['timestamp_ms'], dtype=np.int64),
+                'buy_volume': np.where(side == 'buy', volume, 0.0),
+                'sell_volume': np.where(side == 'sell', volume, 0.0),
+                'offset': np.array(trades['offset'], dtype=np.int64),
+            }
+        )
+
+        # the trades before the resume point of their product are already in the
+        # candles we produced
+        is_new = df['offset'].to_numpy() >= self._resume_offsets[slot]
+        is_late = df['timestamp_ms'].to_numpy() < self._floor_ms[slot]
+        self.n_late_trades += int((is_new & is_late).sum())
+        df = df[is_new & ~is_late]
+
+        if self._carry is not None:
+            df = pd.concat([self._carry, df], ignore_index=True)
+        if df.empty:
+            return []
+
+        slot = df['slot'].to_numpy()
+        timestamp_ms = df['timestamp_ms'].to_numpy()
+        candles = []
+        for window_sec in self.window_secs:
+            window_ms = window_sec * 1000
+            window = timestamp_ms - timestamp_ms % window_ms
+            # the latest window of each product is still open
+            open_windows = np.full(len(self._product_ids), NO_WINDOW)
+            np.maximum.at(open_windows, slot, window)
+            is_closed = window < open_windows[slot]
+            candles += self._aggregate(
+                df[is_closed].assign(window=window[is_closed]),
+                window_sec,
+                open_windows,
+            )
+
+        # the open windows of the coarsest resolution contain those of the others
+        self._carry = df[~is_closed]
+        has_trades = open_windows != NO_WINDOW
+        self._floor_ms[has_trades] = open_windows[has_trades]
+
+        if self.indicators is not None:
+            # the candles of each product and resolution are in time order
+            for candle in candles:
+                self.indicators.add_indicators(candle)
+        return candles
+
+    def resume_points(self) -> Dict[str, ResumePoint]:
+        """
+        Returns, for each product, the offset of the first trade we carry over and
+        the start of its open window of the coarsest resolution, in the format of
+        `MultiResolutionOHLC.resume_points`, so the native engine can take over.
+        """
+        points = dict(self._resume_points)
+        if self._carry is not None and not self._carry.empty:
+            offsets = self._carry.groupby('slot')['offset'].min()
+            for slot, offset in offsets.items():
+                points[self._product_ids[slot]] = (
+                    int(offset),
+                    int(self._floor_ms[slot]),
+                )
+        return points
+
+    def _aggregate(
+        self, trades: pd.DataFrame, window_sec: int, open_windows: np.ndarray
+    ) -> List[dict]:
+        """
+        Returns the candles of `window_sec` of the `trades` of closed windows, in
+        time order for each product, without the ones we already emitted. The
+        start of the open window of each slot is in `open_windows`.
+        """
+        if trades.empty:
+            return []
+        window_ms = window_sec * 1000
+        last_window = self._last_window[window_sec]
+        last_close = self._last_close[window_sec]
+
+        candles = (
+            trades.groupby(['slot', 'window'])
+            .agg(
+                open=('price', 'first'),
+                high=('price', 'max'),
+                low=('price', 'min'),
+                close=('price', 'last'),
+                volume=('volume', 'sum'),
+                notional=('notional', 'sum'),
+                trade_count=('price', 'size'),
+                buy_volume=('buy_volume', 'sum'),
+                sell_volume=('sell_volume', 'sum'),
+            )
+            .reset_index()
+        )
+        candles = candles[
+            candles['window'].to_numpy() > last_window[candles['slot'].to_numpy()]
+        ]
+        if candles.empty:
+            return []
+
+        if self.fill_gaps:
+            candles = self._fill_gaps(candles, window_sec, open_windows)
+        else:
+            candles['is_synthetic'] = False
+
+        candles['timestamp'] = candles['window'] + window_ms
+        # like `candles.vwap`, None for a candle without volume, except the
+        # synthetic ones, which trade at their close
+        vwap = (candles['notional'] / candles['volume']).astype(object)
+        candles['vwap'] = vwap.where(candles['volume'] > 0, None).where(
+            ~candles['is_synthetic'], candles['close']
+        )
+        candles['product_id'] = np.array(self._product_ids, dtype=object)[
+            candles['slot'].to_numpy()
+        ]
+
+        # the candles are sorted by slot and window, so the last one of each slot
+        # is its latest
+        is_latest = ~candles['slot'].duplicated(keep='last').to_numpy()
+        latest_slots = candles['slot'].to_numpy()[is_latest]
+        last_window[latest_slots] = candles['window'].to_numpy()[is_latest]
+        last_close[latest_slots] = candles['close'].to_numpy()[is_latest]
+
+        return candles[CANDLE_COLUMNS].assign(window_sec=window_sec).to_dict('records')
+
+    def _fill_gaps(
+        self, candles: pd.DataFrame, window_sec: int, open_windows: np.ndarray
+    ) -> pd.DataFrame:
+        """
+        Adds synthetic candles for the windows without trades of each product,
+        from the last candle we emitted for it, or its first candle, up to its
+        open window, like `OHLCEngine` does when a trade opens a later window.
+        """
+        window_ms = window_sec * 1000
+        last_window = self._last_window[window_sec]
+
+        slots = []
+        windows = []
+        first_windows = candles.groupby('slot')['window'].min()
+        for slot, first_ms in first_windows.items():
+            if last_window[slot] != NO_WINDOW:
+                first_ms = last_window[slot] + window_ms
+            slot_windows = np.arange(first_ms, open_windows[slot], window_ms)
+            slots.append(np.full(len(slot_windows), slot))
+            windows.append(slot_windows)
+
+        candles = candles.set_index(['slot', 'window']).reindex(
+            pd.MultiIndex.from_arrays(
+                [np.concatenate(slots), np.concatenate(windows)],
+                names=['slot', 'window'],
+            )
+        )
+        is_synthetic = candles['trade_count'].isna()
+
+        # nothing was traded, so the prices stay at the previous close
+        close = candles['close'].groupby(level='slot').ffill()
+        previous_close = self._last_close[window_sec][
+            candles.index.get_level_values('slot').to_numpy()
+        ]
+        close = close.fillna(pd.Series(previous_close, index=candles.index))
+        for column in ['open', 'high', 'low', 'close']:
+            candles[column] = candles[column].where(~is_synthetic, close)
+        for column in ['volume', 'notional', 'buy_volume', 'sell_volume']:
+            candles[column] = candles[column].fillna(0.0)
+        candles['trade_count'] = candles['trade_count'].fillna(0).astype(int)
+        candles['is_synthetic'] = is_synthetic
+
+        return candles.reset_index()
+
+    def _add_product(self, product_id: str) -> int:
+        """
+        Gives `product_id` a slot in the state arrays
+        """
+        slot = len(self._product_ids)
+        self._slots[product_id] = slot
+        self._product_ids.append(product_id)
+
+        self._resume_offsets = np.append(self._resume_offsets, 0)
+        self._floor_ms = np.append(self._floor_ms, NO_WINDOW)
+        for window_sec in self.window_secs:
+            self._last_window[window_sec] = np.append(
+                self._last_window[window_sec], NO_WINDOW
+            )
+            self._last_close[window_sec] = np.append(
+                self._last_close[window_sec], np.nan
+            )
+        return slot
+
+
+def run_bulk_ohlc(
+    app: Application,
+    input_topic: Topic,
+    output_topics: Dict[int, Topic],
+    tag_window_sec: bool,
+    batch_size: int,
+    fill_gaps: bool = False,
+    indicators: Optional[dict] = None,
+) -> Dict[int, IndicatorStage]:
+    """
+    Backfills the candles of the trades already in `input_topic`, in large batches
+    aggregated by `BulkOHLC`, and returns when it reaches the live edge, i.e. the
+    end each partition had when it was assigned to us, or when no more trades
+    arrive.
+
+    The offsets are committed like the native engine does, with the resume points
+    of the products in the metadata, so `run_native_ohlc` takes over from there
+    and rebuilds the open candles from the trades we carried over.
+
+    Args:
+        app (Application): The Quix Streams application, which configures the
+            consumer and the producer.
+        input_topic (Topic): The topic with the trades.
+        output_topics (Dict[int, Topic]): The topic where we produce the candles of
+            each resolution, in seconds.
+        tag_window_sec (bool): Whether we keep the `window_sec` field of the
+            candles.
+        batch_size (int): The number of trades we aggregate at once.
+        fill_gaps (bool): Whether we produce synthetic candles for the windows
+            without trades.
+        indicators (Optional[dict]): The settings of the `IndicatorStage` that adds
+            the technical indicators to the candles, or None to not add them.
+
+    Returns:
+        Dict[int, IndicatorStage]: The indicators of each partition we still have,
+            for `run_native_ohlc` to continue with.
+    """
+    aggregators: Dict[int, BulkOHLC] = {}
+    # the end of each partition when it was assigned to us
+    live_edges: Dict[int, int] = {}
+    # the offset of the next trade of each partition
+    next_offsets: Dict[int, int] = {}
+
+    def on_assign(consumer: Consumer, partitions: List[TopicPartition]) -> None:
+        for partition in partitions:
+            _, high = consumer.get_watermark_offsets(partition, timeout=10)
+            live_edges[partition.partition] = high
+
+    def on_revoke(consumer: Consumer, partitions: List[TopicPartition]) -> None:
+        for partition in partitions:
+            live_edges.pop(partition.partition, None)
+            aggregators.pop(partition.partition, None)
+            next_offsets.pop(partition.partition, None)
+
+    with app.get_consumer() as consumer, app.get_producer() as producer:
+        consumer.subscribe(
+            [input_topic.name],
+            on_assign=on_assign,
+            on_revoke=on_revoke,
+            on_lost=on_revoke,
+        )
+
+        n_trades = 0
+        while True:
+            # the columns of the trades of each partition
+            batches: Dict[int, Dict[str, list]] = {}
+            # the ingest time of the oldest trade of each partition, for the trace
+            # headers of the candles, like the native engine
+            ingest_ms: Dict[int, Optional[int]] = {}
+            is_idle = False
+            for _ in range(batch_size):
+                message = consumer.poll(1)
+                if message is None:
+                    is_idle = True
+                    break
+                if message.error():
+                    logger.error(f'Failed to consume a message: {message.error()}')
+                    continue
+
+                partition = message.partition()
+                if partition not in live_edges:
+                    # fetched before the partition was revoked
+                    continue
+                batch = batches.get(partition)
+                if batch is None:
+                    batch = batches[partition] = {
+                        'product_id': [],
+                        'price': [],
+                        'volume': [],
+                        'timestamp_ms': [],
+                        'side': [],
+                        'offset': [],
+                    }
+                    ingest_ms[partition] = get_ingest_ms(message.headers())
+                trade = parse_trade(message.value())
+                batch['product_id'].append(trade['product_id'])
+                batch['price'].append(trade['price'])
+                batch['volume'].append(trade['volume'])
+                batch['timestamp_ms'].append(trade['timestamp_ms'])
+                batch['side'].append(trade.get('side'))
+                batch['offset'].append(message.offset())
+                next_offsets[partition] = message.offset() + 1
+
+            positions = []
+            for partition, batch in batches.items():
+                aggregator = aggregators.get(partition)
+                if aggregator is None:
+                    aggregator = aggregators[partition] = BulkOHLC(
+                        window_secs=list(output_topics),
+                        fill_gaps=fill_gaps,
+                        resume_points=get_resume_points(
+                            consumer, input_topic.name, partition
+                        ),
+                        indicators=indicators,
+                    )
+
+                for candle in aggregator.update(batch):
+                    window_sec = candle['window_sec']
+                    if not tag_window_sec:
+                        del candle['window_sec']
+                    output_topic = output_topics[window_sec]
+                    kafka_message = output_topic.serialize(
+                        key=candle['product_id'], value=candle
+                    )
+                    producer.produce(
+                        topic=output_topic.name,
+                        key=kafka_message.key,
+                        value=kafka_message.value,
+                        headers=candle_trace_headers(ingest_ms[partition]),
+                        timestamp=candle['timestamp'] - window_sec * 1000,
+                    )
+
+                positions.append(
+                    get_resume_position(
+                        input_topic.name, partition, aggregator.resume_points()
+                    )
+                )
+                n_trades += len(batch['offset'])
+
+            # the candles must be in Kafka before we commit the trades they were
+            # built from
+            producer.flush()
+            if positions:
+                consumer.store_offsets(offsets=positions)
+                logger.info(f'Backfilled {n_trades} trades')
+
+            if live_edges and (
+                is_idle
+                or all(
+                    next_offsets.get(partition, 0) >= live_edge
+                    for partition, live_edge in live_edges.items()
+                )
+            ):
+                break
+
+        # the native engine starts from these offsets right away
+        consumer.commit(asynchronous=False)
+        n_late_trades = sum(
+            aggregator.n_late_trades for aggregator in aggregators.values()
+        )
+        logger.info(
+            f'Reached the live edge after {n_trades} trades '
+            f'({n_late_trades} late trades dropped), switching to streaming'
+        )
+    return {
+        partition: aggregator.indicators
+        for partition, aggregator in aggregators.items()
+        if aggregator.indicators is not None
+    }
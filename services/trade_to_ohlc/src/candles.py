@@ -0,0 +1,181 @@
+from typing import List, Optional
+
+
+def init_ohlc_candle(trade: dict) -> dict:
+    """
+    Initialize the OHLC candle with the first trade
+    """
+    volume = trade['volume']
+    side = trade.get('side')
+    return {
+        'open': trade['price'],
+        'high': trade['price'],
+        'low': trade['price'],
+        'close': trade['price'],
+        'product_id': trade['product_id'],
+        'volume': volume,
+        # sum of price * volume, to compute the VWAP when the candle closes
+        'notional': trade['price'] * volume,
+        'trade_count': 1,
+        # volume of the trades where the taker was the buyer / the seller
+        'buy_volume': volume if side == 'buy' else 0.0,
+        'sell_volume': volume if side == 'sell' else 0.0,
+    }
+
+
+def update_ohlc_candle(ohlc_candle: dict, trade: dict) -> dict:
+    """
+    Update the OHLC candle with the new trade and return the updated candle
+
+    The candle is updated in place, which is safe because Quix Streams gives us a
+    fresh copy of the window state for every trade, and it saves us a new dict
+    per trade.
+
+    Args:
+        ohlc_candle : dict : The current OHLC candle
+        trade : dict : The incoming trade
+
+    Returns:
+        dict : The updated OHLC candle
+    """
+    price = trade['price']
+    volume = trade['volume']
+
+    if price > ohlc_candle['high']:
+        ohlc_candle['high'] = price
+    elif price < ohlc_candle['low']:
+        ohlc_candle['low'] = price
+    ohlc_candle['close'] = price
+
+    ohlc_candle['volume'] += volume
+    ohlc_candle['notional'] += price * volume
+    ohlc_candle['trade_count'] += 1
+
+    side = trade.get('side')
+    if side == 'buy':
+        ohlc_candle['buy_volume'] += volume
+    elif side == 'sell':
+        ohlc_candle['sell_volume'] += volume
+
+    return ohlc_candle
+
+
+def merge_candles(candle: dict, finer_candle: dict) -> None:
+    """
+    Adds `finer_candle`, the next candle in time of a finer resolution, to the
+    coarser `candle`, in place.
+
+    Synthetic candles carry no trades, so they only count when all the finer
+    candles are synthetic, and the coarse candle is then synthetic as well.
+    """
+    if finer_candle.get('is_synthetic'):
+        return
+    if candle.get('is_synthetic'):
+        # the first trades of the coarse candle
+        candle.update({**finer_candle, 'timestamp': candle['timestamp']})
+        return
+
+    candle['high'] = max(candle['high'], finer_candle['high'])
+    candle['low'] = min(candle['low'], finer_candle['low'])
+    candle['close'] = finer_candle['close']
+
+    candle['volume'] += finer_candle['volume']
+    candle['notional'] += finer_candle['notional']
+    candle['trade_count'] += finer_candle['trade_count']
+    candle['buy_volume'] += finer_candle['buy_volume']
+    candle['sell_volume'] += finer_candle['sell_volume']
+    candle['vwap'] = vwap(candle)
+
+
+def add_late_trade(
+    candle: dict, price: float, volume: float, side: Optional[str]
+) -> None:
+    """
+    Adds a trade that arrived after `candle` was closed to it, in place.
+
+    We don't know where the late trade falls between the other trades of the
+    candle, so it only changes the high, the low and the volume based fields, and
+    the open and close stay as they are.
+    """
+    if price > candle['high']:
+        candle['high'] = price
+    elif price < candle['low']:
+        candle['low'] = price
+
+    candle['volume'] += volume
+    candle['notional'] += price * volume
+    candle['trade_count'] += 1
+    if side == 'buy':
+        candle['buy_volume'] += volume
+    elif side == 'sell':
+        candle['sell_volume'] += volume
+    candle['vwap'] = vwap(candle)
+
+
+def rebuild_candle(finer_candles: List[dict], timestamp: int) -> dict:
+    """
+    Builds a coarse candle, ending at `timestamp`, from all its finer candles.
+
+    Args:
+        finer_candles (List[dict]): The finer candles, sorted by timestamp.
+        timestamp (int): The end of the coarse window.
+
+    Returns:
+        dict: The coarse candle.
+    """
+    candle = {**finer_candles[0], 'timestamp': timestamp}
+    for finer_candle in finer_candles[1:]:
+        merge_candles(candle, finer_candle)
+    return candle
+
+
+def synthetic_candles(
+    previous_candle: dict, timestamp: int, window_ms: int
+) -> List[dict]:
+    """
+    Returns flat candles for the empty windows between `previous_candle` and the
+    candle ending at `timestamp`, of the same product.
+
+    Nothing was traded in them, so their prices are the close of
+    `previous_candle`, the same as `interpolate_missing_candles` fills in, their
+    volume is 0 and they are marked with `is_synthetic`.
+
+    Args:
+        previous_candle (dict): The last candle before the gap.
+        timestamp (int): The end of the window of the first candle after the gap.
+        window_ms (int): The size of the candles, in milliseconds.
+
+    Returns:
+        List[dict]: The synthetic candles, in time order.
+    """
+    close = previous_candle['close']
+    return [
+        {
+            'timestamp': candle_timestamp,
+            'open': close,
+            'high': close,
+            'low': close,
+            'close': close,
+            'product_id': previous_candle['product_id'],
+            'volume': 0.0,
+            'notional': 0.0,
+            'vwap': close,
+            'trade_count': 0,
+            'buy_volume': 0.0,
+            'sell_volume': 0.0,
+            'is_synthetic': True,
+        }
+        for candle_timestamp in range(
+            previous_candle['timestamp'] + window_ms, timestamp, window_ms
+        )
+    ]
+
+
+def vwap(candle: dict) -> Optional[float]:
+    """
+    Returns the volume-weighted average price of the candle, or None if it has no
+    volume
+    """
+    if not candle['volume']:
+        return None
+    return candle['notional'] / candle['volume']
@@ -1,5 +1,6 @@
 #import os
-from typing import Optional
+from typing import List, Optional
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
 class Config(BaseSettings):
@@ -11,6 +12,55 @@ class Config(BaseSettings):
         kafka_input_topic (str): The name of the Kafka topic where the trade data is read from.
         kafka_output_topic (str): The name of the Kafka topic where the OHLC data is written to.
         ohlc_window_seconds (int): The window size in seconds for OHLC aggregation.
+        aggregation_engine (str): 'quix' to aggregate with Quix Streams windows, or
+            'native' to use our own array-based engine (see ohlc_engine.py).
+        ohlc_window_seconds_list (List[int]): Several window sizes in seconds, e.g.
+            [10, 60, 300, 3600], to build all of them in one pass (native engine
+            only). Each must be a multiple of the previous one, because coarser
+            candles are built from finer ones.
+        ohlc_tag_window_sec (bool): With several window sizes, whether we write all
+            the candles to `kafka_output_topic` with a `window_sec` field, or the
+            candles of each size to their own topic `{kafka_output_topic}_{size}s`.
+            The feature group keys on `window_sec`, so it keeps both resolutions.
+        native_batch_size (int): The maximum number of trades the native engine
+            processes at once.
+        native_batch_timeout_sec (float): How long the native engine waits for
+            the first trade of a batch.
+        ohlc_allowed_lateness_ms (int): How late, after the end of its window, a
+            trade is still added to its candle. The Quix Streams windows wait that
+            long before emitting the candle. The native engine emits it right away
+            and emits a corrected candle, with the same product_id and timestamp,
+            when a late trade arrives.
+        ohlc_max_closed_windows (int): The maximum number of closed candles the
+            native engine keeps per product and resolution for late trades.
+        ohlc_fill_gaps (bool): Whether we emit a synthetic flat candle, marked
+            with `is_synthetic`, for each window without trades of a product, so
+            the candles downstream have no gaps.
+        kafka_auto_offset_reset (str): Where a new consumer group starts reading
+            the trades, 'latest' for real-time processing or 'earliest' to read
+            all the trades in the topic, e.g. for backfilling or a load test.
+        state_dir (str): Where the Quix Streams windows keep their local state.
+            It is restored from its changelog topic when a partition moves to
+            another replica, so the replicas don't need to share it.
+        ohlc_snapshot_interval_sec (float): How often the native engine writes a
+            snapshot of its state to the compacted topic
+            `{kafka_consumer_group}_snapshots`, so it restarts from the snapshot
+            instead of reading again all the trades of its open candles. 0 turns
+            the snapshots off.
+        ohlc_bulk_mode (bool): Whether the native engine starts with a backfill of
+            all the trades already in the topic, aggregated in large batches with
+            pandas (see bulk.py), before it switches to streaming at the live edge.
+        ohlc_bulk_batch_size (int): The number of trades the backfill aggregates
+            at once.
+        ohlc_indicators (bool): Whether we add the technical indicators of the
+            price_predictor features, `rsi`, `momentum`, `std`, `MACD` and
+            `MACD_Signal`, to the candles, updated incrementally with each candle
+            (see indicators.py). They are None until enough candles were seen.
+        ohlc_rsi_timeperiod (int): The time period of the RSI, in candles.
+        ohlc_momentum_timeperiod (int): The time period of the momentum, in
+            candles.
+        ohlc_volatility_timeperiod (int): The time period of the standard
+            deviation, in candles.
 
     Values are read from environment variables.
     If they are not found there, default values are used.
@@ -21,6 +71,82 @@ class Config(BaseSettings):
     kafka_output_topic: str
     kafka_consumer_group: str
     ohlc_window_seconds: int
+    aggregation_engine: Optional[str] = 'quix'
+    ohlc_window_seconds_list: Optional[List[int]] = None
+    ohlc_tag_window_sec: Optional[bool] = False
+    native_batch_size: Optional[int] = 10_000
+    native_batch_timeout_sec: Optional[float] = 0.5
+    ohlc_allowed_lateness_ms: Optional[int] = 0
+    ohlc_max_closed_windows: Optional[int] = 1_000
+    ohlc_fill_gaps: Optional[bool] = True
+    kafka_auto_offset_reset: Optional[str] = 'latest'
+    state_dir: Optional[str] = 'state'
+    ohlc_snapshot_interval_sec: Optional[float] = 30.0
+    ohlc_bulk_mode: Optional[bool] = False
+    ohlc_bulk_batch_size: Optional[int] = 500_000
+    ohlc_indicators: Optional[bool] = False
+    ohlc_rsi_timeperiod: Optional[int] = 14
+    ohlc_momentum_timeperiod: Optional[int] = 14
+    ohlc_volatility_timeperiod: Optional[int] = 5
+
+    @field_validator('aggregation_engine')
+    @classmethod
+    def validate_aggregation_engine(cls, value):
+        assert value in {
+            'quix',
+            'native',
+        }, f'Invalid value for aggregation_engine: {value}'
+        return value
+
+    @field_validator('ohlc_window_seconds_list')
+    @classmethod
+    def validate_ohlc_window_seconds_list(cls, value):
+        if value is not None:
+            value = sorted(value)
+            for finer, coarser in zip(value, value[1:]):
+                assert (
+                    coarser % finer == 0
+                ), f'{coarser}s candles can\'t be built from {finer}s candles'
+        return value
+
+    @field_validator('ohlc_allowed_lateness_ms')
+    @classmethod
+    def validate_ohlc_allowed_lateness_ms(cls, value):
+        assert value >= 0, f'Invalid value for ohlc_allowed_lateness_ms: {value}'
+        return value
+
+
+    @field_validator('kafka_auto_offset_reset')
+    @classmethod
+    def validate_kafka_auto_offset_reset(cls, value):
+        assert value in {
+            'earliest',
+            'latest',
+        }, f'Invalid value for kafka_auto_offset_reset: {value}'
+        return value
+
+
+    @field_validator('ohlc_snapshot_interval_sec')
+    @classmethod
+    def validate_ohlc_snapshot_interval_sec(cls, value):
+        assert value >= 0, f'Invalid value for ohlc_snapshot_interval_sec: {value}'
+        return value
+
+
+    @field_validator('ohlc_bulk_batch_size')
+    @classmethod
+    def validate_ohlc_bulk_batch_size(cls, value):
+        assert value > 0, f'Invalid value for ohlc_bulk_batch_size: {value}'
+        return value
+
+
+    @field_validator(
+        'ohlc_rsi_timeperiod', 'ohlc_momentum_timeperiod', 'ohlc_volatility_timeperiod'
+    )
+    @classmethod
+    def validate_indicator_timeperiod(cls, value, info):
+        assert value > 0, f'Invalid value for {info.field_name}: {value}'
+        return value
 
 
 config = Config()
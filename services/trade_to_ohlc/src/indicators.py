@@ -0,0 +1,510 @@
+from collections import deque
+from copy import deepcopy
+from math import sqrt
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Incremental versions of the technical indicators `add_features` computes with
+# talib in the price_predictor, so we can add them to each candle as we emit it,
+# in O(1) per candle, instead of recomputing them over the whole history.
+#
+# Each indicator follows the talib algorithm, including how it warms up, so over
+# the same candles it gives the same values: None until it has seen enough
+# candles, where talib gives NaN.
+#
+# The latest value of an indicator can be replaced, when the candle it was
+# computed from is corrected by late trades or emitted again, by undoing its
+# last update, for which each indicator keeps what it needs. The values of the
+# older candles that can still be corrected are computed again from the closes
+# we keep since the oldest of them.
+
+# the columns we add to the candles, as `add_features` names them
+INDICATOR_COLUMNS = ['rsi', 'momentum', 'std', 'MACD', 'MACD_Signal']
+
+
+class EMA:
+    """
+    Exponential moving average, seeded with the simple average of the first
+    `timeperiod` values, like talib.EMA
+    """
+
+    def __init__(self, timeperiod: int) -> None:
+        self.timeperiod = timeperiod
+        self.value: Optional[float] = None
+        # the values before the first average
+        self.seed: List[float] = []
+        self.previous_value: Optional[float] = None
+
+    def update(self, value: float) -> Optional[float]:
+        self.previous_value = self.value
+        if self.value is not None:
+            self.value += (value - self.value) * 2 / (self.timeperiod + 1)
+        else:
+            self.seed.append(value)
+            if len(self.seed) == self.timeperiod:
+                self.value = sum(self.seed) / self.timeperiod
+        return self.value
+
+    def undo(self) -> None:
+        if self.previous_value is None:
+            # the last value went to the seed
+            self.seed.pop()
+        self.value = self.previous_value
+
+
+class RSI:
+    """
+    Relative Strength Index with Wilder's smoothing, seeded with the simple
+    averages of the first `timeperiod` gains and losses, like talib.RSI
+    """
+
+    def __init__(self, timeperiod: int) -> None:
+        self.timeperiod = timeperiod
+        self.last_close: Optional[float] = None
+        self.n_changes = 0
+        # the sums of the gains and losses until the first averages
+        self.avg_gain = 0.0
+        self.avg_loss = 0.0
+        self.previous: Optional[Tuple[Optional[float], int, float, float]] = None
+
+    def update(self, close: float) -> Optional[float]:
+        self.previous = (self.last_close, self.n_changes, self.avg_gain, self.avg_loss)
+        last_close = self.last_close
+        self.last_close = close
+        if last_close is None:
+            return None
+
+        change = close - last_close
+        gain = change if change > 0 else 0.0
+        loss = -change if change < 0 else 0.0
+        n = self.timeperiod
+        self.n_changes += 1
+        if self.n_changes < n:
+            self.avg_gain += gain
+            self.avg_loss += loss
+            return None
+        if self.n_changes == n:
+            self.avg_gain = (self.avg_gain + gain) / n
+            self.avg_loss = (self.avg_loss + loss) / n
+        else:
+            self.avg_gain = (self.avg_gain * (n - 1) + gain) / n
+            self.avg_loss = (self.avg_loss * (n - 1) + loss) / n
+
+        total = self.avg_gain + self.avg_loss
+        return 100 * self.avg_gain / total if total else 0.0
+
+    def undo(self) -> None:
+        self.last_close, self.n_changes, self.avg_gain, self.avg_loss = self.previous
+
+
+class Momentum:
+    """
+    Difference between the latest close and the close `timeperiod` candles
+    before, like talib.MOM
+    """
+
+    def __init__(self, timeperiod: int) -> None:
+        self.timeperiod = timeperiod
+        self.closes: Deque[float] = deque()
+        # the close that left the window with the last update
+        self.dropped: Optional[float] = None
+
+    def update(self, close: float) -> Optional[float]:
+        self.closes.append(close)
+        self.dropped = None
+        if len(self.closes) > self.timeperiod + 1:
+            self.dropped = self.closes.popleft()
+        if len(self.closes) <= self.timeperiod:
+            return None
+        return close - self.closes[0]
+
+    def undo(self) -> None:
+        self.closes.pop()
+        if self.dropped is not None:
+            self.closes.appendleft(self.dropped)
+
+
+class RollingStd:
+    """
+    Population standard deviation of the last `timeperiod` closes, times `nbdev`,
+    like talib.STDDEV, with the mean and the sum of squared deviations updated
+    as closes enter and leave the window (Welford's algorithm)
+    """
+
+    def __init__(self, timeperiod: int, nbdev: float = 1) -> None:
+        self.timeperiod = timeperiod
+        self.nbdev = nbdev
+        self.closes: Deque[float] = deque()
+        self.mean = 0.0
+        # the sum of the squared deviations from the mean
+        self.m2 = 0.0
+        self.dropped: Optional[float] = None
+        self.previous: Tuple[float, float] = (0.0, 0.0)
+
+    def update(self, close: float) -> Optional[float]:
+        self.previous = (self.mean, self.m2)
+        self.closes.append(close)
+        self.dropped = None
+        if len(self.closes) > self.timeperiod:
+            # the close that leaves the window is replaced by the new one
+            dropped = self.dropped = self.closes.popleft()
+            mean = self.mean
+            self.mean += (close - dropped) / self.timeperiod
+            self.m2 += (close - dropped) * (close - self.mean + dropped - mean)
+        else:
+            delta = close - self.mean
+            self.mean += delta / len(self.closes)
+            self.m2 += delta * (close - self.mean)
+
+        if len(self.closes) < self.timeperiod:
+            return None
+        variance = self.m2 / self.timeperiod
+        # the rounding errors can make a flat window slightly negative
+        return sqrt(variance) * self.nbdev if variance > 0 else 0.0
+
+    def undo(self) -> None:
+        self.closes.pop()
+        if self.dropped is not None:
+            self.closes.appendleft(self.dropped)
+        self.mean, self.m2 = self.previous
+
+
+class MACD:
+    """
+    Moving Average Convergence Divergence and its signal line, like talib.MACD.
+
+    As in talib, both averages start at the `slowperiod`-th close, so the fast
+    one is seeded with the last `fastperiod` of those closes, and the MACD is
+    only returned once its signal line is warmed up.
+    """
+
+    def __init__(
+        self, fastperiod: int = 12, slowperiod: int = 26, signalperiod: int = 9
+    ) -> None:
+        self.n_closes = 0
+        self.skip_fast = slowperiod - fastperiod
+        self.fast = EMA(fastperiod)
+        self.slow = EMA(slowperiod)
+        self.signal = EMA(signalperiod)
+
+    def update(self, close: float) -> Tuple[Optional[float], Optional[float]]:
+        self.n_closes += 1
+        if self.n_closes > self.skip_fast:
+            self.fast.update(close)
+        slow = self.slow.update(close)
+        if slow is None:
+            return None, None
+        macd = self.fast.value - slow
+        signal = self.signal.update(macd)
+        if signal is None:
+            return None, None
+        return macd, signal
+
+    def undo(self) -> None:
+        if self.slow.value is not None:
+            self.signal.undo()
+        self.slow.undo()
+        if self.n_closes > self.skip_fast:
+            self.fast.undo()
+        self.n_closes -= 1
+
+
+class CandleIndicators:
+    """
+    The indicators of the candles of one product and resolution, updated with
+    each candle in time order.
+    """
+
+    def __init__(
+        self,
+        rsi_timeperiod: int = 14,
+        momentum_timeperiod: int = 14,
+        volatility_timeperiod: int = 5,
+        max_recent: int = 1_000,
+    ) -> None:
+        """
+        Args:
+            rsi_timeperiod (int): The time period of the RSI.
+            momentum_timeperiod (int): The time period of the momentum.
+            volatility_timeperiod (int): The time period of the standard
+                deviation.
+            max_recent (int): How many of the latest values we keep, for the
+                older candles that are emitted again.
+
+        Returns:
+            None
+        """
+        self.rsi = RSI(rsi_timeperiod)
+        self.momentum = Momentum(momentum_timeperiod)
+        self.std = RollingStd(volatility_timeperiod)
+        self.macd = MACD()
+        self.max_recent = max_recent
+
+        # the timestamp of the latest candle
+        self.timestamp: Optional[int] = None
+        # {timestamp: indicators} of the latest candles
+        self._recent: Dict[int, dict] = {}
+
+        # {timestamp: close} of the latest candles that can still be corrected,
+        # and the indicators before the oldest of them, or None if we don't keep
+        # them because we did not see every candle
+        self._closes: Dict[int, float] = {}
+        self._base: Optional[CandleIndicators] = None
+
+    def update(
+        self, timestamp: int, close: float, max_correction_ms: Optional[int] = None
+    ) -> dict:
+        """
+        Returns the indicators of the candle ending at `timestamp`, with its
+        `close`.
+
+        A candle of the same timestamp as the latest one replaces it. An older
+        candle whose close changed, e.g. a synthetic candle late trades turned
+        into a real one, gets its indicators computed again, and so do the candles
+        after it. Otherwise the indicators of an older candle are the ones we
+        returned for it, if we still have them, or None.
+
+        Args:
+            timestamp (int): The end of the window of the candle.
+            close (float): The close of the candle.
+            max_correction_ms (Optional[int]): How far back from the latest candle
+                a candle can still be corrected, or None if candles are never
+                corrected.
+
+        Returns:
+            dict: The indicators of the candle.
+        """
+        if self.timestamp is not None and timestamp < self.timestamp:
+            if timestamp in self._closes and close != self._closes[timestamp]:
+                return self._recompute(timestamp, close)
+            return self._recent.get(timestamp) or dict.fromkeys(INDICATOR_COLUMNS)
+
+        if self.timestamp is None and max_correction_ms is not None:
+            # the indicators before the first candle, to replay the closes from
+            self._base = CandleIndicators(
+                rsi_timeperiod=self.rsi.timeperiod,
+                momentum_timeperiod=self.momentum.timeperiod,
+                volatility_timeperiod=self.std.timeperiod,
+                max_recent=1,
+            )
+
+        if timestamp == self.timestamp:
+            for indicator in (self.rsi, self.momentum, self.std, self.macd):
+                indicator.undo()
+        self.timestamp = timestamp
+
+        macd, macd_signal = self.macd.update(close)
+        indicators = {
+            'rsi': self.rsi.update(close),
+            'momentum': self.momentum.update(close),
+            'std': self.std.update(close),
+            'MACD': macd,
+            'MACD_Signal': macd_signal,
+        }
+
+        self._recent[timestamp] = indicators
+        if len(self._recent) > self.max_recent:
+            del self._recent[next(iter(self._recent))]
+
+        if self._base is not None and max_correction_ms is not None:
+            self._closes[timestamp] = close
+            # the candles that can't be corrected anymore move to the base
+            oldest_ms = next(iter(self._closes))
+            while oldest_ms < timestamp - max_correction_ms:
+                self._base.update(oldest_ms, self._closes.pop(oldest_ms))
+                oldest_ms = next(iter(self._closes))
+        return indicators
+
+    def _recompute(self, timestamp: int, close: float) -> dict:
+        """
+        Replaces the close of the older candle ending at `timestamp`, and computes
+        again the indicators of the candles from it to the latest one, by
+        replaying the closes we keep on a copy of the base.
+        """
+        self._closes[timestamp] = close
+        replayed = deepcopy(self._base)
+        for candle_timestamp, candle_close in self._closes.items():
+            values = replayed.update(candle_timestamp, candle_close)
+            if candle_timestamp == timestamp:
+                indicators = values
+            if candle_timestamp >= timestamp and candle_timestamp in self._recent:
+                self._recent[candle_timestamp] = values
+
+        # the replay ends with the latest candle, so it can still be undone
+        self.rsi = replayed.rsi
+        self.momentum = replayed.momentum
+        self.std = replayed.std
+        self.macd = replayed.macd
+        return indicators
+
+    def to_dict(self, recent_ms: int = 0) -> dict:
+        """
+        Returns the state of the indicators, as a dict that can be serialized to
+        JSON and given to `from_dict`.
+
+        Args:
+            recent_ms (int): How far back from the latest candle we keep the
+                values we returned, for the candles that may still be emitted
+                again.
+
+        Returns:
+            dict: The state of the indicators.
+        """
+        return {
+            'timestamp': self.timestamp,
+            'max_recent': self.max_recent,
+            'recent': [
+                [timestamp, indicators]
+                for timestamp, indicators in self._recent.items()
+                if timestamp >= self.timestamp - recent_ms
+            ],
+            'closes': list(self._closes.items()),
+            'base': self._base.to_dict() if self._base is not None else None,
+            **{
+                name: {
+                    key: list(value) if isinstance(value, deque) else value
+                    for key, value in vars(indicator).items()
+                }
+                for name, indicator in (
+                    ('rsi', self.rsi),
+                    ('momentum', self.momentum),
+                    ('std', self.std),
+                )
+            },
+            'macd': {
+                'n_closes': self.macd.n_closes,
+                'skip_fast': self.macd.skip_fast,
+                'fast': vars(self.macd.fast),
+                'slow': vars(self.macd.slow),
+                'signal': vars(self.macd.signal),
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'CandleIndicators':
+        """
+        Returns the indicators with the state from `to_dict`
+        """
+        indicators = cls(max_recent=state['max_recent'])
+        indicators.timestamp = state['timestamp']
+        indicators._recent = {
+            timestamp: values for timestamp, values in state.get('recent', [])
+        }
+        indicators._closes = {
+            timestamp: close for timestamp, close in state.get('closes', [])
+        }
+        if state.get('base') is not None:
+            indicators._base = cls.from_dict(state['base'])
+        for name in ('rsi', 'momentum', 'std'):
+            indicator = getattr(indicators, name)
+            for key, value in state[name].items():
+                if isinstance(getattr(indicator, key, None), deque):
+                    value = deque(value)
+                elif key == 'previous' and value is not None:
+                    value = tuple(value)
+                setattr(indicator, key, value)
+
+        macd = indicators.macd
+        macd.n_closes = state['macd']['n_closes']
+        macd.skip_fast = state['macd']['skip_fast']
+        for name in ('fast', 'slow', 'signal'):
+            vars(getattr(macd, name)).update(state['macd'][name])
+        return indicators
+
+
+class IndicatorStage:
+    """
+    Adds the indicators to the candles of every product and resolution, as they
+    are emitted.
+    """
+
+    def __init__(
+        self,
+        rsi_timeperiod: int = 14,
+        momentum_timeperiod: int = 14,
+        volatility_timeperiod: int = 5,
+    ) -> None:
+        """
+        Args:
+            rsi_timeperiod (int): The time period of the RSI.
+            momentum_timeperiod (int): The time period of the momentum.
+            volatility_timeperiod (int): The time period of the standard
+                deviation.
+
+        Returns:
+            None
+        """
+        self.settings = {
+            'rsi_timeperiod': rsi_timeperiod,
+            'momentum_timeperiod': momentum_timeperiod,
+            'volatility_timeperiod': volatility_timeperiod,
+        }
+        # {product_id: {window_sec: indicators}}
+        self._indicators: Dict[str, Dict[int, CandleIndicators]] = {}
+
+    def add_indicators(self, candle: dict, allowed_lateness_ms: int = 0) -> None:
+        """
+        Adds the indicators to `candle`, in place. The candle must be tagged with
+        its `window_sec`.
+
+        Args:
+            candle (dict): The candle.
+            allowed_lateness_ms (int): How long after the end of its window a
+                candle may still be corrected, so that we can compute its
+                indicators again.
+
+        Returns:
+            None
+        """
+        by_window = self._indicators.setdefault(candle['product_id'], {})
+        indicators = by_window.get(candle['window_sec'])
+        if indicators is None:
+            indicators = by_window[candle['window_sec']] = CandleIndicators(
+                **self.settings
+            )
+        candle.update(
+            indicators.update(
+                candle['timestamp'],
+                candle['close'],
+                max_correction_ms=candle['window_sec'] * 1000 + allowed_lateness_ms,
+            )
+        )
+
+    def snapshot(self, product_id: str, allowed_lateness_ms: int = 0) -> List[list]:
+        """
+        Returns the state of the indicators of `product_id`, as a list that can be
+        serialized to JSON and given to `restore`.
+
+        Args:
+            product_id (str): The product.
+            allowed_lateness_ms (int): How long after the end of its window a
+                candle may still be corrected, so that we keep its indicators.
+
+        Returns:
+            List[list]: The [window_sec, state] of each resolution.
+        """
+        return [
+            [
+                window_sec,
+                indicators.to_dict(
+                    recent_ms=window_sec * 1000 + allowed_lateness_ms
+                ),
+            ]
+            for window_sec, indicators in self._indicators.get(product_id, {}).items()
+        ]
+
+    def restore(self, product_id: str, snapshot: List[list]) -> None:
+        """
+        Restores the indicators of `product_id` from a `snapshot` of them
+        """
+        self._indicators[product_id] = {
+            window_sec: CandleIndicators.from_dict(state)
+            for window_sec, state in snapshot
+        }
+
+    def drop(self, product_ids: List[str]) -> None:
+        """
+        Forgets the indicators of `product_ids`, e.g. when their partition is
+        assigned to another replica
+        """
+        for product_id in product_ids:
+            self._indicators.pop(product_id, None)
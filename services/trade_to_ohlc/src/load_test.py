@@ -0,0 +1,194 @@
+"""
+Load test of the horizontal scaling of `trade_to_ohlc`.
+
+It writes synthetic trades to a new, partitioned, trades topic, with the products
+spread across the partitions like `trade_producer` does, and then runs the service
+with 1, 2, 4, ... replicas in the same consumer group, each time with a new
+consumer group and output topic, and reports how fast they turn the trades into
+candles.
+
+Run it with `make load-test`, against the broker in `KAFKA_BROKER_ADDRESS`.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, time
+from typing import List
+from uuid import uuid4
+
+from loguru import logger
+from quixstreams import Application
+from quixstreams.models.topics import TopicConfig
+
+
+def produce_trades(
+    app: Application,
+    topic_name: str,
+    n_partitions: int,
+    n_products: int,
+    n_windows: int,
+    trades_per_window: int,
+    window_sec: int,
+) -> None:
+    """
+    Creates the trades topic and writes `trades_per_window` trades per product in
+    each of `n_windows` consecutive windows, the product `i` to the partition
+    `i % n_partitions`.
+    """
+    topic = app.topic(
+        name=topic_name,
+        value_serializer='json',
+        config=TopicConfig(num_partitions=n_partitions, replication_factor=1),
+    )
+    start_ms = int(time() * 1000) // (window_sec * 1000) * window_sec * 1000
+    step_ms = window_sec * 1000 // trades_per_window
+
+    with app.get_producer() as producer:
+        for i in range(n_windows * trades_per_window):
+            for product in range(n_products):
+                trade = {
+                    'product_id': f'PRODUCT{product}/USD',
+                    'price': 100.0 + i % 50,
+                    'volume': 0.01 * (i % 7 + 1),
+                    'timestamp_ms': start_ms + i * step_ms,
+                    'trade_id': i,
+                    'side': 'buy' if i % 2 else 'sell',
+                }
+                producer.produce(
+                    topic=topic.name,
+                    key=trade['product_id'],
+                    value=json.dumps(trade),
+                    partition=product % n_partitions,
+                )
+            if i % 10_000 == 0:
+                producer.poll(0)
+
+
+def run_replicas(
+    broker_address: str,
+    input_topic: str,
+    n_replicas: int,
+    expected_candles: int,
+    window_sec: int,
+    engine: str,
+    timeout_sec: float,
+) -> float:
+    """
+    Runs `n_replicas` replicas of the service on the trades topic and returns the
+    number of candles per second they produced, from the moment we started them
+    until the last expected candle reached the output topic.
+    """
+    run_id = uuid4().hex[:8]
+    output_topic = f'load_test_ohlc_{run_id}'
+
+    replicas = []
+    for replica in range(n_replicas):
+        env = {
+            **os.environ,
+            'KAFKA_BROKER_ADDRESS': broker_address,
+            'KAFKA_INPUT_TOPIC': input_topic,
+            'KAFKA_OUTPUT_TOPIC': output_topic,
+            'KAFKA_CONSUMER_GROUP': f'load_test_trade_to_ohlc_{run_id}',
+            'KAFKA_AUTO_OFFSET_RESET': 'earliest',
+            'OHLC_WINDOW_SECONDS': str(window_sec),
+            'AGGREGATION_ENGINE': engine,
+            # the replicas run on the same machine, so each needs its own state
+            'STATE_DIR': tempfile.mkdtemp(prefix=f'load_test_{run_id}_{replica}_'),
+            'LOGURU_LEVEL': 'WARNING',
+        }
+        replicas.append(
+            subprocess.Popen(
+                [sys.executable, 'main.py'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+            )
+        )
+    start = perf_counter()
+
+    app = Application(
+        broker_address=broker_address,
+        consumer_group=f'load_test_reader_{run_id}',
+        auto_offset_reset='earliest',
+    )
+    n_candles = 0
+    elapsed = None
+    try:
+        with app.get_consumer() as consumer:
+            consumer.subscribe([output_topic])
+            while perf_counter() - start < timeout_sec:
+                message = consumer.poll(1)
+                if message is None or message.error():
+                    continue
+                n_candles += 1
+                if n_candles >= expected_candles:
+                    elapsed = perf_counter() - start
+                    break
+    finally:
+        for process in replicas:
+            process.terminate()
+        for process in replicas:
+            process.wait()
+
+    if elapsed is None:
+        logger.warning(
+            f'Only {n_candles} of {expected_candles} candles after {timeout_sec}s'
+        )
+        elapsed = timeout_sec
+    return n_candles / elapsed
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Writes the trades once and runs the service with each number of replicas
+    """
+    input_topic = f'load_test_trades_{uuid4().hex[:8]}'
+    app = Application(broker_address=args.broker_address)
+    logger.info(f'Writing the trades to {input_topic}')
+    produce_trades(
+        app,
+        input_topic,
+        n_partitions=args.partitions,
+        n_products=args.products,
+        n_windows=args.windows,
+        trades_per_window=args.trades_per_window,
+        window_sec=args.window_sec,
+    )
+
+    # the last window of each product stays open, because no later trade closes it
+    expected_candles = args.products * (args.windows - 1)
+    results: List[str] = []
+    for n_replicas in args.replicas:
+        candles_per_sec = run_replicas(
+            broker_address=args.broker_address,
+            input_topic=input_topic,
+            n_replicas=n_replicas,
+            expected_candles=expected_candles,
+            window_sec=args.window_sec,
+            engine=args.engine,
+            timeout_sec=args.timeout_sec,
+        )
+        results.append(f'{n_replicas:>3} replicas {candles_per_sec:>12,.1f} candles/sec')
+        logger.info(results[-1])
+
+    print('\n'.join(results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        '--broker-address',
+        default=os.environ.get('KAFKA_BROKER_ADDRESS', 'localhost:19092'),
+    )
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--products', type=int, default=16)
+    parser.add_argument('--windows', type=int, default=100)
+    parser.add_argument('--trades-per-window', type=int, default=100)
+    parser.add_argument('--window-sec', type=int, default=60)
+    parser.add_argument('--engine', choices=['quix', 'native'], default='native')
+    parser.add_argument('--replicas', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--timeout-sec', type=float, default=600)
+    main(parser.parse_args())
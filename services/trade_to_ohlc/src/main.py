@@ -2,7 +2,14 @@ from config import config
 from loguru import logger
 from datetime import timedelta
 from typing import Any, List, Optional, Tuple
-from quixstreams import Application
+from quixstreams import Application, State
+from quixstreams.models.topics import TopicConfig
+from bulk import run_bulk_ohlc
+from candles import init_ohlc_candle, synthetic_candles, update_ohlc_candle, vwap
+from indicators import CandleIndicators
+from ohlc_engine import run_native_ohlc
+from tracing import candle_trace_headers, get_ingest_ms
+from wire_format import TradeDeserializer
 
 def custom_ts_extractor(
     value: Any,
@@ -46,7 +53,29 @@ def trade_to_ohlc(
         #because if the consumer group already exists, it will start reading from the last offset
         #meaning that it will start reading from the last message that was read by the consumer group
         #auto_offset_reset="earliest",#read from the beginning of the topic, meaning all the messages (right for backfilling)
-        auto_offset_reset= "latest" #forget passed messages (right for real-time processing)
+        #auto_offset_reset= "latest" #forget passed messages (right for real-time processing)
+        # a backfill reads the whole topic, unless the consumer group already
+        # committed where it stopped
+        auto_offset_reset=(
+            'earliest' if config.ohlc_bulk_mode else config.kafka_auto_offset_reset
+        ),
+        # the windows are partitioned like the trades, by product_id, and their
+        # state is backed up to a changelog topic, so when we run several replicas
+        # and a partition moves to another one, its open windows move with it.
+        # With the state_dir on a persistent volume, a restart only replays the
+        # changelog from the offset the local state was saved at
+        use_changelog_topics=True,
+        state_dir=config.state_dir,
+        # a backfill reads the trades in large batches, so it fetches them in
+        # large chunks too
+        consumer_extra_config=(
+            {
+                'fetch.max.bytes': 100 * 1024 * 1024,
+                'max.partition.fetch.bytes': 10 * 1024 * 1024,
+            }
+            if config.ohlc_bulk_mode
+            else None
+        ),
     )
 
     #clearing the state store whenever the chanhelogic has been deleted
@@ -55,55 +84,106 @@ def trade_to_ohlc(
     #specify input and output topics
     input_topic = app.topic(
         name=kafka_input_topic,
-        value_serializer='json',
+        # understands both the JSON and the binary trades
+        value_deserializer=TradeDeserializer(),
         timestamp_extractor=custom_ts_extractor,
     )
     output_topic = app.topic(name=kafka_output_topic, value_serializer="json")
 
+    if config.ohlc_window_seconds_list is not None:
+        # several resolutions in a single pass, which only the native engine can do
+        assert (
+            config.aggregation_engine == 'native'
+        ), 'OHLC_WINDOW_SECONDS_LIST needs AGGREGATION_ENGINE=native'
+        output_topics = {
+            window_sec: (
+                output_topic
+                if config.ohlc_tag_window_sec
+                else app.topic(
+                    name=f'{kafka_output_topic}_{window_sec}s', value_serializer='json'
+                )
+            )
+            for window_sec in config.ohlc_window_seconds_list
+        }
+    else:
+        output_topics = {ohlc_window_seconds: output_topic}
+
+    # the settings of the technical indicators we add to the candles, if any
+    indicators = None
+    if config.ohlc_indicators:
+        indicators = {
+            'rsi_timeperiod': config.ohlc_rsi_timeperiod,
+            'momentum_timeperiod': config.ohlc_momentum_timeperiod,
+            'volatility_timeperiod': config.ohlc_volatility_timeperiod,
+        }
+
+    if config.ohlc_bulk_mode:
+        # the backfill hands the candles it hasn't closed over to the native engine
+        assert (
+            config.aggregation_engine == 'native'
+        ), 'OHLC_BULK_MODE needs AGGREGATION_ENGINE=native'
+
+    if config.aggregation_engine == 'native':
+        # the snapshots of the state, so a restart doesn't read again all the trades
+        # of the open candles. The topic is compacted, so it only keeps the latest
+        # snapshot of each product.
+        snapshot_topic = None
+        if config.ohlc_snapshot_interval_sec:
+            snapshot_topic = app.topic(
+                name=f'{kafka_consumer_group}_snapshots',
+                value_serializer='json',
+                config=TopicConfig(
+                    num_partitions=1,
+                    replication_factor=1,
+                    extra_config={'cleanup.policy': 'compact'},
+                ),
+            )
+
+        indicator_stages = None
+        if config.ohlc_bulk_mode:
+            # the trades already in the topic in large pandas batches, then the
+            # native engine takes over from the offsets the backfill committed,
+            # and continues its indicators
+            indicator_stages = run_bulk_ohlc(
+                app=app,
+                input_topic=input_topic,
+                output_topics=output_topics,
+                tag_window_sec=config.ohlc_tag_window_sec,
+                batch_size=config.ohlc_bulk_batch_size,
+                fill_gaps=config.ohlc_fill_gaps,
+                indicators=indicators,
+            )
+
+        # our own array-based aggregation, see ohlc_engine.OHLCEngine
+        run_native_ohlc(
+            app=app,
+            input_topic=input_topic,
+            output_topics=output_topics,
+            tag_window_sec=config.ohlc_tag_window_sec,
+            batch_size=config.native_batch_size,
+            batch_timeout_sec=config.native_batch_timeout_sec,
+            allowed_lateness_ms=config.ohlc_allowed_lateness_ms,
+            max_closed_windows=config.ohlc_max_closed_windows,
+            fill_gaps=config.ohlc_fill_gaps,
+            snapshot_topic=snapshot_topic,
+            snapshot_interval_sec=config.ohlc_snapshot_interval_sec,
+            indicators=indicators,
+            indicator_stages=indicator_stages,
+        )
+        return
+
     #creating a streaming dataframe from the input topic
     sdf = app.dataframe(input_topic)
 
     #applying transformations to the incoming data
-    def init_ohlc_candle(value: dict) -> dict:
-        """
-        Initialize the OHLC candle with the first trade
-        """
-        return {
-            'open': value['price'],
-            'high': value['price'],
-            'low': value['price'],
-            'close': value['price'],
-            'product_id': value['product_id'],
-
-            # Uncomment this line if you plan to use `volume` in your feature engineering
-            # For you Olanrewaju!
-            # 'volume': value['volume']
-        }
-    def update_ohlc_candle(ohlc_candle: dict, trade: dict) -> dict:
-        """
-        Update the OHLC candle with the new trade and return the updated candle
-
-        Args:
-            ohlc_candle : dict : The current OHLC candle
-            trade : dict : The incoming trade
-
-        Returns:
-            dict : The updated OHLC candle
-        """
-        return {
-            'open': ohlc_candle['open'],
-            'high': max(ohlc_candle['high'], trade['price']),
-            'low': min(ohlc_candle['low'], trade['price']),
-            'close': trade['price'],
-            'product_id': trade['product_id'],
-
-            # Uncomment this line if you plan to use `volume` in your feature engineering
-            # For you Olanrewaju!
-            # 'volume': ohlc_candle['volume'] + trade['volume']
-        }
-    
+    # the reducer and the initializer of the candles are in candles.py
     #creating a tumbling window 
-    sdf=sdf.tumbling_window(duration_ms=timedelta(seconds = ohlc_window_seconds))
+    # the grace period keeps the window open for the trades that arrive late, e.g.
+    # after a websocket reconnection, at the cost of emitting the candle later
+    sdf=sdf.tumbling_window(
+        duration_ms=timedelta(seconds = ohlc_window_seconds),
+        grace_ms=timedelta(milliseconds=config.ohlc_allowed_lateness_ms),
+    )
     #applying reduce function to the window
     # Create a "reduce" aggregation with "reducer" and "initializer" functions and wait until the end of the window to return the candle
     sdf=sdf.reduce(reducer=update_ohlc_candle, initializer=init_ohlc_candle).final()
@@ -124,6 +204,9 @@ def trade_to_ohlc(
     #     'low': 3535.98,
     #     'close': 3537.11,
     #     'product_id': 'ETH/USD',
+    #     'volume': 12.5, 'notional': 44208.7, 'vwap': 3536.7, 'trade_count': 42,
+    #     'buy_volume': 7.5, 'sell_volume': 5.0,
+    #     'is_synthetic': False,
     # }
 
     # unpacking the values we want
@@ -133,16 +216,91 @@ def trade_to_ohlc(
     sdf['close'] = sdf['value']['close']
     sdf['product_id'] = sdf['value']['product_id']
 
-    # adding the volume key if you plan to use it generate features that depend on it
-    # For you Olanrewaju!
-    # sdf['volume'] = sdf['value']['volume']
+    # the volume based fields, for the features that depend on them
+    sdf['volume'] = sdf['value']['volume']
+    sdf['notional'] = sdf['value']['notional']
+    sdf['vwap'] = sdf['value'].apply(vwap)
+    sdf['trade_count'] = sdf['value']['trade_count']
+    sdf['buy_volume'] = sdf['value']['buy_volume']
+    sdf['sell_volume'] = sdf['value']['sell_volume']
 
     # adding a timestamp key and transforming it to timestamp
     sdf['timestamp'] = sdf['end']
 
+    # the candles of the windows without trades are marked as synthetic
+    sdf['is_synthetic'] = False
+
     # let's keep only the keys we want in our final message
-    # don't forget to add the volume key if you plan to use it
-    sdf = sdf[['timestamp', 'open', 'high', 'low', 'close', 'product_id']]
+    sdf = sdf[
+        [
+            'timestamp',
+            'open',
+            'high',
+            'low',
+            'close',
+            'product_id',
+            'volume',
+            'notional',
+            'vwap',
+            'trade_count',
+            'buy_volume',
+            'sell_volume',
+            'is_synthetic',
+        ]
+    ]
+
+    if config.ohlc_fill_gaps:
+        window_ms = ohlc_window_seconds * 1000
+
+        def fill_gaps(candle: dict, state: State) -> List[dict]:
+            """
+            Returns the synthetic candles of the windows without trades since the
+            previous candle of the product, followed by `candle`.
+
+            The previous candle is kept in the state of the message key, which is
+            the product_id.
+            """
+            previous_candle = state.get('previous_candle')
+            state.set('previous_candle', candle)
+            if previous_candle is None:
+                return [candle]
+            candles = synthetic_candles(previous_candle, candle['timestamp'], window_ms)
+            return candles + [candle]
+
+        # each candle of the list becomes its own message
+        sdf = sdf.apply(fill_gaps, stateful=True, expand=True)
+
+    if indicators is not None:
+
+        def add_indicators(candle: dict, state: State) -> dict:
+            """
+            Adds the technical indicators of the product to `candle`, updated
+            with it.
+
+            The state of the indicators is kept in the state of the message key,
+            which is the product_id.
+            """
+            saved = state.get('indicators')
+            candle_indicators = (
+                CandleIndicators(**indicators)
+                if saved is None
+                else CandleIndicators.from_dict(saved)
+            )
+            candle.update(
+                candle_indicators.update(candle['timestamp'], candle['close'])
+            )
+            state.set('indicators', candle_indicators.to_dict())
+            return candle
+
+        sdf = sdf.apply(add_indicators, stateful=True)
+
+    # the trace headers, with the ingest time of the trade that closed the window,
+    # whose headers the candle still has
+    sdf = sdf.set_headers(
+        lambda candle, key, timestamp, headers: candle_trace_headers(
+            get_ingest_ms(headers)
+        )
+    )
 
     #print the transformed data
     sdf = sdf.update(logger.info)
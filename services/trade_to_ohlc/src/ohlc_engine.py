@@ -0,0 +1,1150 @@
+import json
+from array import array
+from collections import deque
+from time import monotonic
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from confluent_kafka import TopicPartition
+from loguru import logger
+from quixstreams import Application
+from quixstreams.kafka import Consumer
+from quixstreams.models.topics import Topic
+
+from candles import (
+    add_late_trade,
+    init_ohlc_candle,
+    merge_candles,
+    rebuild_candle,
+    synthetic_candles,
+    vwap,
+)
+from indicators import IndicatorStage
+from snapshots import load_snapshot, read_snapshots, write_snapshots
+from tracing import candle_trace_headers, get_ingest_ms
+from wire_format import parse_trade
+
+# (product_id, price, volume, timestamp_ms, side, offset), where offset is the
+# offset of the trade in its partition of the trades topic
+TradeTuple = Tuple[str, float, float, int, Optional[str], int]
+
+# (offset, floor_ms) of a product: the offset of the first trade we need to read
+# again to rebuild its state, and the start of the oldest window a late trade can
+# still be added to
+ResumePoint = Tuple[int, int]
+
+# the most metadata Kafka keeps with a committed offset, by default
+# (`offset.metadata.max.bytes` of the broker). A commit with more fails.
+MAX_COMMIT_METADATA_BYTES = 4096
+
+# the partitions whose resume points did not fit in the commit metadata, so we
+# warn about them once
+_oversized_partitions = set()
+
+
+class OHLCEngine:
+    """
+    Builds OHLC candles over tumbling windows of `window_ms` milliseconds, for any
+    number of products.
+
+    The state of the open candle of each product (OHLC, volume, notional, trade
+    count and buy / sell volume) lives in preallocated arrays, one slot per
+    product, that are updated in place, so processing a trade does not allocate
+    anything. The VWAP is only computed when the candle closes.
+
+    A candle is closed, and returned by `update`, when the first trade of the same
+    product in a later window arrives, which matches the
+    `tumbling_window(...).final()` of Quix Streams with one product per message key.
+
+    Trades older than the open window of their product are late. The closed
+    candles of the last `allowed_lateness_ms` before the open window are kept, and
+    a late trade that falls in one of them updates it and returns it again from
+    `update`, flagged with `is_correction`, so it can be upserted downstream on
+    its `product_id` and `timestamp`. Trades later than that are dropped and
+    counted in `n_late_trades`.
+
+    With `fill_gaps`, the open window of each product is its watermark, and when
+    it moves past windows without trades, we return a synthetic flat candle for
+    each of them, so the candles of a product have no gaps.
+    """
+
+    def __init__(
+        self,
+        window_ms: int,
+        n_products: int = 64,
+        allowed_lateness_ms: int = 0,
+        max_closed_windows: int = 1_000,
+        fill_gaps: bool = False,
+    ) -> None:
+        """
+        Args:
+            window_ms (int): The size of the tumbling windows, in milliseconds.
+            n_products (int): The number of products we preallocate room for. The
+                arrays grow when we see more products than that.
+            allowed_lateness_ms (int): How long after the end of its window a trade
+                can still correct the candle, measured against the start of the
+                open window of its product. 0 means late trades are dropped.
+            max_closed_windows (int): The maximum number of closed candles kept per
+                product, which bounds the memory for long allowed lateness.
+            fill_gaps (bool): Whether we return synthetic candles for the windows
+                without trades.
+
+        Returns:
+            None
+        """
+        self.window_ms = window_ms
+        self.allowed_lateness_ms = allowed_lateness_ms
+        self.max_closed_windows = max_closed_windows
+        self.fill_gaps = fill_gaps
+
+        # {product_id: index of its slot in the state arrays}
+        self._slots: Dict[str, int] = {}
+        self._product_ids: List[str] = []
+
+        self._capacity = n_products
+        self._window_start = array('q', bytes(8 * n_products))
+        self._open = array('d', bytes(8 * n_products))
+        self._high = array('d', bytes(8 * n_products))
+        self._low = array('d', bytes(8 * n_products))
+        self._close = array('d', bytes(8 * n_products))
+        self._volume = array('d', bytes(8 * n_products))
+        self._notional = array('d', bytes(8 * n_products))
+        self._buy_volume = array('d', bytes(8 * n_products))
+        self._sell_volume = array('d', bytes(8 * n_products))
+        # number of trades in the open candle, 0 means the slot has no open candle
+        self._count = array('q', bytes(8 * n_products))
+
+        # the recently closed candles of each slot, {window start: candle}, which
+        # late trades can still correct
+        self._closed: List[Dict[int, dict]] = []
+        # (window start, offset of its first trade) of the windows of each slot,
+        # oldest first, to know where to read the trades topic again from
+        self._first_offsets: List[Deque[Tuple[int, int]]] = []
+
+        # {product_id: start of the oldest window a late trade can be added to},
+        # for the products we resumed, see `drop_late_trades_before`
+        self._floor_ms: Dict[str, int] = {}
+
+        self.n_late_trades = 0
+
+    def update(self, trades: Iterable[TradeTuple]) -> List[dict]:
+        """
+        Adds a micro-batch of trades to the open candles.
+
+        Args:
+            trades (Iterable[TradeTuple]): The trades, in the order they were consumed.
+
+        Returns:
+            List[dict]: The candles closed by these trades, in the order they closed,
+                with the synthetic candles of the gaps, and the candles corrected
+                by late trades, where their first late trade arrived.
+        """
+        # local references, to skip the attribute lookups in the loop
+        slots = self._slots
+        window_ms = self.window_ms
+        window_start = self._window_start
+        open_ = self._open
+        high = self._high
+        low = self._low
+        close = self._close
+        volume_ = self._volume
+        notional = self._notional
+        buy_volume = self._buy_volume
+        sell_volume = self._sell_volume
+        count = self._count
+        first_offsets = self._first_offsets
+
+        closed = []
+        # {(slot, window start): correction} returned for this batch, so each
+        # candle is returned once, with all its late trades of the batch
+        corrections = {}
+        for product_id, price, volume, timestamp_ms, side, offset in trades:
+            slot = slots.get(product_id)
+            if slot is None:
+                # the arrays grow in place, so our local references stay valid
+                slot = self._add_product(product_id)
+
+            start_ms = timestamp_ms - timestamp_ms % window_ms
+
+            if count[slot] and start_ms == window_start[slot]:
+                # the hot path: the trade falls in the open candle of its product
+                if price > high[slot]:
+                    high[slot] = price
+                elif price < low[slot]:
+                    low[slot] = price
+                close[slot] = price
+                volume_[slot] += volume
+                notional[slot] += price * volume
+                count[slot] += 1
+                if side == 'buy':
+                    buy_volume[slot] += volume
+                elif side == 'sell':
+                    sell_volume[slot] += volume
+                continue
+
+            if count[slot]:
+                if start_ms < window_start[slot]:
+                    candle = self._add_late_trade(slot, price, volume, start_ms, side)
+                    if candle is not None:
+                        correction = corrections.get((slot, start_ms))
+                        if correction is None:
+                            correction = corrections[(slot, start_ms)] = {}
+                            closed.append(correction)
+                        correction.update(candle, is_correction=True)
+                    continue
+                closed.append(self._close_candle(slot, start_ms))
+                if self.fill_gaps:
+                    closed += synthetic_candles(
+                        closed[-1], start_ms + window_ms, window_ms
+                    )
+
+            # open a new candle with this trade
+            first_offsets[slot].append((start_ms, offset))
+            window_start[slot] = start_ms
+            open_[slot] = high[slot] = low[slot] = close[slot] = price
+            volume_[slot] = volume
+            notional[slot] = price * volume
+            count[slot] = 1
+            buy_volume[slot] = volume if side == 'buy' else 0.0
+            sell_volume[slot] = volume if side == 'sell' else 0.0
+
+        return closed
+
+    @property
+    def product_ids(self) -> List[str]:
+        """
+        The products we have seen trades of
+        """
+        return self._product_ids
+
+    def oldest_window_ms(self, product_id: str) -> int:
+        """
+        Returns the start of the oldest window of `product_id` we still need,
+        either its open window or the oldest closed one late trades can correct
+        """
+        slot = self._slots[product_id]
+        closed = self._closed[slot]
+        return min(closed) if closed else self._window_start[slot]
+
+    def floor_ms(self, product_id: str) -> int:
+        """
+        Returns the start of the oldest window of `product_id` a late trade can
+        still be added to. The trades of older windows are dropped, now and later.
+        """
+        horizon_ms = (
+            self._window_start[self._slots[product_id]]
+            - self.window_ms
+            - self.allowed_lateness_ms
+        )
+        floor_ms = horizon_ms - horizon_ms % self.window_ms + self.window_ms
+        # the windows dropped before we resumed stay dropped
+        return max(floor_ms, self._floor_ms.get(product_id, floor_ms))
+
+    def drop_late_trades_before(self, product_id: str, floor_ms: int) -> None:
+        """
+        Drops the late trades of `product_id` for the windows before `floor_ms`.
+
+        When we read the trades again from a resume point, the windows before its
+        `floor_ms` were already dropped as too late, with all the trades they had,
+        so a late trade of one of them must not open a new candle.
+        """
+        self._floor_ms[product_id] = floor_ms
+
+    def first_offset(self, product_id: str, from_ms: int) -> int:
+        """
+        Returns the offset of the first trade of the windows of `product_id` that
+        start at `from_ms` or later, and forgets the offsets of the older windows.
+        """
+        first_offsets = self._first_offsets[self._slots[product_id]]
+        # the open window is always the last one, so we never empty the deque
+        while len(first_offsets) > 1 and first_offsets[0][0] < from_ms:
+            first_offsets.popleft()
+        return first_offsets[0][1]
+
+    def snapshot(self, product_id: str) -> dict:
+        """
+        Returns the state of `product_id`, as a dict that can be serialized to JSON
+        and given to `restore`
+        """
+        slot = self._slots[product_id]
+        return {
+            'window_start': self._window_start[slot],
+            'candle': [
+                self._open[slot],
+                self._high[slot],
+                self._low[slot],
+                self._close[slot],
+                self._volume[slot],
+                self._notional[slot],
+                self._buy_volume[slot],
+                self._sell_volume[slot],
+                self._count[slot],
+            ],
+            'closed': list(self._closed[slot].values()),
+            'first_offsets': list(self._first_offsets[slot]),
+            'floor_ms': self._floor_ms.get(product_id),
+        }
+
+    def restore(self, product_id: str, snapshot: dict) -> None:
+        """
+        Restores the state of `product_id` from a `snapshot` of it
+        """
+        slot = self._slots.get(product_id)
+        if slot is None:
+            slot = self._add_product(product_id)
+
+        self._window_start[slot] = snapshot['window_start']
+        (
+            self._open[slot],
+            self._high[slot],
+            self._low[slot],
+            self._close[slot],
+            self._volume[slot],
+            self._notional[slot],
+            self._buy_volume[slot],
+            self._sell_volume[slot],
+            self._count[slot],
+        ) = snapshot['candle']
+        self._closed[slot] = {
+            candle['timestamp'] - self.window_ms: candle
+            for candle in snapshot['closed']
+        }
+        self._first_offsets[slot] = deque(
+            (start_ms, offset) for start_ms, offset in snapshot['first_offsets']
+        )
+        if snapshot['floor_ms'] is not None:
+            self._floor_ms[product_id] = snapshot['floor_ms']
+
+    def _close_candle(self, slot: int, next_start_ms: int) -> dict:
+        """
+        Closes the open candle in `slot`, because a trade of the window starting at
+        `next_start_ms` arrived, and returns it.
+
+        The candle is kept for late trades, and the candles that are now too old
+        for them are dropped.
+        """
+        candle = self._candle(slot)
+        if not self.allowed_lateness_ms:
+            return candle
+
+        closed = self._closed[slot]
+        closed[self._window_start[slot]] = candle
+
+        horizon_ms = next_start_ms - self.window_ms - self.allowed_lateness_ms
+        for start_ms in [start_ms for start_ms in closed if start_ms <= horizon_ms]:
+            del closed[start_ms]
+        while len(closed) > self.max_closed_windows:
+            del closed[min(closed)]
+
+        # we keep our own copy, because the candle we return is sent as is
+        return dict(candle)
+
+    def _add_late_trade(
+        self,
+        slot: int,
+        price: float,
+        volume: float,
+        start_ms: int,
+        side: Optional[str],
+    ) -> Optional[dict]:
+        """
+        Adds a late trade, of the window starting at `start_ms`, to the closed
+        candle of that window in `slot`.
+
+        Returns:
+            Optional[dict]: The corrected candle, or None if the trade is too late.
+        """
+        closed = self._closed[slot]
+        candle = closed.get(start_ms)
+
+        if candle is not None:
+            add_late_trade(candle, price, volume, side)
+            return candle
+
+        if (
+            start_ms + self.window_ms + self.allowed_lateness_ms
+            <= self._window_start[slot]
+            or len(closed) >= self.max_closed_windows
+            or start_ms < self._floor_ms.get(self._product_ids[slot], start_ms)
+        ):
+            self.n_late_trades += 1
+            return None
+
+        # nothing was traded in this window before, so the trade opens its candle,
+        # which replaces the synthetic one downstream, if any
+        candle = {
+            'timestamp': start_ms + self.window_ms,
+            **init_ohlc_candle(
+                {
+                    'price': price,
+                    'volume': volume,
+                    'product_id': self._product_ids[slot],
+                    'side': side,
+                }
+            ),
+        }
+        candle['vwap'] = vwap(candle)
+        candle['is_synthetic'] = False
+        closed[start_ms] = candle
+        return candle
+
+    def _candle(self, slot: int) -> dict:
+        """
+        Returns the candle in `slot`, in the format of the OHLC topic
+        """
+        candle = {
+            # end of the window
+            'timestamp': self._window_start[slot] + self.window_ms,
+            'open': self._open[slot],
+            'high': self._high[slot],
+            'low': self._low[slot],
+            'close': self._close[slot],
+            'product_id': self._product_ids[slot],
+            'volume': self._volume[slot],
+            'notional': self._notional[slot],
+            'trade_count': self._count[slot],
+            'buy_volume': self._buy_volume[slot],
+            'sell_volume': self._sell_volume[slot],
+        }
+        candle['vwap'] = vwap(candle)
+        candle['is_synthetic'] = False
+        return candle
+
+    def _add_product(self, product_id: str) -> int:
+        """
+        Gives `product_id` a slot in the state arrays, growing them if they are full
+        """
+        slot = len(self._product_ids)
+        if slot == self._capacity:
+            for state in (
+                self._window_start,
+                self._open,
+                self._high,
+                self._low,
+                self._close,
+                self._volume,
+                self._notional,
+                self._buy_volume,
+                self._sell_volume,
+                self._count,
+            ):
+                # doubles the array in place, which keeps the slots where they are
+                state.extend(array(state.typecode, bytes(8 * self._capacity)))
+            self._capacity *= 2
+
+        self._slots[product_id] = slot
+        self._product_ids.append(product_id)
+        self._closed.append({})
+        self._first_offsets.append(deque())
+        return slot
+
+
+class CandleRollup:
+    """
+    Builds the candles of a coarse resolution out of the closed candles of a finer
+    one, e.g. 5m candles out of 1m candles.
+
+    A coarse candle is closed as soon as the finer candle that ends with it is
+    closed, or otherwise when a finer candle of a later window arrives.
+
+    The finer candles of each coarse candle are kept, for as long as late trades
+    can correct them, so a corrected finer candle gives a corrected coarse candle,
+    rebuilt from scratch and flagged with `is_correction`.
+    """
+
+    def __init__(
+        self,
+        finer_window_ms: int,
+        window_ms: int,
+        allowed_lateness_ms: int = 0,
+        max_closed_windows: int = 1_000,
+    ) -> None:
+        """
+        Args:
+            finer_window_ms (int): The size of the candles we get, in milliseconds.
+            window_ms (int): The size of the candles we build, in milliseconds. It
+                must be a multiple of `finer_window_ms`.
+            allowed_lateness_ms (int): How long after the end of its window a
+                candle can still be corrected, as in `OHLCEngine`.
+            max_closed_windows (int): The maximum number of closed candles kept per
+                product.
+
+        Returns:
+            None
+        """
+        assert window_ms % finer_window_ms == 0, (
+            f'{window_ms}ms candles can\'t be built from {finer_window_ms}ms candles'
+        )
+        self.finer_window_ms = finer_window_ms
+        self.window_ms = window_ms
+        self.allowed_lateness_ms = allowed_lateness_ms
+        self.max_closed_windows = max_closed_windows
+
+        # {product_id: open candle}
+        self._candles: Dict[str, dict] = {}
+        # {product_id: {finer timestamp: finer candle}} of the open candles
+        self._finer_candles: Dict[str, Dict[int, dict]] = {}
+        # {product_id: {timestamp: {finer timestamp: finer candle}}} of the
+        # recently closed candles, which can still be corrected
+        self._closed: Dict[str, Dict[int, Dict[int, dict]]] = {}
+        # {product_id: start of the latest finer candle}
+        self._latest_ms: Dict[str, int] = {}
+
+        self.n_late_candles = 0
+
+    def update(self, finer_candles: List[dict]) -> List[dict]:
+        """
+        Adds the closed finer candles to the open coarse candles.
+
+        Args:
+            finer_candles (List[dict]): The finer candles, in the order they closed.
+
+        Returns:
+            List[dict]: The coarse candles closed or corrected by them, in order.
+        """
+        closed = []
+        for finer_candle in finer_candles:
+            product_id = finer_candle['product_id']
+            finer_ms = finer_candle['timestamp']
+            start_ms = finer_ms - self.finer_window_ms
+            end_ms = start_ms - start_ms % self.window_ms + self.window_ms
+
+            candle = self._candles.get(product_id)
+            latest_ms = self._latest_ms.get(product_id)
+            if latest_ms is not None and start_ms <= latest_ms:
+                # a finer candle corrected by late trades, or a late one
+                if candle is not None and candle['timestamp'] == end_ms:
+                    # the coarse candle is still open, so we just start over
+                    finer = self._finer_candles[product_id]
+                    finer[finer_ms] = finer_candle
+                    candle = rebuild_candle(
+                        [finer[ms] for ms in sorted(finer)], timestamp=end_ms
+                    )
+                    candle.pop('is_correction', None)
+                    self._candles[product_id] = candle
+                else:
+                    candle = self._correct(product_id, end_ms, finer_candle)
+                    if candle is not None:
+                        closed.append(candle)
+                continue
+
+            self._latest_ms[product_id] = start_ms
+
+            if candle is not None and candle['timestamp'] != end_ms:
+                closed.append(self._close(product_id))
+                candle = None
+
+            if candle is None:
+                # the candles only differ in their timestamp and window size
+                candle = {**finer_candle, 'timestamp': end_ms}
+                candle.pop('is_correction', None)
+                self._candles[product_id] = candle
+                self._finer_candles[product_id] = {finer_ms: finer_candle}
+            else:
+                self._finer_candles[product_id][finer_ms] = finer_candle
+                merge_candles(candle, finer_candle)
+
+            if finer_ms == end_ms:
+                # no finer candle can fall in this window anymore
+                closed.append(self._close(product_id))
+
+        return closed
+
+    def oldest_window_ms(self, product_id: str) -> Optional[int]:
+        """
+        Returns the start of the oldest window of `product_id` we still need,
+        either its open window or the oldest closed one that can be corrected, or
+        None if we have none
+        """
+        starts = [
+            end_ms - self.window_ms for end_ms in self._closed.get(product_id, ())
+        ]
+        candle = self._candles.get(product_id)
+        if candle is not None:
+            starts.append(candle['timestamp'] - self.window_ms)
+        return min(starts, default=None)
+
+    def snapshot(self, product_id: str) -> dict:
+        """
+        Returns the state of `product_id`, as a dict that can be serialized to JSON
+        and given to `restore`
+        """
+        return {
+            'candle': self._candles.get(product_id),
+            'finer': list(self._finer_candles.get(product_id, {}).values()),
+            'closed': [
+                [end_ms, list(finer.values())]
+                for end_ms, finer in self._closed.get(product_id, {}).items()
+            ],
+            'latest_ms': self._latest_ms.get(product_id),
+        }
+
+    def restore(self, product_id: str, snapshot: dict) -> None:
+        """
+        Restores the state of `product_id` from a `snapshot` of it
+        """
+        if snapshot['candle'] is not None:
+            self._candles[product_id] = snapshot['candle']
+            self._finer_candles[product_id] = {
+                finer_candle['timestamp']: finer_candle
+                for finer_candle in snapshot['finer']
+            }
+        if snapshot['closed']:
+            self._closed[product_id] = {
+                end_ms: {
+                    finer_candle['timestamp']: finer_candle for finer_candle in finer
+                }
+                for end_ms, finer in snapshot['closed']
+            }
+        if snapshot['latest_ms'] is not None:
+            self._latest_ms[product_id] = snapshot['latest_ms']
+
+    def _close(self, product_id: str) -> dict:
+        """
+        Closes the open candle of `product_id` and returns it, keeping its finer
+        candles for the corrections
+        """
+        candle = self._candles.pop(product_id)
+        finer = self._finer_candles.pop(product_id)
+        if not self.allowed_lateness_ms:
+            return candle
+
+        closed = self._closed.setdefault(product_id, {})
+        closed[candle['timestamp']] = finer
+
+        horizon_ms = self._latest_ms[product_id] - self.allowed_lateness_ms
+        for end_ms in [end_ms for end_ms in closed if end_ms <= horizon_ms]:
+            del closed[end_ms]
+        while len(closed) > self.max_closed_windows:
+            del closed[min(closed)]
+
+        return candle
+
+    def _correct(
+        self, product_id: str, end_ms: int, finer_candle: dict
+    ) -> Optional[dict]:
+        """
+        Adds a corrected, or late, finer candle to the closed candle ending at
+        `end_ms`.
+
+        Returns:
+            Optional[dict]: The corrected candle, or None if it is too late.
+        """
+        closed = self._closed.get(product_id, {})
+        finer = closed.get(end_ms)
+
+        if finer is None:
+            if (
+                not self.allowed_lateness_ms
+                or end_ms + self.allowed_lateness_ms <= self._latest_ms[product_id]
+                or len(closed) >= self.max_closed_windows
+            ):
+                self.n_late_candles += 1
+                return None
+            # the first candle of a window without trades until now
+            finer = self._closed.setdefault(product_id, {})[end_ms] = {}
+
+        finer[finer_candle['timestamp']] = finer_candle
+        candle = rebuild_candle([finer[ms] for ms in sorted(finer)], timestamp=end_ms)
+        candle['is_correction'] = True
+        return candle
+
+
+class MultiResolutionOHLC:
+    """
+    Builds candles of several resolutions in a single pass over the trades.
+
+    The finest resolution is built from the trades by the `OHLCEngine`, and each
+    coarser resolution from the candles of the previous one by a `CandleRollup`,
+    e.g. 10s -> 1m -> 5m -> 1h. Each candle is tagged with its `window_sec`.
+    Corrections of the finest candles by late trades flow through the rollups, so
+    they correct the candles of every resolution, and so do the synthetic candles
+    of the gaps.
+
+    With `indicators`, the candles of every resolution also get the technical
+    indicators of their product, see `indicators.IndicatorStage`.
+    """
+
+    def __init__(
+        self,
+        window_secs: List[int],
+        allowed_lateness_ms: int = 0,
+        max_closed_windows: int = 1_000,
+        fill_gaps: bool = False,
+        indicators: Optional[dict] = None,
+    ) -> None:
+        """
+        Args:
+            window_secs (List[int]): The resolutions, in seconds. Each of them must
+                be a multiple of the previous one.
+            allowed_lateness_ms (int): How long after the end of its window a
+                candle can still be corrected by late trades.
+            max_closed_windows (int): The maximum number of closed candles kept per
+                product and resolution.
+            fill_gaps (bool): Whether we emit synthetic candles for the windows
+                without trades.
+            indicators (Optional[dict]): The settings of the `IndicatorStage` that
+                adds the indicators to the candles, or None to not add them.
+
+        Returns:
+            None
+        """
+        self.window_secs = sorted(window_secs)
+        # the settings the state depends on, which a snapshot must match
+        self.settings = {
+            'window_secs': self.window_secs,
+            'allowed_lateness_ms': allowed_lateness_ms,
+            'max_closed_windows': max_closed_windows,
+            'fill_gaps': fill_gaps,
+            'indicators': indicators,
+        }
+        self.indicators = (
+            IndicatorStage(**indicators) if indicators is not None else None
+        )
+
+        self.engine = OHLCEngine(
+            window_ms=self.window_secs[0] * 1000,
+            allowed_lateness_ms=allowed_lateness_ms,
+            max_closed_windows=max_closed_windows,
+            fill_gaps=fill_gaps,
+        )
+        self.rollups = [
+            CandleRollup(
+                finer_window_ms=finer * 1000,
+                window_ms=coarser * 1000,
+                allowed_lateness_ms=allowed_lateness_ms,
+                max_closed_windows=max_closed_windows,
+            )
+            for finer, coarser in zip(self.window_secs, self.window_secs[1:])
+        ]
+
+    def update(self, trades: Iterable[TradeTuple]) -> List[dict]:
+        """
+        Adds a micro-batch of trades to the open candles of every resolution.
+
+        Args:
+            trades (Iterable[TradeTuple]): The trades, in the order they were consumed.
+
+        Returns:
+            List[dict]: The candles of any resolution closed or corrected by these
+                trades.
+        """
+        candles = self.engine.update(trades)
+        for candle in candles:
+            candle['window_sec'] = self.window_secs[0]
+
+        closed = list(candles)
+        for window_sec, rollup in zip(self.window_secs[1:], self.rollups):
+            candles = rollup.update(candles)
+            for candle in candles:
+                candle['window_sec'] = window_sec
+            closed += candles
+
+        if self.indicators is not None:
+            for candle in closed:
+                self.indicators.add_indicators(
+                    candle, self.settings['allowed_lateness_ms']
+                )
+        return closed
+
+    def resume_points(self) -> Dict[str, ResumePoint]:
+        """
+        Returns, for each product, where we need to read its trades again from to
+        rebuild its state: the offset of the first trade of the open candles of
+        every resolution and of the closed candles late trades can still correct,
+        and the start of the oldest window whose late trades still count.
+        """
+        points = {}
+        for product_id in self.engine.product_ids:
+            from_ms = self.engine.oldest_window_ms(product_id)
+            for rollup in self.rollups:
+                oldest_ms = rollup.oldest_window_ms(product_id)
+                if oldest_ms is not None and oldest_ms < from_ms:
+                    from_ms = oldest_ms
+            points[product_id] = (
+                self.engine.first_offset(product_id, from_ms),
+                # the late trades of older windows were dropped by every resolution
+                min(from_ms, self.engine.floor_ms(product_id)),
+            )
+        return points
+
+
+    def snapshot(self, product_id: str) -> dict:
+        """
+        Returns the state of `product_id` in every resolution, as a dict that can
+        be serialized to JSON and given to `restore`
+        """
+        return {
+            'engine': self.engine.snapshot(product_id),
+            'rollups': [rollup.snapshot(product_id) for rollup in self.rollups],
+            'indicators': (
+                self.indicators.snapshot(
+                    product_id, self.settings['allowed_lateness_ms']
+                )
+                if self.indicators is not None
+                else None
+            ),
+        }
+
+    def restore(self, product_id: str, snapshot: dict) -> None:
+        """
+        Restores the state of `product_id` in every resolution from a `snapshot`
+        of it, taken with the same `settings`
+        """
+        self.engine.restore(product_id, snapshot['engine'])
+        for rollup, rollup_snapshot in zip(self.rollups, snapshot['rollups']):
+            rollup.restore(product_id, rollup_snapshot)
+        if self.indicators is not None:
+            self.indicators.restore(product_id, snapshot['indicators'])
+
+    def resume(self, resume_points: Dict[str, ResumePoint]) -> None:
+        """
+        Prepares the engine to read the trades again from the given resume points,
+        committed by the previous owner of the partition.
+        """
+        for product_id, (_, floor_ms) in resume_points.items():
+            self.engine.drop_late_trades_before(product_id, floor_ms)
+
+
+def get_resume_position(
+    topic: str, partition: int, resume_points: Dict[str, ResumePoint]
+) -> TopicPartition:
+    """
+    Returns the position we commit for `partition`: the earliest offset any of its
+    products needs to be read again from, with the resume point of each product
+    in the commit metadata.
+
+    The metadata fits about a hundred products per partition. With more, we only
+    commit the offset, so the new owner of the partition reads the trades of
+    every product from there, and produces again some candles that were final.
+    """
+    offset = min(product_offset for product_offset, _ in resume_points.values())
+    metadata = json.dumps(resume_points, separators=(',', ':'))
+    if len(metadata.encode()) > MAX_COMMIT_METADATA_BYTES:
+        if partition not in _oversized_partitions:
+            _oversized_partitions.add(partition)
+            logger.warning(
+                f'The resume points of the {len(resume_points)} products of '
+                f'partition {partition} take more than {MAX_COMMIT_METADATA_BYTES} '
+                'bytes, so we commit its offset without them. Spread the products '
+                'over more partitions, or set OHLC_SNAPSHOT_INTERVAL_SEC.'
+            )
+        metadata = ''
+    return TopicPartition(topic, partition, offset, metadata=metadata)
+
+
+def get_resume_points(
+    consumer: Consumer, topic: str, partition: int
+) -> Dict[str, ResumePoint]:
+    """
+    Returns the resume points of the products of `partition` from its committed
+    metadata, or an empty dict if nothing was committed with them.
+    """
+    committed = consumer.committed([TopicPartition(topic, partition)], timeout=10)
+    metadata = committed[0].metadata if committed else None
+    if not metadata:
+        return {}
+    try:
+        return {
+            product_id: (offset, floor_ms)
+            for product_id, (offset, floor_ms) in json.loads(metadata).items()
+        }
+    except ValueError:
+        logger.warning(f'Ignoring the committed metadata of partition {partition}')
+        return {}
+
+
+def run_native_ohlc(
+    app: Application,
+    input_topic: Topic,
+    output_topics: Dict[int, Topic],
+    tag_window_sec: bool,
+    batch_size: int,
+    batch_timeout_sec: float,
+    allowed_lateness_ms: int = 0,
+    max_closed_windows: int = 1_000,
+    fill_gaps: bool = False,
+    snapshot_topic: Optional[Topic] = None,
+    snapshot_interval_sec: float = 30.0,
+    indicators: Optional[dict] = None,
+    indicator_stages: Optional[Dict[int, IndicatorStage]] = None,
+) -> None:
+    """
+    Reads trades from `input_topic` in micro-batches, aggregates them with the
+    `MultiResolutionOHLC` engine and produces the closed candles of each resolution
+    to its output topic, with the same format as the Quix Streams pipeline in
+    `main.trade_to_ohlc`.
+
+    Several replicas can run in the same consumer group, each with the partitions
+    of the trades topic Kafka assigns to it. The committed offset of a partition
+    is the first trade its state still depends on, and its metadata the resume
+    point of each product, see `MultiResolutionOHLC.resume_points`, so after a
+    rebalance the new owner rebuilds the state from Kafka, and only produces again
+    the candles that could still have been corrected, with the same key and
+    timestamp.
+
+    With a `snapshot_topic`, we also write the state of each partition to it every
+    `snapshot_interval_sec`, see `snapshots.py`, and the new owner restores it and
+    only reads the trades that came after it, which is much less than the trades
+    the open candles depend on when they are long or when a product trades rarely.
+
+    The candles carry the trace headers of `tracing.py`, with the ingest time of
+    the oldest trade of the micro-batch that closed them.
+
+    Args:
+        app (Application): The Quix Streams application, which configures the
+            consumer and the producer.
+        input_topic (Topic): The topic with the trades.
+        output_topics (Dict[int, Topic]): The topic where we produce the candles of
+            each resolution, in seconds. Several resolutions may share a topic.
+        tag_window_sec (bool): Whether we keep the `window_sec` field of the
+            candles, which tells the resolutions apart in a shared topic.
+        batch_size (int): The maximum number of messages in a micro-batch.
+        batch_timeout_sec (float): How long we wait for the first message of a
+            micro-batch.
+        allowed_lateness_ms (int): How long after the end of its window a candle
+            can still be corrected by late trades. The corrected candles are
+            produced again with the same key and timestamp, and an `is_correction`
+            header, so downstream they replace the candle we produced before.
+        max_closed_windows (int): The maximum number of closed candles kept per
+            product and resolution for the corrections.
+        fill_gaps (bool): Whether we produce synthetic candles, with
+            `is_synthetic` set, for the windows without trades.
+        snapshot_topic (Optional[Topic]): The compacted topic where we write the
+            snapshots of the state, or None to not write them.
+        snapshot_interval_sec (float): How often we write the snapshots.
+        indicators (Optional[dict]): The settings of the `IndicatorStage` that adds
+            the technical indicators to the candles, or None to not add them.
+        indicator_stages (Optional[Dict[int, IndicatorStage]]): The indicators of
+            each partition handed over by `bulk.run_bulk_ohlc`, which the engine
+            of the partition continues with, unless it is restored from a snapshot.
+
+    Returns:
+        None
+    """
+    # the trades of a product are all in the same partition, so each partition
+    # gets its own engine, which we can drop when the partition is assigned to
+    # another replica, and rebuild when it comes back
+    engines: Dict[int, MultiResolutionOHLC] = {}
+    # where the trades of each product of a partition we resumed start counting,
+    # from its committed metadata
+    resume_points: Dict[int, Dict[str, ResumePoint]] = {}
+    # the offset of the next trade of each partition, for the snapshots
+    next_offsets: Dict[int, int] = {}
+    assigned = set()
+
+    def new_engine() -> MultiResolutionOHLC:
+        return MultiResolutionOHLC(
+            window_secs=list(output_topics),
+            allowed_lateness_ms=allowed_lateness_ms,
+            max_closed_windows=max_closed_windows,
+            fill_gaps=fill_gaps,
+            indicators=indicators,
+        )
+
+    def restore_snapshot(
+        consumer: Consumer, partition: int, records: List[dict]
+    ) -> Optional[int]:
+        """
+        Restores the engine of `partition` from its snapshot, and returns the
+        offset we read its trades from, or None if we can't use the snapshot
+        """
+        engine = new_engine()
+        snapshot = load_snapshot(records, engine.settings)
+        if snapshot is None:
+            return None
+        offset, states, points = snapshot
+
+        committed = consumer.committed(
+            [TopicPartition(input_topic.name, partition)], timeout=10
+        )[0]
+        if offset < committed.offset:
+            # e.g. the snapshots were turned off for a while
+            logger.warning(f'Ignoring an old snapshot of partition {partition}')
+            return None
+
+        for product_id, state in states.items():
+            engine.restore(product_id, state)
+        engine.resume(points)
+        engines[partition] = engine
+        resume_points[partition] = {
+            **{
+                product_id: (offset, engine.engine.floor_ms(product_id))
+                for product_id in states
+            },
+            **points,
+        }
+        logger.info(f'Restored {len(states)} products of partition {partition}')
+        # the products we had no state for need their trades from before it
+        return min([offset] + [point[0] for point in points.values()])
+
+    def on_assign(consumer: Consumer, partitions: List[TopicPartition]) -> None:
+        assigned.update(partition.partition for partition in partitions)
+        logger.info(f'Assigned partitions {sorted(assigned)}')
+
+        if snapshot_topic is not None and partitions:
+            snapshots = read_snapshots(app, snapshot_topic, input_topic.name)
+            for partition in partitions:
+                offset = restore_snapshot(
+                    consumer,
+                    partition.partition,
+                    snapshots.get(partition.partition, []),
+                )
+                if offset is not None:
+                    partition.offset = offset
+        # we assign the partitions ourselves, to start from the snapshots
+        consumer.incremental_assign(partitions)
+
+    def on_revoke(consumer: Consumer, partitions: List[TopicPartition]) -> None:
+        for partition in partitions:
+            assigned.discard(partition.partition)
+            # the replica the partition goes to rebuilds the state from the
+            # offset we committed
+            engines.pop(partition.partition, None)
+            resume_points.pop(partition.partition, None)
+            next_offsets.pop(partition.partition, None)
+        logger.info(f'Assigned partitions {sorted(assigned)}')
+
+    with app.get_consumer() as consumer, app.get_producer() as producer:
+        consumer.subscribe(
+            [input_topic.name],
+            on_assign=on_assign,
+            on_revoke=on_revoke,
+            on_lost=on_revoke,
+        )
+        next_snapshot_at = monotonic() + snapshot_interval_sec
+
+        while True:
+            # wait for the first message, then take whatever is already fetched
+            message = consumer.poll(batch_timeout_sec)
+            if message is None:
+                continue
+
+            messages = [message]
+            while len(messages) < batch_size:
+                message = consumer.poll(0)
+                if message is None:
+                    break
+                messages.append(message)
+
+            # the trades of each partition
+            trades: Dict[int, List[TradeTuple]] = {}
+            # the ingest time of the oldest trade of each partition, which the
+            # candles closed by this batch are traced with, because the trades of
+            # a batch all wait for the batch
+            ingest_ms: Dict[int, Optional[int]] = {}
+            for message in messages:
+                if message.error():
+                    logger.error(f'Failed to consume a message: {message.error()}')
+                    continue
+
+                partition = message.partition()
+                if partition not in assigned:
+                    # fetched before the partition was revoked
+                    continue
+                if partition not in engines:
+                    engines[partition] = new_engine()
+                    if indicator_stages and partition in indicator_stages:
+                        engines[partition].indicators = indicator_stages.pop(
+                            partition
+                        )
+                    resume_points[partition] = get_resume_points(
+                        consumer, input_topic.name, partition
+                    )
+                    engines[partition].resume(resume_points[partition])
+
+                trade = parse_trade(message.value())
+                offset = message.offset()
+                next_offsets[partition] = offset + 1
+                resume_point = resume_points[partition].get(trade['product_id'])
+                if resume_point is not None and offset < resume_point[0]:
+                    # already in candles we produced, which can't change anymore
+                    continue
+
+                trades.setdefault(partition, []).append(
+                    (
+                        trade['product_id'],
+                        trade['price'],
+                        trade['volume'],
+                        trade['timestamp_ms'],
+                        trade.get('side'),
+                        offset,
+                    )
+                )
+                if partition not in ingest_ms:
+                    ingest_ms[partition] = get_ingest_ms(message.headers())
+
+            candles = []
+            for partition, partition_trades in trades.items():
+                candles += [
+                    (candle, ingest_ms[partition])
+                    for candle in engines[partition].update(partition_trades)
+                ]
+
+            for candle, candle_ingest_ms in candles:
+                logger.info(candle)
+                window_sec = candle['window_sec']
+                if not tag_window_sec:
+                    del candle['window_sec']
+                headers = candle_trace_headers(candle_ingest_ms)
+                # the flag goes in a header, so the candles keep the same schema
+                if candle.pop('is_correction', False):
+                    headers.append(('is_correction', b'1'))
+
+                output_topic = output_topics[window_sec]
+                kafka_message = output_topic.serialize(
+                    key=candle['product_id'], value=candle
+                )
+                producer.produce(
+                    topic=output_topic.name,
+                    key=kafka_message.key,
+                    value=kafka_message.value,
+                    headers=headers,
+                    # like Quix Streams, we timestamp the candle with its window start
+                    timestamp=candle['timestamp'] - window_sec * 1000,
+                )
+
+            if candles:
+                # the candles must be in Kafka before we commit the trades they
+                # were built from
+                producer.flush()
+
+            # we commit the offset of the oldest trade the state of the partition
+            # still depends on, not the last one we read, so the replica that
+            # takes the partition over reads again only what it needs to rebuild
+            # the open candles and the ones late trades can still correct. The
+            # offsets are committed in the background by the consumer.
+            positions = []
+            for partition in trades:
+                points = engines[partition].resume_points()
+                # the products we haven't read a trade of since we resumed still
+                # need what the previous owner committed for them
+                for product_id, point in resume_points[partition].items():
+                    points.setdefault(product_id, point)
+                positions.append(
+                    get_resume_position(input_topic.name, partition, points)
+                )
+            if positions:
+                consumer.store_offsets(offsets=positions)
+
+            if snapshot_topic is not None and monotonic() >= next_snapshot_at:
+                for partition, offset in next_offsets.items():
+                    engine = engines[partition]
+                    product_ids = set(engine.engine.product_ids)
+                    write_snapshots(
+                        producer,
+                        snapshot_topic,
+                        input_topic.name,
+                        partition,
+                        offset,
+                        engine.settings,
+                        states={
+                            product_id: engine.snapshot(product_id)
+                            for product_id in product_ids
+                        },
+                        resume_points={
+                            product_id: point
+                            for product_id, point in resume_points[partition].items()
+                            if product_id not in product_ids
+                        },
+                    )
+                next_snapshot_at = monotonic() + snapshot_interval_sec
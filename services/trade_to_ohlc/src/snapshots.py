@@ -0,0 +1,178 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from confluent_kafka import OFFSET_BEGINNING, TopicPartition
+from loguru import logger
+from quixstreams import Application
+from quixstreams.kafka import Producer
+from quixstreams.models.topics import Topic
+
+# Snapshots of the state of the native engine, see `ohlc_engine.run_native_ohlc`.
+#
+# Every few seconds we write one record per product of each partition of the
+# trades topic to a compacted topic, keyed by '{trades topic}/{partition}/{product}',
+# with the state of its open and still-correctable candles in every resolution and
+# the offset of the next trade of the partition. A replica that gets the partition
+# restores the products from their records and reads the trades from that offset,
+# instead of from the oldest trade the open candles depend on.
+#
+# The value of a record:
+#
+#   {'topic': trades topic, 'partition': 0, 'product_id': 'BTC/USD',
+#    'offset': next offset of the partition, 'settings': {...} of the engine,
+#    'state': the state of the product, or None if we have no state for it yet,
+#    'resume_point': [offset, floor_ms] of a product without state, or None}
+
+
+def snapshot_key(topic: str, partition: int, product_id: str) -> str:
+    """
+    Returns the key of the snapshot record of `product_id` in `partition`
+    """
+    return f'{topic}/{partition}/{product_id}'
+
+
+def write_snapshots(
+    producer: Producer,
+    snapshot_topic: Topic,
+    topic: str,
+    partition: int,
+    offset: int,
+    settings: dict,
+    states: Dict[str, dict],
+    resume_points: Dict[str, Tuple[int, int]],
+) -> None:
+    """
+    Produces the snapshot records of the products of `partition`.
+
+    Args:
+        producer (Producer): The producer of the candles.
+        snapshot_topic (Topic): The compacted topic of the snapshots.
+        topic (str): The name of the trades topic.
+        partition (int): The partition of the trades topic.
+        offset (int): The offset of the next trade of the partition.
+        settings (dict): The settings of the engine, which the state depends on.
+        states (Dict[str, dict]): The state of each product we have one for.
+        resume_points (Dict[str, Tuple[int, int]]): The resume points of the
+            products we have no state for yet, because we haven't read one of
+            their trades since we resumed the partition.
+
+    Returns:
+        None
+    """
+    records = [(product_id, state, None) for product_id, state in states.items()]
+    records += [
+        (product_id, None, list(resume_point))
+        for product_id, resume_point in resume_points.items()
+    ]
+    for product_id, state, resume_point in records:
+        producer.produce(
+            topic=snapshot_topic.name,
+            key=snapshot_key(topic, partition, product_id),
+            value=json.dumps(
+                {
+                    'topic': topic,
+                    'partition': partition,
+                    'product_id': product_id,
+                    'offset': offset,
+                    'settings': settings,
+                    'state': state,
+                    'resume_point': resume_point,
+                },
+                separators=(',', ':'),
+            ),
+        )
+
+
+def read_snapshots(
+    app: Application, snapshot_topic: Topic, topic: str
+) -> Dict[int, List[dict]]:
+    """
+    Reads the whole snapshot topic, which is small because it is compacted.
+
+    Args:
+        app (Application): The Quix Streams application, which configures the
+            consumer.
+        snapshot_topic (Topic): The compacted topic of the snapshots, with a single
+            partition.
+        topic (str): The name of the trades topic.
+
+    Returns:
+        Dict[int, List[dict]]: The latest record of each product of `topic`, by
+            partition.
+    """
+    records = {}
+    # our own consumer, which reads the topic without joining the consumer group
+    with app.get_consumer(auto_commit_enable=False) as consumer:
+        _, high = consumer.get_watermark_offsets(
+            TopicPartition(snapshot_topic.name, 0), timeout=10
+        )
+        if high > 0:
+            consumer.incremental_assign(
+                [TopicPartition(snapshot_topic.name, 0, OFFSET_BEGINNING)]
+            )
+            while True:
+                message = consumer.poll(10)
+                if message is None:
+                    logger.warning('Timed out reading the snapshots')
+                    break
+                if message.error():
+                    logger.error(f'Failed to read a snapshot: {message.error()}')
+                    continue
+                # the topic may not be compacted yet, so the last record wins
+                if message.value() is not None:
+                    records[message.key()] = json.loads(message.value())
+                if message.offset() >= high - 1:
+                    break
+
+    snapshots: Dict[int, List[dict]] = {}
+    for record in records.values():
+        if record['topic'] == topic:
+            snapshots.setdefault(record['partition'], []).append(record)
+    return snapshots
+
+
+def load_snapshot(
+    records: List[dict], settings: dict
+) -> Optional[Tuple[int, Dict[str, dict], Dict[str, Tuple[int, int]]]]:
+    """
+    Checks the snapshot records of a partition and splits them up.
+
+    The records of a partition are only usable together if they were all written
+    at the same offset, i.e. we didn't stop halfway through writing them, and
+    with the same settings as the engine we restore them into.
+
+    Args:
+        records (List[dict]): The snapshot records of the partition.
+        settings (dict): The settings of the engine.
+
+    Returns:
+        Optional[Tuple[int, Dict[str, dict], Dict[str, Tuple[int, int]]]]: The
+            offset of the snapshot, the state of each product we have one for and
+            the resume points of the others, or None if the snapshot is not usable.
+    """
+    if not records:
+        return None
+    offsets = {record['offset'] for record in records}
+    if len(offsets) > 1:
+        logger.warning(
+            f'Ignoring an incomplete snapshot of partition {records[0]["partition"]}'
+        )
+        return None
+    if any(record['settings'] != settings for record in records):
+        logger.warning(
+            f'Ignoring a snapshot of partition {records[0]["partition"]} '
+            'taken with other settings'
+        )
+        return None
+
+    states = {
+        record['product_id']: record['state']
+        for record in records
+        if record['state'] is not None
+    }
+    resume_points = {
+        record['product_id']: tuple(record['resume_point'])
+        for record in records
+        if record['state'] is None
+    }
+    return offsets.pop(), states, resume_points
@@ -0,0 +1,46 @@
+from time import time
+from typing import Collection, List, Optional, Tuple, Union
+
+# Trace headers of the messages of the pipeline, to measure how long it takes from
+# the end of the window of a candle to the candle being queryable in the feature
+# store, and which service the time goes to:
+#
+#   'ingest_ms': when `trade_producer` got the trade from the exchange. We copy it
+#       from the trade that closed the candle to the candle
+#   'produce_ms': when we produced the candle
+#
+# Both are milliseconds since the epoch, as ASCII digits. The end of the window is
+# the `timestamp` of the candle. `kafka_to_feature_store` turns them into latency
+# histograms once the candle is inserted, see `kafka_to_feature_store/src/metrics.py`
+INGEST_MS_HEADER = 'ingest_ms'
+PRODUCE_MS_HEADER = 'produce_ms'
+
+Headers = Collection[Tuple[str, Union[str, bytes]]]
+
+
+def get_ingest_ms(headers: Optional[Headers]) -> Optional[int]:
+    """
+    Returns the ingest time in the `headers` of a trade, or None if the trade has
+    none, e.g. because it was produced before we traced the trades.
+    """
+    for key, value in headers or ():
+        if key == INGEST_MS_HEADER:
+            return int(value)
+    return None
+
+
+def candle_trace_headers(ingest_ms: Optional[int]) -> List[Tuple[str, bytes]]:
+    """
+    Returns the trace headers of a candle we are about to produce.
+
+    Args:
+        ingest_ms (Optional[int]): The ingest time of the trade that closed the
+            candle, or None if we don't know it.
+
+    Returns:
+        List[Tuple[str, bytes]]: The headers of the candle.
+    """
+    headers = [(PRODUCE_MS_HEADER, str(int(time() * 1000)).encode())]
+    if ingest_ms is not None:
+        headers.append((INGEST_MS_HEADER, str(ingest_ms).encode()))
+    return headers
@@ -0,0 +1,75 @@
+import json
+import struct
+
+from quixstreams.models import Deserializer, SerializationContext
+from quixstreams.models.serializers.exceptions import SerializationError
+
+# Binary wire format of the trades topic, as produced by `trade_producer`
+# (see `trade_producer/src/serialization.py`). Version 2:
+#
+#   magic (uint8, always 0) | version (uint8) | price (float64) | volume (float64) |
+#   timestamp_ms (int64) | trade_id (int64, -1 if missing) |
+#   side (int8, 1 for buy, -1 for sell, 0 if missing) | product_id (utf-8)
+#
+# Version 1 is the same without the side.
+BINARY_MAGIC = 0
+BINARY_TRADE_V1 = struct.Struct('<BBddqq')
+BINARY_TRADE_V2 = struct.Struct('<BBddqqb')
+BINARY_SIDES = {1: 'buy', -1: 'sell', 0: None}
+
+
+def parse_trade(value: bytes) -> dict:
+    """
+    Parses a message of the trades topic, in either format, into a dictionary.
+
+    Args:
+        value (bytes): The value of the message.
+
+    Returns:
+        dict: The trade, with the same keys as the JSON messages.
+
+    Raises:
+        SerializationError: If the message is in neither format.
+    """
+    if value[:1] != bytes([BINARY_MAGIC]):
+        try:
+            return json.loads(value)
+        except ValueError as exc:
+            raise SerializationError(str(exc)) from exc
+
+    version = value[1]
+    if version == 2:
+        _, _, price, volume, timestamp_ms, trade_id, side = (
+            BINARY_TRADE_V2.unpack_from(value)
+        )
+        product_id = value[BINARY_TRADE_V2.size :].decode()
+    elif version == 1:
+        _, _, price, volume, timestamp_ms, trade_id = BINARY_TRADE_V1.unpack_from(
+            value
+        )
+        product_id = value[BINARY_TRADE_V1.size :].decode()
+        side = 0
+    else:
+        raise SerializationError(f'Unknown binary trade version {version}')
+
+    return {
+        'product_id': product_id,
+        'price': price,
+        'volume': volume,
+        'timestamp_ms': timestamp_ms,
+        'trade_id': trade_id if trade_id >= 0 else None,
+        'side': BINARY_SIDES[side],
+    }
+
+
+class TradeDeserializer(Deserializer):
+    """
+    Deserializes the messages of the trades topic into dictionaries, whether they
+    were produced as JSON or in the binary format.
+
+    The first byte of a binary message is always 0, which can't start a JSON
+    document, so both formats can coexist in the same topic while we migrate.
+    """
+
+    def __call__(self, value: bytes, ctx: SerializationContext) -> dict:
+        return parse_trade(value)